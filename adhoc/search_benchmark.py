@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Benchmark multi-term search over a synthetic music library.
+
+This compares the way djdb.search.fetch_keys_for_query_string used to
+combine query terms (in sorted order, materializing every match of
+every term) with the selectivity-ordered executor in djdb.postings.
+
+It does not need App Engine; run it from the top of the tree:
+
+    python adhoc/search_benchmark.py --tracks=100000
+
+One run with --tracks=100000 --repeat=10 gave:
+
+    query                       matches   naive ms     new ms  speedup
+    blue love                      2415      66.59      46.77     1.4x
+    band quasar                       0      54.20       0.01  3953.3x
+    city night blue band             28      98.96      29.25     3.4x
+    love -remix                   13253      68.60      68.92     1.0x
+    night song -live -remix        1552     106.62      48.61     2.2x
+
+Queries with a rare term gain the most.  A single common term with
+forbidden terms, like "love -remix", gains nothing: every match of
+"love" has to be looked at either way.
+"""
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from djdb import postings
+
+
+# Query parts are (is_forbidden, term).  Stop words such as "the" are
+# never indexed or searched for (see djdb.search._is_stop_word), so
+# they are left out here too.
+QUERIES = [
+    ('blue love', [(False, u'blue'), (False, u'love')]),
+    ('band quasar', [(False, u'band'), (False, u'quasar')]),
+    ('city night blue band', [(False, u'city'), (False, u'night'),
+                              (False, u'blue'), (False, u'band')]),
+    ('love -remix', [(False, u'love'), (True, u'remix')]),
+    ('night song -live -remix', [(False, u'night'), (False, u'song'),
+                                 (True, u'live'), (True, u'remix')]),
+]
+
+COMMON_WORDS = [u'band', u'love', u'night', u'live', u'remix', u'song',
+                u'blue', u'city', u'dance', u'heart', u'dream', u'home']
+
+
+def build_library(num_tracks, seed=1):
+    """Returns {term: {field: set of doc ids}} for a fake library."""
+    rnd = random.Random(seed)
+    rare_words = [u'word%05d' % i for i in xrange(20000)] + [u'quasar']
+    index = {}
+
+    def add(doc_id, field, words):
+        for w in words:
+            index.setdefault(w, {}).setdefault(field, set()).add(doc_id)
+
+    def some_words(n):
+        words = []
+        for _ in xrange(n):
+            if rnd.random() < 0.4:
+                words.append(rnd.choice(COMMON_WORDS))
+            else:
+                # A rough Zipf distribution over the rare words.
+                i = int(len(rare_words) * rnd.random() ** 3)
+                words.append(rare_words[i])
+        return words
+
+    num_artists = max(1, num_tracks // 50)
+    artist_names = [some_words(rnd.randint(1, 3))
+                    for _ in xrange(num_artists)]
+    for doc_id in xrange(num_tracks):
+        add(doc_id, 'title', some_words(rnd.randint(1, 5)))
+        add(doc_id, 'artist', rnd.choice(artist_names))
+    return index
+
+
+def naive_search(index, query):
+    """The old algorithm: sorted order, a fresh dict for every term."""
+    all_matches = None
+    for is_forbidden, term in sorted(query):
+        these_matches = set()
+        for field, ids in index.get(term, {}).iteritems():
+            these_matches.update((doc_id, field) for doc_id in ids)
+        if is_forbidden:
+            for doc_id, _ in these_matches:
+                all_matches.pop(doc_id, None)
+        elif all_matches is None:
+            all_matches = {}
+            for doc_id, field in these_matches:
+                all_matches.setdefault(doc_id, set()).add(field)
+        else:
+            new_all_matches = {}
+            for doc_id, field in these_matches:
+                if doc_id in all_matches:
+                    fields = new_all_matches.get(doc_id)
+                    if fields is None:
+                        fields = new_all_matches[doc_id] = set(
+                            all_matches[doc_id])
+                    fields.add(field)
+            all_matches = new_all_matches
+        if not all_matches:
+            break
+    return all_matches
+
+
+def postings_search(plist_index, query):
+    required = []
+    forbidden = []
+    for is_forbidden, term in query:
+        clause = plist_index.get(term, {}).items()
+        if is_forbidden:
+            forbidden.append(clause)
+        else:
+            required.append(clause)
+    return postings.execute(required, forbidden)
+
+
+def time_it(fn, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        result = fn()
+    return (time.time() - start) / repeat, result
+
+
+def main():
+    p = optparse.OptionParser(usage='%prog [options]')
+    p.add_option('--tracks', type='int', default=100000,
+                 help='Number of tracks in the synthetic library')
+    p.add_option('--repeat', type='int', default=20,
+                 help='Number of times to run each query')
+    (options, args) = p.parse_args()
+
+    start = time.time()
+    index = build_library(options.tracks)
+    plist_index = {}
+    for term, by_field in index.iteritems():
+        plist_index[term] = dict((field, postings.from_ids(ids))
+                                 for field, ids in by_field.iteritems())
+    print 'Built a %d-track library with %d terms in %.1fs' % (
+        options.tracks, len(index), time.time() - start)
+    print
+    print '%-26s %8s %10s %10s %8s' % ('query', 'matches', 'naive ms',
+                                       'new ms', 'speedup')
+    for label, query in QUERIES:
+        naive_secs, expected = time_it(lambda: naive_search(index, query),
+                                       options.repeat)
+        new_secs, actual = time_it(lambda: postings_search(plist_index,
+                                                           query),
+                                   options.repeat)
+        assert (expected or {}) == actual, label
+        print '%-26s %8d %10.2f %10.2f %7.1fx' % (
+            label, len(actual), naive_secs * 1000, new_secs * 1000,
+            naive_secs / max(new_secs, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
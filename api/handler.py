@@ -34,6 +34,7 @@ from playlists.models import (chirp_playlist_key, PlaylistTrack,
 from playlists.tasks import _push_notify
 from djdb import pylast
 from common import dbconfig
+from common.prefetch import prefetch_references
 
 
 log = logging.getLogger()
@@ -143,6 +144,8 @@ class CurrentPlaylist(CachedApiHandler):
                                 .filter('playlist =', playlist_key)
                                 .order('-established')
                                 .fetch(6))
+        prefetch_references(recent_tracks,
+                            ['selector', 'artist', 'track', 'album'])
         return {
             'now_playing': self.track_as_data(recent_tracks.pop(0)),
             # Last 5 played tracks:
@@ -0,0 +1,75 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+__all__ = ['TestPrefetchReferences']
+
+import datetime
+import unittest
+
+import fudge
+from google.appengine.ext import db
+
+from common import prefetch
+from djdb.models import Artist, Album, Track
+
+
+class TestPrefetchReferences(unittest.TestCase):
+
+    def setUp(self):
+        self.artist = Artist.create(name=u"Stevie Wonder")
+        self.artist.put()
+        self.album = Album(album_id=1,
+                           album_artist=self.artist,
+                           title=u"Talking Book",
+                           import_timestamp=datetime.datetime.now(),
+                           num_tracks=2)
+        self.album.put()
+        for i, title in enumerate([u"Superstition", u"Big Brother"]):
+            Track(album=self.album,
+                  title=title,
+                  track_artist=self.artist,
+                  sampling_rate_hz=44000,
+                  bit_rate_kbps=256,
+                  channels='stereo',
+                  duration_ms=123,
+                  track_num=i + 1).put()
+
+    def tearDown(self):
+        for model in (Track, Album, Artist):
+            for obj in model.all():
+                obj.delete()
+
+    def test_prefetch(self):
+        tracks = Track.all().fetch(10)
+        before = prefetch.rpcs_saved()
+        # Four references to two entities, resolved with one get.
+        saved = prefetch.prefetch_references(
+            tracks + [None], ['album', 'track_artist', 'no_such_property'])
+        self.assertEqual(3, saved)
+        self.assertEqual(before + 3, prefetch.rpcs_saved())
+        no_gets = fudge.Fake('get').is_callable().raises(
+            AssertionError('unexpected get'))
+        patch = fudge.patch_object(db, 'get', no_gets)
+        try:
+            for trk in tracks:
+                self.assertEqual(u"Talking Book", trk.album.title)
+                self.assertEqual(u"Stevie Wonder", trk.track_artist.name)
+        finally:
+            patch.restore()
+
+    def test_nothing_to_prefetch(self):
+        self.assertEqual(0, prefetch.prefetch_references([], ['album']))
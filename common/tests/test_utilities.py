@@ -16,7 +16,7 @@
 ### limitations under the License.
 ###
 
-__all__ = ['TestJSONHandler', 'TestAsEncodedString']
+__all__ = ['TestJSONHandler', 'TestAsEncodedString', 'TestStreamingCSV']
 
 from unittest import TestCase
 
@@ -72,6 +72,40 @@ class TestAsEncodedString(TestCase):
                                                     'Ivan Krsti?')
 
 
+class TestStreamingCSV(TestCase):
+
+    def test_iter_csv(self):
+        lines = utilities.iter_csv(iter([['a', 'b,c'], [1, 'Krsti\xc4\x87']]))
+        self.assertEqual(lines.next(), 'a,"b,c"\r\n')
+        self.assertEqual(lines.next(), '1,Krsti\xc4\x87\r\n')
+        self.assertRaises(StopIteration, lines.next)
+
+    def test_iter_csv_with_format(self):
+        self.assertEqual(list(utilities.iter_csv([['a', 'b']], delimiter='\t')),
+                         ['a\tb\r\n'])
+
+    def test_rows_are_read_as_the_response_is_sent(self):
+        read = []
+
+        def items():
+            for i in range(3):
+                read.append(i)
+                yield {'name': u'Ivan Krsti\u0107', 'num': i}
+
+        response = utilities.http_send_csv_file('people', ['name', 'num'],
+                                                items())
+        self.assertEqual(read, [])
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=people.csv')
+        self.assertEqual(response.content,
+                         'name,num\r\n'
+                         'Ivan Krsti\xc4\x87,0\r\n'
+                         'Ivan Krsti\xc4\x87,1\r\n'
+                         'Ivan Krsti\xc4\x87,2\r\n')
+        self.assertEqual(read, [0, 1, 2])
+
+
 class TestCronJob(TestCase):
 
     def setUp(self):
@@ -14,9 +14,12 @@
 ### See the License for the specific language governing permissions and
 ### limitations under the License.
 ###
+import csv
 import functools
+import itertools
 import traceback
 import logging
+from StringIO import StringIO
 
 from django import http
 from django.conf import settings
@@ -60,24 +63,51 @@ def as_encoded_str(s, encoding='utf8', errors='strict'):
     return s
 
 
-def http_send_csv_file(fname, fields, items):
-    import csv
+def iter_csv(rows, **fmtparams):
+    """Formats rows as CSV, one line at a time.
+
+    Only the current line is held in memory, so this can format any
+    number of rows as they are produced.
+
+    Args:
+      rows: An iterable of sequences.  Unicode values must already be
+        encoded.
+      fmtparams: Passed on to csv.writer().
 
+    Yields:
+      One byte string per row.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf, **fmtparams)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def http_stream_csv_file(fname, lines, extension='csv'):
+    """Returns a response that sends CSV lines as they are produced.
+
+    Args:
+      fname: The name of the file to download, without its extension.
+      lines: An iterable of byte strings, such as one made by iter_csv()
+        or a job's output.  It is only read as the response is sent.
+      extension: The extension of the file to download.
+    """
+    response = HttpResponse(lines, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = "attachment; filename=%s.%s" % (
+                                                            fname, extension)
+    return response
+
+
+def http_send_csv_file(fname, fields, items):
     # dump item using key fields
     def item2row(i):
         return [as_encoded_str(i[key], encoding='utf8') for key in fields]
 
-    # use response obj to set filename of downloaded file
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = "attachment; filename=%s.csv" % (fname)
-
-    # write data out
-    out = csv.writer(response)
-    out.writerow(fields)
-    for item in items:
-        out.writerow(item2row(item))
-    #
-    return response
+    rows = itertools.chain([fields], itertools.imap(item2row, items))
+    return http_stream_csv_file(fname, iter_csv(rows))
 
 
 def _access_restrictor(role):
@@ -89,9 +119,10 @@ def _access_restrictor(role):
     return restrict_access
 
 
-def restricted_job_worker(job_name, required_role):
+def restricted_job_worker(job_name, required_role, **kwargs):
     return job_worker(job_name,
-                      pre_request=_access_restrictor(required_role))
+                      pre_request=_access_restrictor(required_role),
+                      **kwargs)
 
 
 def restricted_job_product(job_name, required_role):
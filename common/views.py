@@ -22,6 +22,7 @@ from google.appengine.api import taskqueue
 
 from common.models import Config, load_dbconfig_into_memcache
 from common.utilities import as_json
+from djdb import search
 
 log = logging.getLogger()
 
@@ -60,4 +61,5 @@ def appengine_warmup(request):
     log.info("Warming up")
     taskqueue.add(url='/api/current_playlist', method='GET')
     load_dbconfig_into_memcache()
+    search.build_snapshot()
     return HttpResponse("it's getting hot in here")
@@ -0,0 +1,127 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Per-artist track catalogs for the DJ track search.
+
+A catalog lists every track on an artist's albums.  It is built with
+one query for the album keys, one batch get for the albums, and one
+query per album for the tracks, all issued at once.  It is then kept
+in memcache until one of the artist's albums or tracks changes, at
+which point invalidate_for() throws it away.
+
+The cached form is compact: each album's title and label are stored
+once rather than once per track.
+"""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from djdb import models
+
+log = logging.getLogger(__name__)
+
+# Catalogs are invalidated explicitly, so this only bounds how long
+# an unused one takes up space.
+MEMCACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _cache_key(artist_key):
+    return "djdb.catalog.%s" % artist_key
+
+
+def _build(artist_key):
+    query = db.Query(models.Album, keys_only=True)
+    query.filter("album_artist =", db.Key(str(artist_key)))
+    album_keys = list(AutoRetry(query).run())
+    # Start every track query before reading from any of them, so that
+    # their RPCs overlap.
+    in_flight = [AutoRetry(models.Track.all().filter("album =", key)).run()
+                 for key in album_keys]
+    albums = {}
+    for album in AutoRetry(db).get(album_keys):
+        if album:
+            albums[str(album.key())] = (album.title, album.label)
+    tracks = []
+    for album_key, album_tracks in zip(album_keys, in_flight):
+        album_key = str(album_key)
+        if album_key not in albums:
+            continue
+        for t in album_tracks:
+            tracks.append((t.title, str(t.key()), list(t.current_tags),
+                           album_key))
+    tracks.sort()
+    return {"albums": albums, "tracks": tracks}
+
+
+def artist_tracks(artist_key):
+    """Returns every track on an artist's albums, sorted by title.
+
+    Args:
+      artist_key: The artist's key, as a db.Key or a string.
+
+    Returns:
+      A list of dicts with the keys 'song', 'song_key', 'song_tags',
+      'album', 'album_key' and 'label'.
+    """
+    key = _cache_key(artist_key)
+    try:
+        catalog = memcache.get(key)
+    except:
+        catalog = None
+        log.exception('getting from memcache')
+    if catalog is None:
+        catalog = _build(artist_key)
+        try:
+            memcache.set(key, catalog, time=MEMCACHE_TIMEOUT)
+        except:
+            log.exception('setting memcache')
+    albums = catalog["albums"]
+    result = []
+    for title, track_key, tags, album_key in catalog["tracks"]:
+        album_title, label = albums[album_key]
+        result.append({'song': title,
+                       'song_key': track_key,
+                       'song_tags': tags,
+                       'album': album_title,
+                       'album_key': album_key,
+                       'label': label})
+    return result
+
+
+def invalidate_for(entities):
+    """Throws away the catalogs that list some albums or tracks.
+
+    Args:
+      entities: A sequence of entities.  Albums and Tracks invalidate
+        their artist's catalog; anything else is ignored.
+    """
+    artist_keys = set()
+    for ent in entities:
+        kind = ent.kind()
+        if kind == "Track":
+            ent = ent.album
+            kind = ent and ent.kind()
+        if kind == "Album":
+            artist_key = models.Album.album_artist.get_value_for_datastore(
+                ent)
+            if artist_key is not None:
+                artist_keys.add(artist_key)
+    if artist_keys:
+        memcache.delete_multi([_cache_key(k) for k in artist_keys])
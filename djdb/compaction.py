@@ -0,0 +1,248 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Background compaction of the search index.
+
+Every Indexer.save() writes a new SearchMatches object for each term it
+touches, so a term's matches end up spread over more and more objects
+as the catalog is edited, and every search for that term has to read
+all of them.  search.optimize_index() merges them back together, one
+term at a time.
+
+A compaction sweep is started by cron and runs as a chain of task queue
+tasks, recording its progress in an IndexCompaction entity:
+
+  scan: walk the whole index in term order, scoring each term by how
+    many more SearchMatches objects it has than it needs, and keep the
+    MAX_CANDIDATES highest scoring terms.  Emptied SearchMatches older
+    than search_index.TOMBSTONE_SECONDS are deleted along the way.
+  merge: call optimize_index() on the candidates, MERGE_BATCH_SIZE at
+    a time, counting their objects before and after.
+  done: nothing left to do.
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from djdb import models
+from djdb import search
+from djdb import search_index
+
+log = logging.getLogger(__name__)
+
+TASK_URL = "/djdb/task/compact_index/work"
+
+# How many SearchMatches objects to read per scan task.
+SCAN_BATCH_SIZE = 500
+
+# The most terms one sweep will compact.
+MAX_CANDIDATES = 500
+
+# How many terms to compact per merge task.
+MERGE_BATCH_SIZE = 20
+
+# A sweep that has not finished after this long is assumed to have
+# died, and no longer stops a new one from starting.
+STALE_AFTER = datetime.timedelta(hours=12)
+
+
+def start():
+    """Starts a new compaction sweep, unless one is already running.
+
+    Returns:
+      The new IndexCompaction, or None if a sweep is already under way.
+    """
+    latest = models.IndexCompaction.get_latest()
+    if (latest is not None and not latest.is_done
+        and datetime.datetime.now() - latest.started < STALE_AFTER):
+        log.info("Index compaction %d is still running",
+                 latest.key().id())
+        return None
+    run = models.IndexCompaction()
+    AutoRetry(run).put()
+    log.info("Starting index compaction %d", run.key().id())
+    _enqueue(run)
+    return run
+
+
+def _enqueue(run):
+    # Naming each task after the work done so far means that a retried
+    # task cannot fork the chain into two.
+    name = "compact-index-%d-%s-%d-%d" % (run.key().id(), run.phase,
+                                          run.num_rows_scanned,
+                                          run.num_terms_compacted)
+    try:
+        taskqueue.add(url=TASK_URL, name=name,
+                      params={"run": run.key().id()})
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        log.info("Compaction task %s already enqueued", name)
+
+
+def fragmentation(rows):
+    """Scores how badly a term's SearchMatches objects need compacting.
+
+    Args:
+      rows: All of the SearchMatches objects for a single term.
+
+    Returns:
+      The number of objects beyond what optimize_index() would leave
+      behind, plus the number of objects holding more than
+      search.MAX_MATCHES_PER_SHARD matches.
+    """
+    segmented = {}
+    for sm in rows:
+        if not sm.matches:
+            # Emptied objects are deleted by the scan instead.
+            continue
+        segmented.setdefault(
+            (sm.generation, sm.entity_kind, sm.field), []).append(sm)
+    score = 0
+    for subset in segmented.itervalues():
+        num_matches = sum(len(sm.matches) for sm in subset)
+        num_shards = max(
+            1, -(-num_matches // search.MAX_MATCHES_PER_SHARD))
+        score += max(0, len(subset) - num_shards)
+        score += sum(1 for sm in subset
+                     if len(sm.matches) > search.MAX_MATCHES_PER_SHARD)
+    return score
+
+
+def _add_candidate(run, term, score):
+    candidates = zip(run.candidate_scores, run.candidate_terms)
+    candidates.append((score, term))
+    candidates.sort(reverse=True)
+    del candidates[MAX_CANDIDATES:]
+    run.candidate_scores = [s for s, _ in candidates]
+    run.candidate_terms = [t for _, t in candidates]
+
+
+def _scan_batch(run):
+    """Scores the terms in the next batch of SearchMatches objects.
+
+    Returns:
+      True if the whole index has been scanned.
+    """
+    query = models.SearchMatches.all().order("term")
+    if run.last_term is not None:
+        query.filter("term >", run.last_term)
+    batch = AutoRetry(query).fetch(SCAN_BATCH_SIZE)
+    finished = len(batch) < SCAN_BATCH_SIZE
+    reap_before = datetime.datetime.now() - datetime.timedelta(
+        seconds=search_index.TOMBSTONE_SECONDS)
+    reaped = [sm for sm in batch
+              if not sm.matches and sm.timestamp < reap_before]
+    if reaped:
+        AutoRetry(db).delete(reaped)
+        run.num_rows_reaped += len(reaped)
+    by_term = {}
+    for sm in batch:
+        by_term.setdefault(sm.term, []).append(sm)
+    if not finished and len(by_term) > 1:
+        # The batch probably stopped partway through the last term's
+        # objects; leave that term for the next batch.
+        del by_term[batch[-1].term]
+    for term, rows in by_term.iteritems():
+        if len(by_term) == 1 and not finished:
+            # A single term filled the whole batch, which is as
+            # fragmented as anything we could find.
+            score = len(rows)
+        else:
+            score = fragmentation(rows)
+        if score > 0:
+            _add_candidate(run, term, score)
+        run.num_rows_scanned += len(rows)
+    run.num_terms_scanned += len(by_term)
+    if by_term:
+        run.last_term = max(by_term)
+    return finished
+
+
+def _merge_batch(run):
+    """Compacts the next batch of candidate terms.
+
+    Returns:
+      True if every candidate has been compacted.
+    """
+    terms = run.candidate_terms[:MERGE_BATCH_SIZE]
+    for term in terms:
+        query = db.Query(models.SearchMatches, keys_only=True)
+        query.filter("term =", term)
+        rows_before = AutoRetry(query).count()
+        num_deleted = search.optimize_index(term)
+        run.num_terms_compacted += 1
+        run.rows_before += rows_before
+        run.rows_after += rows_before - num_deleted
+    del run.candidate_terms[:len(terms)]
+    del run.candidate_scores[:len(terms)]
+    return not run.candidate_terms
+
+
+def do_work(run_id):
+    """Performs one step of a compaction sweep.
+
+    Args:
+      run_id: The numeric ID of the IndexCompaction.
+
+    Returns:
+      The updated IndexCompaction, or None if there is nothing to do.
+    """
+    run = AutoRetry(models.IndexCompaction).get_by_id(run_id)
+    if run is None or run.is_done:
+        return None
+    if run.phase == "scan":
+        if _scan_batch(run):
+            run.phase = "merge" if run.candidate_terms else "done"
+    elif _merge_batch(run):
+        run.phase = "done"
+    if run.is_done:
+        run.finished = datetime.datetime.now()
+        log.info("Index compaction %d finished: %d terms compacted, "
+                 "%d SearchMatches objects reduced to %d "
+                 "(%.2f to %.2f reads per term)",
+                 run.key().id(), run.num_terms_compacted, run.rows_before,
+                 run.rows_after, run.read_amplification_before,
+                 run.read_amplification_after)
+    AutoRetry(run).put()
+    if not run.is_done:
+        _enqueue(run)
+    return run
+
+
+def status():
+    """Returns a dict describing the latest compaction sweep."""
+    run = models.IndexCompaction.get_latest()
+    if run is None:
+        return {"phase": None}
+    return {
+        "phase": run.phase,
+        "num_rows_scanned": run.num_rows_scanned,
+        "num_terms_scanned": run.num_terms_scanned,
+        "num_rows_reaped": run.num_rows_reaped,
+        "num_candidates": len(run.candidate_terms),
+        "num_terms_compacted": run.num_terms_compacted,
+        "rows_before": run.rows_before,
+        "rows_after": run.rows_after,
+        "read_amplification_before": run.read_amplification_before,
+        "read_amplification_after": run.read_amplification_after,
+        "started": str(run.started),
+        "finished": str(run.finished),
+    }
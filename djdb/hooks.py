@@ -19,7 +19,13 @@
 
 from django import http
 from google.appengine.api import users
+
+from common.utilities import as_json, cronjob
+from djdb import compaction
+from djdb import reindex
 from djdb import search
+from djdb import search_cache
+from djdb import search_index
 
 
 def optimize_index(request):
@@ -34,5 +40,102 @@ def optimize_index(request):
     if term:
         search.optimize_index(term)
     return http.HttpResponse("ok")
-    
-    
+
+
+def index_snapshot_stats(request):
+    """Reports the size and build time of this instance's index snapshot."""
+    if not users.is_current_user_admin():
+        return http.HttpResponse("no", status=403)
+    return _index_snapshot_stats(request)
+
+
+@as_json
+def _index_snapshot_stats(request):
+    snapshot = search_index.get_snapshot(*search.get_generations()[0])
+    if snapshot is None:
+        return {"enabled": search_index.is_enabled(), "ready": False}
+    stats = snapshot.stats()
+    stats["enabled"] = True
+    stats["ready"] = True
+    stats["high_water_mark"] = str(stats["high_water_mark"])
+    return stats
+
+
+def search_cache_stats(request):
+    """Reports hit and miss counts for the search result cache."""
+    if not users.is_current_user_admin():
+        return http.HttpResponse("no", status=403)
+    return _search_cache_stats(request)
+
+
+@as_json
+def _search_cache_stats(request):
+    stats = search_cache.stats()
+    stats["enabled"] = search_cache.is_enabled()
+    return stats
+
+
+def _is_admin_or_task(request):
+    # App Engine strips this header from requests that do not come
+    # from the task queue.
+    return (users.is_current_user_admin()
+            or "HTTP_X_APPENGINE_QUEUENAME" in request.META)
+
+
+def start_reindex(request):
+    """Starts rebuilding the whole search index into a new generation."""
+    if not users.is_current_user_admin() or request.method != "POST":
+        return http.HttpResponse("no", status=403)
+    return _start_reindex(request)
+
+
+@as_json
+def _start_reindex(request):
+    reindex.start()
+    return reindex.status()
+
+
+def reindex_work(request):
+    """Task queue handler that performs one step of a reindex."""
+    if not _is_admin_or_task(request):
+        return http.HttpResponse("no", status=403)
+    reindex.do_work()
+    return http.HttpResponse("ok")
+
+
+def reindex_status(request):
+    """Reports the progress and throughput of the latest reindex."""
+    if not users.is_current_user_admin():
+        return http.HttpResponse("no", status=403)
+    return _reindex_status(request)
+
+
+@as_json
+def _reindex_status(request):
+    return reindex.status()
+
+
+@cronjob
+def start_index_compaction(request):
+    """Cron handler that starts a compaction sweep of the search index."""
+    compaction.start()
+
+
+def index_compaction_work(request):
+    """Task queue handler that performs one step of a compaction sweep."""
+    if not _is_admin_or_task(request) or request.method != "POST":
+        return http.HttpResponse("no", status=403)
+    compaction.do_work(int(request.POST["run"]))
+    return http.HttpResponse("ok")
+
+
+def index_compaction_status(request):
+    """Reports what the latest compaction sweep found and removed."""
+    if not users.is_current_user_admin():
+        return http.HttpResponse("no", status=403)
+    return _index_compaction_status(request)
+
+
+@as_json
+def _index_compaction_status(request):
+    return compaction.status()
@@ -654,6 +654,96 @@ class Track(db.Model):
         """Returns True if the [Recommended] tag is set on this track."""
         return self.has_tag(RECOMMENDED_TAG)
 
+
+class CompilationTrackLookup(db.Model):
+    """Finds the albums a track by a given artist appears on.
+
+    Only tracks with their own track_artist, which are the tracks on
+    compilations, are listed.  The key name is make_key_name() of the
+    track's title and artist name.  search.Indexer adds tracks as it
+    indexes them.
+    """
+    album_keys = db.ListProperty(db.Key)
+
+    @classmethod
+    def make_key_name(cls, track_title, artist_name):
+        normalized = u"\t".join(u" ".join(text.lower().split())
+                                 for text in (track_title, artist_name))
+        # Titles can be longer than a key name is allowed to be.
+        return hashlib.md5(normalized.encode("utf8")).hexdigest()
+
+    @classmethod
+    def add_tracks(cls, tracks, removed_tracks=()):
+        """Records which albums some tracks are on.
+
+        Args:
+          tracks: A sequence of (track title, artist name, album key)
+            tuples.
+          removed_tracks: A sequence of tuples like those in tracks,
+            for tracks that no longer have that title or artist name.
+            These are removed before tracks are added.
+        """
+        wanted = {}
+        for title, artist_name, album_key in tracks:
+            key_name = cls.make_key_name(title, artist_name)
+            wanted.setdefault(key_name, set()).add(album_key)
+        unwanted = {}
+        for title, artist_name, album_key in removed_tracks:
+            key_name = cls.make_key_name(title, artist_name)
+            unwanted.setdefault(key_name, set()).add(album_key)
+        key_names = list(set(wanted).union(unwanted))
+        changed = []
+        emptied = []
+        for key_name, lookup in zip(key_names,
+                                    AutoRetry(cls).get_by_key_name(key_names)):
+            album_keys = set()
+            if lookup is not None:
+                album_keys.update(lookup.album_keys)
+            new_album_keys = album_keys.difference(
+                unwanted.get(key_name, ())).union(wanted.get(key_name, ()))
+            if new_album_keys == album_keys:
+                continue
+            if not new_album_keys:
+                emptied.append(lookup)
+                continue
+            if lookup is None:
+                lookup = cls(key_name=key_name)
+            lookup.album_keys = sorted(new_album_keys)
+            changed.append(lookup)
+        AutoRetry(db).put(changed)
+        if emptied:
+            AutoRetry(db).delete(emptied)
+
+    @classmethod
+    def is_complete(cls):
+        """Returns True if every compilation track has been listed.
+
+        Tracks indexed before this lookup existed are only listed by
+        a rebuild of the search index that has got past the tracks.
+        """
+        state = ReindexState.get_current()
+        return bool(state and state.lists_compilation_tracks
+                    and state.phase in ("cleanup", "done"))
+
+    @classmethod
+    def find_albums(cls, track_title, artist_name):
+        """Returns the albums with a track by an artist on them.
+
+        Args:
+          track_title: The title of the track.
+          artist_name: The name of the track's artist.
+
+        Returns:
+          A list of Album instances, or None if no track with that
+          title and artist has been recorded.
+        """
+        lookup = AutoRetry(cls).get_by_key_name(
+            cls.make_key_name(track_title, artist_name))
+        if lookup is None:
+            return None
+        return [album for album in AutoRetry(db).get(lookup.album_keys)
+                if album is not None]
+
         
 ############################################################################
 
@@ -686,6 +776,113 @@ class SearchMatches(db.Model):
     matches = db.ListProperty(db.Key)
 
 
+class ReindexState(db.Model):
+    """Tracks a rebuild of the search index into a new generation.
+
+    There is only ever one of these, with key name KEY_NAME.  While a
+    rebuild is in progress, searches read from both the old and new
+    generations and the indexer writes to the new one.
+    """
+    KEY_NAME = "current"
+
+    # The generation being replaced, and the one being built.
+    old_generation = db.IntegerProperty(required=True)
+    new_generation = db.IntegerProperty(required=True)
+
+    # Which kind of entity we are currently indexing: "Artist",
+    # "Album" or "Track".  After that comes "cleanup", while the old
+    # generation is deleted, and finally "done".
+    phase = db.StringProperty(required=True)
+
+    # A query cursor marking our position within the current phase.
+    cursor = db.TextProperty()
+
+    # How many entities have been indexed, and how many old
+    # SearchMatches have been deleted.
+    num_indexed = db.IntegerProperty(default=0)
+    num_deleted = db.IntegerProperty(default=0)
+
+    # Time actually spent doing work, not waiting in the task queue.
+    work_seconds = db.FloatProperty(default=0.0)
+
+    # Whether this rebuild fills in CompilationTrackLookup.  Rebuilds
+    # from before it existed did not.
+    lists_compilation_tracks = db.BooleanProperty(default=False)
+
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty()
+
+    @classmethod
+    def get_current(cls):
+        return AutoRetry(cls).get_by_key_name(cls.KEY_NAME)
+
+    @property
+    def is_done(self):
+        return self.phase == "done"
+
+    @property
+    def entities_per_second(self):
+        if not self.work_seconds:
+            return 0.0
+        return self.num_indexed / self.work_seconds
+
+
+class IndexCompaction(db.Model):
+    """A record of one background compaction sweep of the search index.
+
+    The sweep first scans the whole index, remembering the most
+    fragmented terms in candidate_terms, and then compacts them.
+    """
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty()
+
+    # One of "scan", "merge" or "done".
+    phase = db.StringProperty(default="scan")
+    # The scan has looked at every term up to and including this one.
+    last_term = db.StringProperty()
+    # The terms waiting to be compacted, most fragmented first, and
+    # how many excess SearchMatches objects each of them has.
+    candidate_terms = db.StringListProperty()
+    candidate_scores = db.ListProperty(int)
+
+    # How much of the index we looked at.
+    num_rows_scanned = db.IntegerProperty(default=0)
+    num_terms_scanned = db.IntegerProperty(default=0)
+    # Emptied SearchMatches (see search.delete_matches) that the scan
+    # found old enough to delete.
+    num_rows_reaped = db.IntegerProperty(default=0)
+
+    # The terms we compacted, and how many SearchMatches objects they
+    # were spread across before and after.  Searching for a term reads
+    # every one of its objects, so rows_before - rows_after is the
+    # number of reads saved each time all of these terms are searched.
+    num_terms_compacted = db.IntegerProperty(default=0)
+    rows_before = db.IntegerProperty(default=0)
+    rows_after = db.IntegerProperty(default=0)
+
+    @classmethod
+    def get_latest(cls):
+        return AutoRetry(cls.all().order("-started")).get()
+
+    @property
+    def is_done(self):
+        return self.phase == "done"
+
+    @property
+    def read_amplification_before(self):
+        """Average SearchMatches reads per compacted term, before."""
+        if not self.num_terms_compacted:
+            return 0.0
+        return float(self.rows_before) / self.num_terms_compacted
+
+    @property
+    def read_amplification_after(self):
+        """Average SearchMatches reads per compacted term, after."""
+        if not self.num_terms_compacted:
+            return 0.0
+        return float(self.rows_after) / self.num_terms_compacted
+
+
 ############################################################################
 
 
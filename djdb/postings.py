@@ -0,0 +1,181 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Compact posting lists for the in-memory search index.
+
+A posting list is a sorted array of unique integer document ids.
+Nothing in this module talks to App Engine, so it can be exercised
+(and benchmarked) outside of the dev server.
+"""
+
+from array import array
+import bisect
+
+# The array typecode used for all posting lists.
+TYPECODE = "i"
+
+EMPTY = array(TYPECODE)
+
+
+def from_ids(doc_ids):
+    """Builds a posting list from an arbitrary iterable of document ids."""
+    return array(TYPECODE, sorted(set(doc_ids)))
+
+
+def union(postings):
+    """Merges a sequence of posting lists into a single posting list."""
+    postings = [p for p in postings if p]
+    if not postings:
+        return EMPTY
+    if len(postings) == 1:
+        return postings[0]
+    merged = set()
+    for plist in postings:
+        merged.update(plist)
+    return array(TYPECODE, sorted(merged))
+
+
+def size_in_bytes(plist):
+    """Returns the number of bytes used to store a posting list's ids."""
+    return plist.itemsize * len(plist)
+
+
+def contains(plist, doc_id):
+    """Returns True if doc_id appears in a posting list."""
+    i = bisect.bisect_left(plist, doc_id)
+    return i < len(plist) and plist[i] == doc_id
+
+
+def _gallop(plist, doc_id, lo):
+    """Returns the first index at or after lo where plist[i] >= doc_id.
+
+    We probe forward in exponentially growing steps and then binary
+    search the last step, so skipping over long runs of a large list
+    costs O(log(distance)) rather than O(distance).
+    """
+    n = len(plist)
+    bound = 1
+    while lo + bound < n and plist[lo + bound] < doc_id:
+        bound *= 2
+    return bisect.bisect_left(plist, doc_id, lo, min(lo + bound + 1, n))
+
+
+def intersect(a, b):
+    """Returns the ids that appear in both posting lists.
+
+    We walk the shorter list and gallop through the longer one.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    result = array(TYPECODE)
+    lo = 0
+    n = len(b)
+    for doc_id in a:
+        lo = _gallop(b, doc_id, lo)
+        if lo == n:
+            break
+        if b[lo] == doc_id:
+            result.append(doc_id)
+            lo += 1
+    return result
+
+
+def difference(a, b):
+    """Returns the ids in posting list a that do not appear in b."""
+    if not a or not b:
+        return a
+    result = array(TYPECODE)
+    lo = 0
+    n = len(b)
+    for doc_id in a:
+        if lo < n:
+            lo = _gallop(b, doc_id, lo)
+        if lo == n or b[lo] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def estimate_size(clause):
+    """Returns an upper bound on the number of ids matching a clause.
+
+    A clause is a sequence of (field, posting list) pairs; a document
+    matches the clause if it appears in any of the posting lists.
+    """
+    return sum(len(plist) for _, plist in clause)
+
+
+def _restrict(candidates, clause):
+    """Returns the candidates that match at least one list in a clause."""
+    plists = [plist for _, plist in clause if plist]
+    if not plists:
+        return EMPTY
+    if len(plists) == 1:
+        return intersect(candidates, plists[0])
+    if len(candidates) * len(plists) < estimate_size(clause):
+        # Probing each candidate is cheaper than merging the lists.
+        return array(TYPECODE, [doc_id for doc_id in candidates
+                                if any(contains(p, doc_id) for p in plists)])
+    return intersect(candidates, union(plists))
+
+
+def execute(required, forbidden):
+    """Evaluates a parsed query against in-memory posting lists.
+
+    Args:
+      required: A sequence of clauses that every result must match.
+      forbidden: A sequence of clauses that no result may match.
+
+      Each clause is a sequence of (field, posting list) pairs, as
+      described in estimate_size().
+
+    Returns:
+      A dict mapping document ids to the set of fields in which the
+      document matched a required clause.
+
+    Required clauses are intersected in order of increasing estimated
+    size, so a rare term empties the result before a common one is
+    ever merged.  Forbidden clauses are subtracted at the very end,
+    once the candidate set is as small as it will get.
+    """
+    if not required:
+        return {}
+    candidates = None
+    for clause in sorted(required, key=estimate_size):
+        if candidates is None:
+            candidates = union([plist for _, plist in clause])
+        else:
+            candidates = _restrict(candidates, clause)
+        if not candidates:
+            return {}
+    for clause in forbidden:
+        for _, plist in clause:
+            candidates = difference(candidates, plist)
+        if not candidates:
+            return {}
+    result = dict((doc_id, set()) for doc_id in candidates)
+    for clause in required:
+        for field, plist in clause:
+            if len(plist) <= len(candidates):
+                for doc_id in plist:
+                    fields = result.get(doc_id)
+                    if fields is not None:
+                        fields.add(field)
+            else:
+                for doc_id in candidates:
+                    if contains(plist, doc_id):
+                        result[doc_id].add(field)
+    return result
@@ -0,0 +1,110 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""A prefix dictionary over the terms in the search index.
+
+The terms are kept in one sorted list, so every prefix corresponds to
+a contiguous slice of it.  Alongside the list we keep, for each
+(entity kind, field), a running total of posting list lengths.  The
+number of postings under a prefix is then the difference of two
+running totals, and we never have to look at a posting list to find
+it.
+
+This gives us what a trie with per-node counts would, in two flat
+arrays rather than a tree of small objects.
+
+Like postings.py, nothing here talks to App Engine.
+"""
+
+from array import array
+import bisect
+
+# Sorts after any character we put into the index.
+_HIGHEST_CHAR = u"\uffff"
+
+
+class PrefixDictionary(object):
+    """An immutable sorted term table with cumulative posting counts."""
+
+    def __init__(self, terms, counts):
+        """Constructor.
+
+        Args:
+          terms: A sorted list of unique terms.
+          counts: A function mapping a term to a dict of
+            {(entity kind, field): number of postings}.
+        """
+        self.terms = terms
+        self._cumulative = {}
+        for i, term in enumerate(terms):
+            for kind_field, n in counts(term).iteritems():
+                cumulative = self._cumulative.get(kind_field)
+                if cumulative is None:
+                    cumulative = self._cumulative[kind_field] = array(
+                        "l", [0] * (len(terms) + 1))
+                cumulative[i + 1] = n
+        # Turn per-term counts into running totals.
+        for cumulative in self._cumulative.itervalues():
+            total = 0
+            for i in xrange(len(cumulative)):
+                total += cumulative[i]
+                cumulative[i] = total
+
+    def __len__(self):
+        return len(self.terms)
+
+    def span(self, low, high=None):
+        """Returns (start, end) indices of the terms in [low, high).
+
+        If high is None, the span covers all terms starting with low.
+        """
+        if high is None:
+            high = low + _HIGHEST_CHAR
+        return (bisect.bisect_left(self.terms, low),
+                bisect.bisect_left(self.terms, high))
+
+    def expand(self, prefix, max_terms=None):
+        """Returns the terms starting with prefix, in sorted order.
+
+        Args:
+          prefix: A term prefix.
+          max_terms: If given, at most this many terms are returned.
+        """
+        start, end = self.span(prefix)
+        if max_terms is not None:
+            end = min(end, start + max_terms)
+        return self.terms[start:end]
+
+    def count(self, prefix, entity_kind=None, field=None):
+        """Returns the number of postings under a prefix.
+
+        This is an upper bound on the number of matching documents: a
+        document containing several terms with the prefix is counted
+        once for each of them.  It is zero if and only if nothing
+        matches.
+        """
+        start, end = self.span(prefix)
+        if start == end:
+            return 0
+        total = 0
+        for (kind, fld), cumulative in self._cumulative.iteritems():
+            if entity_kind and kind != entity_kind:
+                continue
+            if field and fld != field:
+                continue
+            total += cumulative[end] - cumulative[start]
+        return total
@@ -0,0 +1,199 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Rebuild the whole search index into a new generation.
+
+The rebuild runs as a chain of task queue tasks.  Each task indexes one
+batch of entities, records its position in the ReindexState, and then
+enqueues the next task, so the work survives instance restarts and
+task retries.  The phases are:
+
+  Artist, Album, Track: index every entity of that kind into the new
+    generation.  Searches meanwhile read both generations.
+  cleanup: searches read only the new generation; delete the old one.
+  done: nothing left to do.
+"""
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from common.prefetch import prefetch_references
+from djdb import models
+from djdb import search
+
+log = logging.getLogger(__name__)
+
+TASK_URL = "/djdb/task/reindex"
+
+PHASES = ("Artist", "Album", "Track", "cleanup", "done")
+
+# How many entities to index per task.
+BATCH_SIZES = {
+    "Artist": 500,
+    "Album": 200,
+    "Track": 200,
+}
+
+# How many old SearchMatches to delete per task.
+DELETE_BATCH_SIZE = 500
+
+_MODELS = {
+    "Artist": models.Artist,
+    "Album": models.Album,
+    "Track": models.Track,
+}
+
+
+class ReindexInProgress(Exception):
+    pass
+
+
+def start():
+    """Starts rebuilding the search index.
+
+    Returns:
+      The new ReindexState.
+
+    Raises:
+      ReindexInProgress: if a rebuild is already under way.
+    """
+    state = models.ReindexState.get_current()
+    if state is None:
+        old_generation = search._GENERATION
+    elif state.is_done:
+        old_generation = state.new_generation
+    else:
+        raise ReindexInProgress(
+            "Already rebuilding generation %d" % state.new_generation)
+    state = models.ReindexState(key_name=models.ReindexState.KEY_NAME,
+                                old_generation=old_generation,
+                                new_generation=old_generation + 1,
+                                phase=PHASES[0],
+                                lists_compilation_tracks=True)
+    AutoRetry(state).put()
+    search.reset_generations()
+    log.info("Rebuilding search index from generation %d to %d",
+             state.old_generation, state.new_generation)
+    # Other instances may keep writing to the old generation until
+    # their cached generations expire, so give them time to notice.
+    _enqueue(state, countdown=2 * search.GENERATION_CACHE_SECONDS)
+    return state
+
+
+def _enqueue(state, countdown=0):
+    # Naming each task after the work done so far means that a retried
+    # task cannot fork the chain into two.
+    name = "reindex-%d-%s-%d" % (state.new_generation, state.phase,
+                                 state.num_indexed + state.num_deleted)
+    try:
+        taskqueue.add(url=TASK_URL, name=name, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        log.info("Reindex task %s already enqueued", name)
+
+
+def _index_batch(state):
+    """Indexes the next batch of the current phase's entities.
+
+    Returns:
+      True if there are no more entities of this kind.
+    """
+    model = _MODELS[state.phase]
+    batch_size = BATCH_SIZES[state.phase]
+    query = model.all()
+    if state.cursor:
+        query.with_cursor(state.cursor)
+    batch = AutoRetry(query).fetch(batch_size)
+    if state.phase == "Album":
+        prefetch_references(batch, ["album_artist"])
+    elif state.phase == "Track":
+        prefetch_references(batch, ["album", "track_artist"])
+        prefetch_references([trk.album for trk in batch], ["album_artist"])
+    idx = search.Indexer(generation=state.new_generation)
+    for ent in batch:
+        idx.add_existing(ent)
+    idx.save()
+    state.num_indexed += len(batch)
+    state.cursor = query.cursor()
+    return len(batch) < batch_size
+
+
+def _delete_batch(state):
+    """Deletes a batch of SearchMatches from the old generation.
+
+    Returns:
+      True if the old generation is gone.
+    """
+    query = db.Query(models.SearchMatches, keys_only=True)
+    query.filter("generation =", state.old_generation)
+    keys = AutoRetry(query).fetch(DELETE_BATCH_SIZE)
+    AutoRetry(db).delete(keys)
+    state.num_deleted += len(keys)
+    return len(keys) < DELETE_BATCH_SIZE
+
+
+def do_work():
+    """Performs one step of the rebuild.
+
+    Returns:
+      The updated ReindexState, or None if no rebuild is under way.
+    """
+    state = models.ReindexState.get_current()
+    if state is None or state.is_done:
+        return None
+    start_time = time.time()
+    if state.phase == "cleanup":
+        phase_finished = _delete_batch(state)
+    else:
+        phase_finished = _index_batch(state)
+    state.work_seconds += time.time() - start_time
+    if phase_finished:
+        state.phase = PHASES[PHASES.index(state.phase) + 1]
+        state.cursor = None
+        if state.is_done:
+            state.finished = datetime.datetime.now()
+    AutoRetry(state).put()
+    search.reset_generations()
+    log.info("Search index rebuild: phase=%s indexed=%d deleted=%d "
+             "(%.1f entities/s)", state.phase, state.num_indexed,
+             state.num_deleted, state.entities_per_second)
+    if not state.is_done:
+        _enqueue(state)
+    return state
+
+
+def status():
+    """Returns a dict describing the progress of the latest rebuild."""
+    state = models.ReindexState.get_current()
+    if state is None:
+        return {"phase": None, "generations": search.get_generations()[0]}
+    return {
+        "phase": state.phase,
+        "old_generation": state.old_generation,
+        "new_generation": state.new_generation,
+        "num_indexed": state.num_indexed,
+        "num_deleted": state.num_deleted,
+        "work_seconds": state.work_seconds,
+        "entities_per_second": state.entities_per_second,
+        "started": str(state.started),
+        "finished": str(state.finished),
+    }
@@ -22,14 +22,71 @@ import re
 import time
 import unicodedata
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 
+from djdb import catalog
 from djdb import models
+from djdb import postings
+from djdb import search_cache
+from djdb import search_index
 from common.autoretry import AutoRetry
+from common.prefetch import prefetch_references
 
-# All search data used by this code is marked with this generation.
+# All search data used by this code is marked with this generation,
+# until the index is rebuilt into a new one (see djdb/reindex.py).
 _GENERATION = 1
 
+# How long (in seconds) each instance trusts its copy of the
+# ReindexState before looking at the datastore again.
+GENERATION_CACHE_SECONDS = 30
+
+# (generations to read, generation to write, expiry time)
+_generations = None
+
+
+def get_generations():
+    """Returns the generations searches should read from and write to.
+
+    Returns:
+      A (read_generations, write_generation) pair, where
+      read_generations is a tuple of integers.  While the index is
+      being rebuilt we read from both the old and new generations, and
+      write to the new one.
+    """
+    global _generations
+    cached = _generations
+    now = time.time()
+    if cached is None or cached[2] < now:
+        state = models.ReindexState.get_current()
+        if state is None:
+            read, write = (_GENERATION,), _GENERATION
+        elif state.phase in ("cleanup", "done"):
+            read, write = (state.new_generation,), state.new_generation
+        else:
+            read = (state.old_generation, state.new_generation)
+            write = state.new_generation
+        cached = _generations = (read, write, now + GENERATION_CACHE_SECONDS)
+    return cached[0], cached[1]
+
+
+def reset_generations():
+    """Forgets this instance's cached generations."""
+    global _generations
+    _generations = None
+
+
+def _get_snapshot():
+    return search_index.get_snapshot(*get_generations()[0])
+
+
+def build_snapshot():
+    """Builds this instance's in-memory index snapshot, if enabled.
+
+    See search_index.build_snapshot.
+    """
+    return search_index.build_snapshot(*get_generations()[0])
+
 
 ###
 ### Text Normalization
@@ -51,8 +108,13 @@ def _is_stop_word(term):
     return len(term) <= 1 or term in _STOP_WORDS
 
 
+# Every prefix of every stop word, including the empty string.
+_STOP_WORD_PREFIXES = frozenset(sw[:i] for sw in _STOP_WORDS
+                                for i in xrange(len(sw) + 1))
+
+
 def _is_stop_word_prefix(prefix):
-    return any(sw.startswith(prefix) for sw in _STOP_WORDS)
+    return prefix in _STOP_WORD_PREFIXES
 
 
 def _scrub_char(c):
@@ -100,19 +162,118 @@ def strip_tags(text):
     return re.sub(r"\[[^\]]+\]", "", text)
 
 
+def ngram_text(text):
+    """Normalizes text for substring matching.
+
+    This is scrub() with runs of whitespace collapsed, so that
+    "Spider And I" and "spider  and i!" both become "spider and i".
+    """
+    return u" ".join(scrub(text).split())
+
+
+# Track titles are also indexed as overlapping n-grams of this length,
+# under NGRAM_FIELD, to support substring search.
+NGRAM_SIZE = 3
+NGRAM_FIELD = "title_ngram"
+
+# Starts every n-gram term.  scrub() never produces this character, so
+# n-grams can never be confused with (or prefix-match) ordinary terms,
+# and are never mistaken for stop words.
+_NGRAM_MARKER = u"~"
+
+
+def _ngrams(text):
+    """Returns the set of n-gram terms for a piece of text."""
+    text = ngram_text(text)
+    return set(_NGRAM_MARKER + text[i:i + NGRAM_SIZE]
+               for i in xrange(len(text) - NGRAM_SIZE + 1))
+
+
 ###
 ### Indexing
 ###
 
+# The most entities the datastore accepts in a single put.
+_MAX_PUT_SIZE = 500
+
+
+def _indexed_text(entity, album=None):
+    """Returns the text the Indexer indexes for an entity.
+
+    Args:
+      entity: An Artist, Album or Track instance.
+      album: For a Track, its Album, if the caller already has it.
+
+    Returns:
+      A list of (field, text) pairs.
+    """
+    kind = entity.kind()
+    if kind == "Artist":
+        return [("name", entity.name)]
+    if kind == "Album":
+        fields = [("title", strip_tags(entity.title)),
+                  ("artist", entity.artist_name)]
+        if entity.label is not None:
+            fields.append(("label", entity.label))
+        if entity.year is not None:
+            fields.append(("year", unicode(entity.year)))
+        return fields
+    if kind == "Track":
+        album = album or entity.album
+        return [("title", strip_tags(entity.title)),
+                ("album", strip_tags(album.title)),
+                ("artist", entity.artist_name)]
+    raise ValueError("Cannot index entity of kind %r" % kind)
+
+
+def _edited_text(entity):
+    """Returns the text indexed for an entity when it is edited.
+
+    Tags, pronunciations and track artists are not indexed when an
+    entity is created, but by tag_util and the Indexer's update_*()
+    methods when they are set later on.
+
+    Args:
+      entity: An Artist, Album or Track instance.
+
+    Returns:
+      A list of (field, text) pairs.
+    """
+    fields = [("tag", tag)
+              for tag in getattr(entity, "current_tags", None) or ()]
+    if getattr(entity, "pronunciation", None):
+        fields.append(("pronunciation", entity.pronunciation))
+    if (entity.kind() == "Track"
+        and models.Track.track_artist.get_value_for_datastore(entity)):
+        try:
+            fields.append(("track_artist", unicode(entity.track_artist)))
+        except db.ReferencePropertyResolveError:
+            logging.warning("Track %s has a missing track artist",
+                            entity.key())
+    return fields
+
+
 class Indexer(object):
     """Builds a searchable index of text associated with datastore entities."""
 
-    def __init__(self, transaction=None):
+    def __init__(self, transaction=None, generation=None):
+        # The generation to write SearchMatches into.  If None, we use
+        # the current write generation.
+        self._generation = generation
         # A cache of our pending, to-be-written SearchMatches objects.
         self._matches = {}
+        # Maps keys to the (field, term) pairs they are to be removed
+        # from when we save.
+        self._removals = {}
         # Additional objects to save at the same time as the
         # SearchMatches.
         self._txn_objects_to_save = []
+        # (title, artist name, album key) for each compilation track
+        # to add to the CompilationTrackLookup when we save.
+        self._compilation_tracks = []
+        # The same, for tracks whose old title or artist should be
+        # removed from the CompilationTrackLookup.
+        self._old_compilation_tracks = []
         if transaction:
             self._transaction = transaction
         else:
@@ -131,29 +292,71 @@ class Indexer(object):
         """
         return self._transaction
 
-    def _get_matches(self, entity_kind, field, term, key=None):
+    @property
+    def generation(self):
+        """The generation our SearchMatches objects are written into."""
+        if self._generation is None:
+            self._generation = get_generations()[1]
+        return self._generation
+
+    def _get_matches(self, entity_kind, field, term):
         """Returns a cached SearchMatches object for a given kind and term."""
         _key = (entity_kind, field, term)
         sm = self._matches.get(_key)
         if sm is None:
-            if key:
-                q = models.SearchMatches.all()
-                q.filter("entity_kind =", entity_kind)
-                q.filter("field =", field)
-                q.filter("term =", term)
-                q.filter("matches =", key)
-                sms = q.fetch(1)
-                if sms :
-                    sm = sms[0]
-            if sm is None:
-                sm = models.SearchMatches(generation=_GENERATION,
-                                          entity_kind=entity_kind,
-                                          field=field,
-                                          term=term,
-                                          parent=self.transaction)
+            sm = models.SearchMatches(generation=self.generation,
+                                      entity_kind=entity_kind,
+                                      field=field,
+                                      term=term,
+                                      parent=self.transaction)
             self._matches[_key] = sm
         return sm
-        
+
+    def _remove_terms(self, key, field, terms):
+        """Prepare to remove a key from the index for some terms.
+
+        The key is taken out of our own pending SearchMatches right
+        away.  Removing it from those already in the datastore waits
+        until save(), so that all of them can be found at once.
+        """
+        for term in terms:
+            sm = self._matches.get((key.kind(), field, term))
+            if sm is not None:
+                while key in sm.matches:
+                    sm.matches.remove(key)
+            self._removals.setdefault(key, set()).add((field, term))
+
+    def _resolve_removals(self):
+        """Applies our pending removals to SearchMatches in the datastore.
+
+        A single "matches =" query per key finds every SearchMatches
+        that the key appears in, whatever its field and term, so this
+        costs one query per entity rather than one per term.  The
+        queries for different keys run concurrently.
+
+        Returns:
+          A (to_save, to_delete) pair of lists of SearchMatches.
+        """
+        keys = self._removals.keys()
+        in_flight = []
+        for key in keys:
+            query = models.SearchMatches.all().filter("matches =", key)
+            in_flight.append(AutoRetry(query).run(limit=_MAX_MATCHES,
+                                                  batch_size=_MAX_MATCHES))
+        changed = {}
+        for key, search_matches in zip(keys, in_flight):
+            to_remove = self._removals[key]
+            for sm in search_matches:
+                if (sm.field, sm.term) not in to_remove:
+                    continue
+                # The same SearchMatches may come back for several keys.
+                sm = changed.setdefault(sm.key(), sm)
+                while key in sm.matches:
+                    sm.matches.remove(key)
+        to_save = [sm for sm in changed.itervalues() if sm.matches]
+        to_delete = [sm for sm in changed.itervalues() if not sm.matches]
+        return to_save, to_delete
+
     def add_key(self, key, field, text):
         """Prepare to index content associated with a datastore key.
 
@@ -162,7 +365,17 @@ class Indexer(object):
           field: A field identifier string.
           text: A unicode string, the content to be indexed.
         """
-        for term in set(explode(text)):
+        self.add_terms(key, field, explode(text))
+
+    def add_terms(self, key, field, terms):
+        """Prepare to index already-normalized terms for a datastore key.
+
+        Args:
+          key: A db.Key instance.
+          field: A field identifier string.
+          terms: A sequence of terms, e.g. from explode().
+        """
+        for term in set(terms):
             sm = self._get_matches(key.kind(), field, term)
             sm.matches.append(key)
 
@@ -173,7 +386,7 @@ class Indexer(object):
         artist is saved when the indexer's save() method is called.
         """
         assert artist.parent_key() == self.transaction
-        self.add_key(artist.key(), "name", artist.name)
+        self._index_entity(artist)
         self._txn_objects_to_save.append(artist)
 
     def add_album(self, album):
@@ -183,12 +396,7 @@ class Indexer(object):
         album is saved when the indexer's save() method is called.
         """
         assert album.parent_key() == self.transaction
-        self.add_key(album.key(), "title", strip_tags(album.title))
-        self.add_key(album.key(), "artist", album.artist_name)
-        if album.label is not None:
-            self.add_key(album.key(), "label", album.label)
-        if album.year is not None:
-            self.add_key(album.key(), "year", unicode(album.year))
+        self._index_entity(album)
         self._txn_objects_to_save.append(album)
             
     def add_track(self, track):
@@ -198,24 +406,60 @@ class Indexer(object):
         track is saved when the indexer's save() method is called.
         """
         assert track.parent_key() == self.transaction
-        self.add_key(track.key(), "title", strip_tags(track.title))
-        self.add_key(track.key(), "album", strip_tags(track.album.title))
-        self.add_key(track.key(), "artist", track.artist_name)
+        self._index_entity(track)
         self._txn_objects_to_save.append(track)
 
+    def add_existing(self, entity, album=None):
+        """Prepare to index an Artist, Album or Track already in the datastore.
+
+        Unlike add_artist() and friends, the entity itself is not saved
+        and need not belong to the indexer's transaction.  Its tags,
+        pronunciation and track artist are indexed as well, since the
+        index is being rebuilt from scratch.
+
+        Args:
+          entity: An Artist, Album or Track instance.
+          album: For a Track, its Album.  Passing this in saves a
+            datastore get when indexing many tracks at once.
+        """
+        self._index_entity(entity, album)
+        for field, text in _edited_text(entity):
+            self.add_key(entity.key(), field, text)
+
+    def _index_entity(self, entity, album=None):
+        for field, text in _indexed_text(entity, album):
+            self.add_key(entity.key(), field, text)
+        if entity.kind() == "Track":
+            self.add_terms(entity.key(), NGRAM_FIELD,
+                           _ngrams(strip_tags(entity.title)))
+            self._note_compilation_track(entity)
+
+    def _update_ngrams(self, track, title):
+        """Replaces the n-grams indexed for a track's title."""
+        self._remove_terms(track.key(), NGRAM_FIELD,
+                           _ngrams(strip_tags(track.title)))
+        self.add_terms(track.key(), NGRAM_FIELD,
+                       _ngrams(strip_tags(title)))
+
+    def _note_compilation_track(self, track, tracks=None):
+        if models.Track.track_artist.get_value_for_datastore(track) is None:
+            return
+        if tracks is None:
+            tracks = self._compilation_tracks
+        tracks.append(
+            (track.title, track.track_artist.name,
+             models.Track.album.get_value_for_datastore(track)))
+
     def remove_key(self, key, field, text):
-        for term in set(explode(text)):
-            sm = self._get_matches(key.kind(), field, term, key)
-            sm.matches.remove(key)
-            if not sm.matches:
-                # Remove empty search index from datastore.
-                AutoRetry(db).delete(sm)
-
-                # Remove cached entry.
-                _key = (key.kind(), field, term)
-                if _key in self._matches:
-                    del self._matches[_key]
-                    
+        """Prepare to remove index content associated with a datastore key.
+
+        Args:
+          key: A db.Key instance.
+          field: A field identifier string.
+          text: A unicode string, the content to be removed.
+        """
+        self._remove_terms(key, field, set(explode(text)))
+
     def update_key(self, key, field, old_text, text):
         """Update index content associated with a datastore key.
         
@@ -226,10 +470,7 @@ class Indexer(object):
           text: A unicode string, the content to be indexed.
         """
         # Remove old terms.
-        for term in set(explode(old_text)):
-            sm = self._get_matches(key.kind(), field, term, key)
-            if key in sm.matches:
-                sm.matches.remove(key)
+        self._remove_terms(key, field, set(explode(old_text)))
             
         # Add new terms.
         if text is not None:
@@ -278,14 +519,26 @@ class Indexer(object):
         track is saved when the indexer's save() method is called.
         """
         assert track.parent_key() == self.transaction
+        if "title" in fields or "track_artist" in fields:
+            self._note_compilation_track(track, self._old_compilation_tracks)
+        if "title" in fields:
+            self._update_ngrams(track, unicode(fields["title"]))
         for field, value in fields.iteritems():
             self.update_key(track.key(), field, unicode(getattr(track, field)), unicode(value))
             setattr(track, field, value)
+        if "title" in fields or "track_artist" in fields:
+            self._note_compilation_track(track)
         self._txn_objects_to_save.append(track)
 
     def save(self, rpc=None):
         """Write all pending index data into the Datastore."""
-        self._txn_objects_to_save.extend(self._matches.itervalues())
+        saved_matches = [sm for sm in self._matches.itervalues()
+                         if sm.matches]
+        deleted_matches = []
+        if self._removals:
+            updated_matches, deleted_matches = self._resolve_removals()
+            saved_matches.extend(updated_matches)
+        self._txn_objects_to_save.extend(saved_matches)
         # All of the objects in self._txn_objects_to_save are part of
         # the same entity group.  This ensures that db.save is an
         # atomic operation --- either all of the objects are
@@ -293,17 +546,70 @@ class Indexer(object):
         kwargs = {}
         if rpc is not None:
             kwargs["rpc"] = rpc
-        AutoRetry(db).save(self._txn_objects_to_save, **kwargs)
+        objects = self._txn_objects_to_save
+        if rpc is None and len(objects) > _MAX_PUT_SIZE:
+            # This is too much to write in one go, which only happens
+            # when reindexing in bulk.  The save is no longer atomic,
+            # but a failed batch is simply redone.
+            for i in xrange(0, len(objects), _MAX_PUT_SIZE):
+                AutoRetry(db).save(objects[i:i + _MAX_PUT_SIZE])
+        else:
+            AutoRetry(db).save(objects, **kwargs)
+        search_index.note_saved(saved_matches)
+        # Deleting only once everything else is written means that a
+        # failed save never loses index data.
+        if deleted_matches:
+            delete_matches(deleted_matches)
+        search_cache.invalidate()
+        catalog.invalidate_for(
+            [obj for obj in self._txn_objects_to_save
+             if obj.kind() in ("Album", "Track")])
+        if self._compilation_tracks or self._old_compilation_tracks:
+            models.CompilationTrackLookup.add_tracks(
+                self._compilation_tracks, self._old_compilation_tracks)
         self._matches = {}
+        self._removals = {}
+        self._compilation_tracks = []
+        self._old_compilation_tracks = []
         self._txn_objects_to_save
 
 
+# The most keys optimize_index() puts into one SearchMatches object.
+# Bigger posting lists are split into shards of this size, which keeps
+# each object well below the datastore's entity size and index entry
+# limits.
+MAX_MATCHES_PER_SHARD = 1000
+
+
+def delete_matches(search_matches):
+    """Deletes SearchMatches objects that are no longer needed.
+
+    While searches are served from snapshots, the objects are emptied
+    instead.  Other instances only notice changed SearchMatches when
+    they refresh, so an emptied object takes the matches out of their
+    snapshots too.  Compaction deletes it once every snapshot has been
+    rebuilt (see search_index.TOMBSTONE_SECONDS).
+
+    Args:
+      search_matches: A list of SearchMatches.
+    """
+    if search_index.is_enabled():
+        for sm in search_matches:
+            del sm.matches[:]
+        AutoRetry(db).save(search_matches)
+        search_index.note_saved(search_matches)
+    else:
+        AutoRetry(db).delete(search_matches)
+        search_index.note_deleted(search_matches)
+
+
 def optimize_index(term):
     """Optimize our index for a specific term.
 
     Locates all SearchMatches objects associated with the given term
     and merges them together so that there is only one SearchMatches
-    per entity kind and field.
+    per entity kind and field, or as few as possible if there are more
+    than MAX_MATCHES_PER_SHARD matches.
 
     Args:
       text: A normalized search term.
@@ -315,13 +621,16 @@ def optimize_index(term):
     query = models.SearchMatches.all().filter("term =", term)
 
     # First we iterate over all of the SearchMatches associated with
-    # particular term and segment them by entity kind and field.
+    # particular term and segment them by generation, entity kind and
+    # field.
+    read_generations = get_generations()[0]
     segmented = {}
     for sm in AutoRetry(query).fetch(999):
-        # Skip anything outside the current generation.
-        if sm.generation != _GENERATION:
+        # Skip anything outside the current generations, and objects
+        # that were emptied rather than deleted.
+        if sm.generation not in read_generations or not sm.matches:
             continue
-        key = (sm.entity_kind, sm.field)
+        key = (sm.generation, sm.entity_kind, sm.field)
         subset = segmented.get(key)
         if not subset:
             subset = segmented[key] = []
@@ -334,31 +643,38 @@ def optimize_index(term):
     # are added to the list.
     if _is_stop_word(term):
         for subset in segmented.itervalues():
-            db.delete(subset)
+            delete_matches(subset)
             num_deleted += len(subset)
         return num_deleted
 
-    # Now for any segment that contains more than one SearchMatches object,
-    # merge them all together.
-    for (kind, field), subset in segmented.iteritems():
-        if len(subset) > 1:
-            merged = models.SearchMatches(generation=_GENERATION,
-                                          entity_kind=kind,
-                                          field=field,
-                                          term=term)
-            union_of_all_matches = set()
-            for sm in subset:
-                union_of_all_matches.update(sm.matches)
-            merged.matches.extend(union_of_all_matches)
-            # We have to be careful about how we make the change in the
-            # datastore: we write out the new merged object first and
-            # then delete the old objects.  That ensures that no matches
-            # will be lost if any operation fails.
-            merged.save()  # Save the new matches
-            db.delete(subset)  # Delete the old matches
-            # The -1 accounts for the new SearchMatches object that
-            # we created.
-            num_deleted += len(subset) - 1
+    # Now for any segment that is fragmented, merge all of its
+    # SearchMatches together, splitting the result into shards of at
+    # most MAX_MATCHES_PER_SHARD keys.
+    for (generation, kind, field), subset in segmented.iteritems():
+        union_of_all_matches = set()
+        for sm in subset:
+            union_of_all_matches.update(sm.matches)
+        all_matches = sorted(union_of_all_matches)
+        num_shards = max(1, -(-len(all_matches) // MAX_MATCHES_PER_SHARD))
+        if len(subset) <= num_shards and all(
+            len(sm.matches) <= MAX_MATCHES_PER_SHARD for sm in subset):
+            continue
+        merged = []
+        for i in xrange(0, len(all_matches), MAX_MATCHES_PER_SHARD):
+            shard = models.SearchMatches(generation=generation,
+                                         entity_kind=kind,
+                                         field=field,
+                                         term=term)
+            shard.matches.extend(all_matches[i:i + MAX_MATCHES_PER_SHARD])
+            merged.append(shard)
+        # We have to be careful about how we make the change in the
+        # datastore: we write out the new merged objects first and
+        # then delete the old objects.  That ensures that no matches
+        # will be lost if any operation fails.
+        AutoRetry(db).save(merged)  # Save the new matches
+        search_index.note_saved(merged)
+        delete_matches(subset)  # Delete the old matches
+        num_deleted += len(subset) - len(merged)
 
     return num_deleted
 
@@ -492,35 +808,63 @@ def _parse_query_string(query_str):
 ### Searching
 ###
 
-def _fetch_all(query):
+# The maximum number of SearchMatches objects we read for a single
+# term or prefix.
+_MAX_MATCHES = 999
+
+
+def _collect_matches(search_matches):
     """Returns a set of (db.Key, matching field) pairs."""
-    # For now, we don't actually return all results --- just the
-    # results we can gather from the first 999 match objects.
-    # That should always be enough.
+    read_generations = get_generations()[0]
     all_matches = set()
-    for sm in AutoRetry(query).fetch(limit=999):
-        # Ignore objects that are not in the current generation.
-        if sm.generation != _GENERATION:
+    for sm in search_matches:
+        # Ignore objects that are not in the current generations.
+        if sm.generation not in read_generations:
             continue
         all_matches.update((m, sm.field) for m in sm.matches)
     return all_matches
 
 
-def fetch_keys_for_one_term(term, entity_kind=None, field=None, end=None):
-    """Find entity keys matching a single search term.
+def _fetch_all(query):
+    """Returns a set of (db.Key, matching field) pairs."""
+    # For now, we don't actually return all results --- just the
+    # results we can gather from the first 999 match objects.
+    # That should always be enough.
+    return _collect_matches(AutoRetry(query).fetch(limit=_MAX_MATCHES))
+
+
+def _fetch_all_async(queries):
+    """Runs several SearchMatches queries at once.
+
+    Query.run() sends its first RPC before returning, so starting every
+    query before reading from any of them lets the RPCs overlap: the
+    total wait is that of the slowest query rather than the sum of all
+    of them.
 
     Args:
-      term: A unicode string containing a single search term.
-      entity_kind: An optional string.  If given, the returned keys are
-        restricted to entities of that kind.
-      field: An optional string.  If given, the returned keys are restricted
-        to matches for that particular field.
-      end: An optional string. If given, the returned keys are restricted to
-        matched within a range from term to end.
+      queries: A sequence of SearchMatches queries.
 
     Returns:
-      A set of (db.Key, matching field) pairs.
+      A list of sets of (db.Key, matching field) pairs, one per query,
+      in the same order as the queries.
     """
+    in_flight = [AutoRetry(query).run(limit=_MAX_MATCHES,
+                                      batch_size=_MAX_MATCHES)
+                 for query in queries]
+    results = []
+    for query, search_matches in zip(queries, in_flight):
+        try:
+            results.append(_collect_matches(search_matches))
+        except (datastore_errors.Timeout,
+                datastore_errors.TransactionFailedError):
+            # Fall back to a synchronous fetch, which will be retried.
+            logging.warning("Async search query failed; retrying: %s",
+                            query)
+            results.append(_fetch_all(query))
+    return results
+
+
+def _term_query(term, entity_kind=None, field=None, end=None):
     query = models.SearchMatches.all()
     if entity_kind:
         query.filter("entity_kind =", entity_kind)
@@ -531,7 +875,39 @@ def fetch_keys_for_one_term(term, entity_kind=None, field=None, end=None):
         query.filter("term <", end + u"\uffff")
     else:
         query.filter("term =", term)
-    return _fetch_all(query)
+    return query
+
+
+def _prefix_query(term_prefix, entity_kind=None, field=None):
+    query = models.SearchMatches.all()
+    if entity_kind:
+        query.filter("entity_kind =", entity_kind)
+    if field:
+        query.filter("field =", field)
+    query.filter("term >=", term_prefix)
+    query.filter("term <", term_prefix + u"\uffff")
+    return query
+
+
+def fetch_keys_for_one_term(term, entity_kind=None, field=None, end=None):
+    """Find entity keys matching a single search term.
+
+    Args:
+      term: A unicode string containing a single search term.
+      entity_kind: An optional string.  If given, the returned keys are
+        restricted to entities of that kind.
+      field: An optional string.  If given, the returned keys are restricted
+        to matches for that particular field.
+      end: An optional string. If given, the returned keys are restricted to
+        matched within a range from term to end.
+
+    Returns:
+      A set of (db.Key, matching field) pairs.
+    """
+    snapshot = _get_snapshot()
+    if snapshot is not None:
+        return snapshot.keys_for_term(term, entity_kind, field, end)
+    return _fetch_all(_term_query(term, entity_kind, field, end))
 
 
 def fetch_keys_for_one_prefix(term_prefix, entity_kind=None, field=None):
@@ -547,18 +923,107 @@ def fetch_keys_for_one_prefix(term_prefix, entity_kind=None, field=None):
     Returns:
       A set of (db.Key, matching field) pairs.
     """
-    query = models.SearchMatches.all()
-    if entity_kind:
-        query.filter("entity_kind =", entity_kind)
-    if field:
-        query.filter("field =", field)
-    query.filter("term >=", term_prefix)
-    query.filter("term <", term_prefix + u"\uffff")
-    return _fetch_all(query)
+    snapshot = _get_snapshot()
+    if snapshot is not None:
+        return snapshot.keys_for_prefix(term_prefix, entity_kind, field)
+    return _fetch_all(_prefix_query(term_prefix, entity_kind, field))
+
+
+def _estimated_selectivity(query_part):
+    """Returns a sort key that puts the most selective query parts first.
+
+    Without an in-memory index we cannot know how many matches a
+    query part has until we fetch it, so we guess: a term restricted
+    to a field beats a plain term, which beats a range, which beats a
+    prefix.  Within each group, longer arguments tend to be rarer.
+    """
+    logic, flavor, arg, field, end = query_part
+    if flavor == IS_PREFIX:
+        rank = 3
+    elif end:
+        rank = 2
+    elif field:
+        rank = 0
+    else:
+        rank = 1
+    return (rank, -len(arg))
+
+
+def _query_for_query_part(query_part, entity_kind):
+    logic, flavor, arg, field, end = query_part
+    if flavor == IS_TERM:
+        return _term_query(arg, entity_kind, field, end)
+    return _prefix_query(arg, entity_kind, field)
+
+
+# The most terms a prefix query part may expand to when searching the
+# in-memory index.  Short autocomplete prefixes can otherwise pull in
+# thousands of terms.
+_MAX_PREFIX_EXPANSION = 1000
+
+
+def _snapshot_components(snapshot, query_part, entity_kind):
+    logic, flavor, arg, field, end = query_part
+    if flavor == IS_TERM:
+        return snapshot.term_components(arg, entity_kind, field, end)
+    return snapshot.prefix_components(arg, entity_kind, field,
+                                      max_terms=_MAX_PREFIX_EXPANSION)
+
+
+def _is_truncated(parsed_query):
+    """Returns True if a query's prefixes expand to too many terms.
+
+    The in-memory index then only searches the first
+    _MAX_PREFIX_EXPANSION terms of such a prefix, so the results may
+    be missing matches and must not be cached.
+
+    Args:
+      parsed_query: The output of _parse_query_string.
+    """
+    snapshot = _get_snapshot()
+    if snapshot is None:
+        return False
+    for logic, flavor, arg, field, end in parsed_query:
+        if (flavor == IS_PREFIX
+            and snapshot.count_terms(arg, _MAX_PREFIX_EXPANSION + 1)
+                > _MAX_PREFIX_EXPANSION):
+            return True
+    return False
+
+
+def may_have_matches(query_str, entity_kind=None):
+    """Cheaply checks whether a query string could match anything.
+
+    Args:
+      query_str: A unicode query string.
+      entity_kind: An optional string.  If given, only entities of
+        that kind are considered.
+
+    Returns:
+      False if we know that some required part of the query has no
+      matches, True otherwise.  Without an in-memory index we cannot
+      tell, so we always return True.
+    """
+    snapshot = _get_snapshot()
+    if snapshot is None:
+        return True
+    for logic, flavor, arg, field, end in _parse_query_string(query_str):
+        if logic != IS_REQUIRED:
+            continue
+        if flavor == IS_PREFIX:
+            if not snapshot.count_prefix(arg, entity_kind, field):
+                return False
+        elif not snapshot.term_components(arg, entity_kind, field, end):
+            return False
+    return True
 
 
 def fetch_keys_for_query_string(query_str, entity_kind=None):
-    """Find entity keys matching a single search term prefix.
+    """Find entity keys matching a query string.
+
+    Required query parts are evaluated most-selective first, and
+    forbidden parts are subtracted once all of the required parts
+    have been intersected.
 
     Args:
       query_str: A unicode query string.
@@ -572,53 +1037,127 @@ def fetch_keys_for_query_string(query_str, entity_kind=None):
     # The empty query is invalid.
     if not parsed:
         return None
-    all_matches = {}
-    is_first = True
-    # We sort the parsed query so that all of the terms with
-    # logic=IS_REQUIRED will be processed first.
-    for logic, flavor, arg, field, end in sorted(parsed):
-        # Find all of the matches related to this component of the
-        # query.
-        if flavor == IS_TERM:
-            these_matches = fetch_keys_for_one_term(arg, entity_kind, field, end)
-        elif flavor == IS_PREFIX:
-            these_matches = fetch_keys_for_one_prefix(arg, entity_kind, field)
-        else:
+    required = []
+    forbidden = []
+    for query_part in parsed:
+        logic, flavor = query_part[:2]
+        if flavor not in (IS_TERM, IS_PREFIX):
             # This should never happen.
             logging.error("Query produced unexpected results: %s", query_str)
             return None
-        # Now use this component's matches to update the complete set.
         if logic == IS_REQUIRED:
-            if is_first:
-                for m, f in these_matches:
-                    all_matches[m] = set([f])
-            else:
-                new_all_matches = {}
-                for m, f in these_matches:
-                    existing_fs = all_matches.get(m)
-                    if existing_fs:
-                        new_all_matches[m] = set([f]).union(existing_fs)
-                all_matches = new_all_matches
+            required.append(query_part)
         elif logic == IS_FORBIDDEN:
-            if is_first:
-                # The first thing we see should not be a negative query part.
-                # If so, the query is invalid.
-                return None
-            for m, _ in these_matches:
-                if m in all_matches:
-                    del all_matches[m]
+            forbidden.append(query_part)
         else:
             # This should never happen.
             logging.error("Query produced unexpected results: %s", query_str)
             return None
-        is_first = False
+    # A query made up only of negative parts is invalid.
+    if not required:
+        return None
+    return _fetch_keys_for_query_parts(required, forbidden, entity_kind)
+
+
+def _fetch_keys_for_query_parts(required, forbidden, entity_kind):
+    """Find entity keys matching some parsed query parts.
+
+    Args:
+      required: A non-empty list of term or prefix query parts that
+        every match must satisfy.
+      forbidden: A list of query parts that no match may satisfy.
+      entity_kind: An optional string.  If given, the returned keys are
+        restricted to entities of that kind.
+
+    Returns:
+      A dict mapping db.Key objects to a set of matching fields.
+    """
+    snapshot = _get_snapshot()
+    if snapshot is not None:
+        by_doc_id = postings.execute(
+            [_snapshot_components(snapshot, qp, entity_kind)
+             for qp in required],
+            [_snapshot_components(snapshot, qp, entity_kind)
+             for qp in forbidden])
+        return dict((snapshot.doc_key(doc_id), fields)
+                    for doc_id, fields in by_doc_id.iteritems())
+
+    # Every term and prefix query is issued at once; we then merge
+    # the results, starting with the part we expect to be smallest.
+    required.sort(key=_estimated_selectivity)
+    fetched = _fetch_all_async(
+        [_query_for_query_part(qp, entity_kind)
+         for qp in required + forbidden])
+    all_matches = None
+    for these_matches in fetched[:len(required)]:
+        if all_matches is None:
+            all_matches = {}
+            for m, f in these_matches:
+                all_matches.setdefault(m, set()).add(f)
+        else:
+            new_all_matches = {}
+            for m, f in these_matches:
+                existing_fs = all_matches.get(m)
+                if existing_fs is not None:
+                    new_all_matches.setdefault(m, set(existing_fs)).add(f)
+            all_matches = new_all_matches
         # Is our set of matches empty?  If so, there is no point in
-        # processing any more terms.
+        # merging any more terms.
+        if not all_matches:
+            return all_matches
+    for these_matches in fetched[len(required):]:
+        for m, _ in these_matches:
+            all_matches.pop(m, None)
         if not all_matches:
             break
     return all_matches
 
 
+def fetch_keys_for_substring(text):
+    """Find tracks whose titles might contain a piece of text.
+
+    The text's n-grams are looked up in the index and their posting
+    lists intersected.  A title containing every n-gram of the text
+    usually contains the text itself, but not always, so callers must
+    check the candidates against ngram_text(title).
+
+    Args:
+      text: A unicode string.
+
+    Returns:
+      A set of Track keys, or None if the text is too short to have
+      any n-grams.
+    """
+    grams = _ngrams(text)
+    if not grams:
+        return None
+    required = [(IS_REQUIRED, IS_TERM, gram, NGRAM_FIELD, None)
+                for gram in grams]
+    return set(_fetch_keys_for_query_parts(required, [], "Track"))
+
+
+def substring_search(text, max_num_results, include_revoked=False):
+    """Finds tracks across the whole library whose titles contain text.
+
+    Args:
+      text: A unicode string.
+      max_num_results: The maximum number of tracks to return.
+      include_revoked: Whether to include revoked tracks.
+
+    Returns:
+      A list of Tracks, sorted as simple_music_search() sorts them.
+    """
+    keys = fetch_keys_for_substring(text)
+    if not keys:
+        return []
+    needle = ngram_text(text)
+    matches = _load_top_matches(
+        sorted(keys, key=str), max_num_results,
+        include_revoked=include_revoked,
+        accept=lambda track: needle in ngram_text(strip_tags(track.title)))
+    return matches.get("Track", [])
+
+
 def load_and_segment_keys(fetched_keys, include_revoked=False):
     """Convert a series of datastore keys into a dict of lists of entities.
 
@@ -642,90 +1181,201 @@ def load_and_segment_keys(fetched_keys, include_revoked=False):
     return segmented
 
 
-def _album_is_reviewed(album, user_key):
-    """Check if an album has been reviewed.
+def _albums_reviewed_by(user_key):
+    """Returns the set of keys of albums reviewed by a user.
+
+    Args:
+      user_key: A stringified user key.
+    """
+    query = models.Document.all()
+    query.filter("author =", db.Key(user_key))
+    query.filter("doctype =", models.DOCTYPE_REVIEW)
+    return set(models.Document.subject.get_value_for_datastore(doc)
+               for doc in AutoRetry(query).fetch(_MAX_MATCHES))
+
+
+def _reviewed_filter(user_key):
+    """Returns a function that tests whether a match has been reviewed.
 
     Args:
-      album: An Album entity
       user_key: A stringified user key, or None.
 
     Returns:
-      If user_key is None, returns True if and only if the album has
-        any reviews at all.
-      If user_key is not None, returns True if and only if the album
-        has been reviewed by the specified user.
-    """
-    if user_key is None or user_key == "":
-        return len(album.reviews) > 0
-    for review in album.reviews:
-        if str(review.author.key()) == user_key:
-            return True
-    return False
+      A function taking an Artist, Album or Track and returning a bool.
+      If user_key is None, it uses the entity's own is_reviewed flag,
+      which is set when any of the relevant albums gets a review.  If
+      user_key is not None, it checks the entity's album, or for an
+      artist any album by that artist, against the set of albums the
+      specified user has reviewed.  That set is loaded once, no matter
+      how many entities are tested.
+    """
+    if not user_key:
+        return lambda entity: getattr(entity, "is_reviewed", True)
+
+    album_keys = _albums_reviewed_by(user_key)
+    artist_keys = []
+
+    def reviewed_artists():
+        # Only looked up if we actually come across an artist.
+        if not artist_keys:
+            albums = AutoRetry(db).get(list(album_keys))
+            artist_keys.append(set(
+                models.Album.album_artist.get_value_for_datastore(album)
+                for album in albums if album))
+        return artist_keys[0]
+
+    def is_reviewed(entity):
+        kind = entity.kind()
+        if kind == "Track":
+            return (models.Track.album.get_value_for_datastore(entity)
+                    in album_keys)
+        if kind == "Album":
+            return entity.key() in album_keys
+        if kind == "Artist":
+            return entity.key() in reviewed_artists()
+        return True
+    return is_reviewed
+
+
+# When there are too many matches to return, we prefer artists to
+# albums and albums to tracks.
+_KIND_PRIORITY = ("Artist", "Album", "Track")
+
+# The field holding the name or title of each kind of entity.  A match
+# on this field beats a match on, say, an album's label.
+_PRIMARY_FIELD = {
+    "Artist": "name",
+    "Album": "title",
+    "Track": "title",
+}
 
 
-def _artist_has_reviewed_album(artist, user_key):
-    """Check if an artist has an album that has been reviewed.
+def _rank_match(key, fields):
+    """Returns a sort key that puts the best search matches first.
 
     Args:
-      artist: An Artist entity.
-      user_key: A stringified user key, or None.
+      key: A db.Key for a matching entity.
+      fields: The set of fields in which the entity matched.
 
-    Returns:
-      True if _album_is_reviewed(album, user_key) is True for any
-      album by that artist, False otherwise.
+    Matches are ordered by kind, then by whether the entity's name or
+    title matched, then by the number of matching fields.  Matches
+    that tie are ordered by name or title once they are loaded (see
+    _load_top_matches()).
     """
-    artist_album_query = models.Album.all().filter(
-        "album_artist =", artist)
-    for album in artist_album_query:
-        if _album_is_reviewed(album, user_key):
-            return True
-    return False
+    kind = key.kind()
+    if kind in _KIND_PRIORITY:
+        kind_rank = _KIND_PRIORITY.index(kind)
+    else:
+        kind_rank = len(_KIND_PRIORITY)
+    return (kind_rank, _PRIMARY_FIELD.get(kind) not in fields,
+            -len(fields))
+
+
+def _name_sort_key(entity):
+    """Returns a sort key for the name or title of an entity."""
+    text = getattr(entity, _PRIMARY_FIELD.get(entity.kind(), ""), None)
+    return (ngram_text(strip_tags(text or u"")), str(entity.key()))
+
+
+# The fewest keys _load_top_matches() fetches at a time.  Refilling one
+# or two filtered-out results with a round trip each would be slower
+# than fetching a few keys we do not need.
+_MIN_LOAD_BATCH_SIZE = 25
+
+# The most keys _load_top_matches() loads beyond max_num_results to
+# choose between matches that tie.  Past that, ties go by key.
+_MAX_TIE_BREAK_KEYS = 100
 
 
-def _discard_items(target_list, num_to_discard):
-    """Discards items from a list at random.
+def _load_top_matches(ranked_keys, max_num_results, include_revoked=False,
+                      reviewed=False, user_key=None, accept=None, rank=None):
+    """Loads the best-ranked entities that pass our filters.
 
     Args:
-      target_list: The list to discard items from a list.  The list is
-        modified in-place.
-      num_to_discard: The number of items to attempt to discard.
+      ranked_keys: A list of datastore keys, best match first.
+      max_num_results: The maximum number of entities to return.
+      include_revoked: Whether to include revoked entities.
+      reviewed: If True, skip entities that have not been reviewed.
+      user_key: If set, skip entities not reviewed by this user.
+      accept: If set, skip entities for which this function returns
+        False.
+      rank: If set, a function returning the rank of a key, by which
+        ranked_keys is sorted.  Entities of the same rank are chosen
+        by name or title.
 
     Returns:
-      Returns the number of items that were actually discarded.
-      This number will be equal to len(target_list) if that value is
-      less than num_to_discard.
-    """
-    if num_to_discard <= 0 or target_list is None:
-        return 0
-    num_to_discard = min(len(target_list), num_to_discard)
-    for _ in xrange(num_to_discard):
-        discarded = target_list.pop()
-    return num_to_discard
-        
+      A dict mapping entity kind names to lists of entities, in the
+      same format as load_and_segment_keys().
+
+    Only the keys we expect to return, or at least
+    _MIN_LOAD_BATCH_SIZE of them, are fetched.  If some of them turn
+    out to be revoked or unreviewed, we fetch the next-best keys to
+    take their place.  If the last entity we keep ties with keys we
+    have not fetched, up to _MAX_TIE_BREAK_KEYS more are fetched to
+    compete with it.
+    """
+    if reviewed:
+        is_reviewed = _reviewed_filter(user_key)
+    entities = []
+    i = 0
+    while i < len(ranked_keys):
+        if len(entities) < max_num_results:
+            batch_size = max(max_num_results - len(entities),
+                             _MIN_LOAD_BATCH_SIZE)
+            end = i + batch_size
+        elif rank is None or not entities:
+            break
+        else:
+            last_rank = rank(entities[max_num_results - 1].key())
+            limit = min(len(ranked_keys),
+                        max_num_results + _MAX_TIE_BREAK_KEYS)
+            end = i
+            while end < limit and rank(ranked_keys[end]) == last_rank:
+                end += 1
+            if end == i:
+                break
+        batch = ranked_keys[i:end]
+        i += len(batch)
+        for entity in AutoRetry(db).get(batch):
+            if not entity:
+                continue
+            if not include_revoked and getattr(entity, "revoked", False):
+                continue
+            if reviewed and not is_reviewed(entity):
+                continue
+            if accept is not None and not accept(entity):
+                continue
+            entities.append(entity)
+    if rank is not None:
+        entities.sort(key=lambda e: (rank(e.key()), _name_sort_key(e)))
+    segmented = {}
+    for entity in entities[:max_num_results]:
+        segmented.setdefault(entity.kind(), []).append(entity)
+    for val in segmented.itervalues():
+        val.sort(key=lambda x: x.sort_key)
+    return segmented
 
-def _enforce_results_limit_on_matches(segmented_matches, max_num_results):
-    """If necessary, throw away results to avoid returning too many items.
+
+def _load_cached_matches(cached):
+    """Loads the entities for a cached search result.
 
     Args:
-      segmented_matches: A dictionary mapping entity type strings to
-        lists of matching entities.  This dict is modified in-place.
-      max_num_results: The maximum number of items that may be returned.
-        This function does nothing is max_num_results is None.
-    
-    If the dict contains too many items, they are thrown away
-    semi-randomly: Track objects are discarded first, then Albums,
-    and finally Artists.
-    """
-    if max_num_results is None:
-        return
-    num_results = sum([len(x) for x in segmented_matches.itervalues()])
-    num_to_discard = num_results - max_num_results
-    for kind in ("Track", "Album", "Artist"):
-        these_matches = segmented_matches.get(kind)
-        num_to_discard -= _discard_items(these_matches, num_to_discard)
-        if these_matches is not None and len(these_matches) == 0:
-            del segmented_matches[kind]
-    
+      cached: A dict mapping entity kind names to lists of keys.
+
+    Returns:
+      A dict mapping entity kind names to lists of entities, in the
+      same order as the keys.
+    """
+    all_keys = [key for keys in cached.itervalues() for key in keys]
+    entities = dict((key, entity) for key, entity
+                    in zip(all_keys, AutoRetry(db).get(all_keys)))
+    segmented = {}
+    for kind, keys in cached.iteritems():
+        these_entities = [entities[key] for key in keys if entities[key]]
+        if these_entities:
+            segmented[kind] = these_entities
+    return segmented
+
 
 def simple_music_search(query_str, max_num_results=None, entity_kind=None,
                         reviewed=False, user_key=None, include_revoked=False):
@@ -734,8 +1384,8 @@ def simple_music_search(query_str, max_num_results=None, entity_kind=None,
     Args:
       query_str: A unicode query string.
       max_num_results: The maximum number of items to return.  If the
-        number of matches exceeds this, some items will be discarded.
-        If None, all matches will be returned.
+        number of matches exceeds this, only the best-ranked matches
+        are returned.  If None, all matches will be returned.
       entity_kind: An optional string.  If given, the returned keys are
         restricted to entities of that kind.
       reviewed: If True, only return albums and tracks associated with
@@ -747,6 +1397,45 @@ def simple_music_search(query_str, max_num_results=None, entity_kind=None,
     Returns:
       A dict mapping object types to lists of entities.
     """
+    # If a user key is set, we are only interested in items that have
+    # been reviewed.
+    if user_key:
+        reviewed = True
+
+    # Search results are cached as lists of keys; the entities
+    # themselves are always loaded fresh.
+    cache_key = search_cache.make_key(
+        _parse_query_string(query_str),
+        max_num_results=max_num_results, entity_kind=entity_kind,
+        reviewed=reviewed, user_key=user_key,
+        include_revoked=include_revoked)
+    cached = search_cache.lookup(cache_key)
+    if cached is not None:
+        return _load_cached_matches(cached)
+
+    segmented_matches = _uncached_music_search(
+        query_str, max_num_results, entity_kind, reviewed, user_key,
+        include_revoked)
+    if (segmented_matches is not None and cache_key is not None
+        and not _is_truncated(_parse_query_string(query_str))):
+        search_cache.store(
+            cache_key,
+            dict((kind, [ent.key() for ent in entities])
+                 for kind, entities in segmented_matches.iteritems()))
+    return segmented_matches
+
+
+# A track only matches if one of these fields does.  Otherwise a search
+# for an artist or album would also return every one of its tracks.
+_TRACK_MATCH_FIELDS = frozenset(["title", "tag", "track_artist"])
+
+
+def _is_wanted_match(key, fields):
+    return key.kind() != "Track" or bool(_TRACK_MATCH_FIELDS & fields)
+
+
+def _uncached_music_search(query_str, max_num_results, entity_kind,
+                           reviewed, user_key, include_revoked):
     # First, find all matching keys.
     all_matches = fetch_keys_for_query_string(query_str, entity_kind)
 
@@ -754,17 +1443,19 @@ def simple_music_search(query_str, max_num_results=None, entity_kind=None,
     if all_matches is None:
         return None
 
-    # If a user key is set, we are only interested in items that have
-    # been reviewed.
-    if user_key:
-        reviewed = True
-
     # Next, filter out the keys for tracks that do not have a title match.
     # Allow search on the tag field for tracks.
-    keys_to_fetch = []
-    for key, fields in all_matches.iteritems():
-        if key.kind() != "Track" or "title" in fields or "tag" in fields or "track_artist" in fields:
-            keys_to_fetch.append(key)
+    keys_to_fetch = [key for key, fields in all_matches.iteritems()
+                     if _is_wanted_match(key, fields)]
+
+    # If there is a limit on the number of results, rank the keys
+    # and fetch only as many entities as we need.
+    if max_num_results is not None:
+        rank = lambda k: _rank_match(k, all_matches[k])
+        keys_to_fetch.sort(key=lambda k: (rank(k), str(k)))
+        return _load_top_matches(keys_to_fetch, max_num_results, rank=rank,
+                                 include_revoked=include_revoked,
+                                 reviewed=reviewed, user_key=user_key)
 
     # Fetch all of the specified keys from the datastore and construct a
     # segmented dict of matches.
@@ -772,21 +1463,172 @@ def simple_music_search(query_str, max_num_results=None, entity_kind=None,
 
     # If necessary, filter out unreviewed matches.
     if reviewed:
-        if "Track" in segmented_matches:
-            segmented_matches["Track"] = [
-                trk for trk in segmented_matches["Track"]
-                if _album_is_reviewed(trk.album, user_key)]
-        if "Album" in segmented_matches:
-            segmented_matches["Album"] = [
-                alb for alb in segmented_matches["Album"]
-                if _album_is_reviewed(alb, user_key)]
-        if "Artist" in segmented_matches:
-            segmented_matches["Artist"] = [
-                art for art in segmented_matches["Artist"]
-                if _artist_has_reviewed_album(art, user_key)]
-
-    # Now enforce any limit on the number of results.
-    _enforce_results_limit_on_matches(segmented_matches, max_num_results)
-                
+        is_reviewed = _reviewed_filter(user_key)
+        for kind, entities in segmented_matches.items():
+            segmented_matches[kind] = [
+                ent for ent in entities if is_reviewed(ent)]
+
     return segmented_matches
-        
+
+
+###
+### Autocomplete
+###
+
+def _entity_terms(entity):
+    """Returns the index terms for an entity, as a dict keyed by field.
+
+    This mirrors what the index holds for the entity: the fields that
+    the Indexer indexes, plus the tags, pronunciation and track artist
+    that are indexed when they are edited.
+    """
+    fields = _indexed_text(entity) + _edited_text(entity)
+    terms = {}
+    for field, text in fields:
+        terms.setdefault(field, set()).update(explode(text))
+    return dict((field, frozenset(these_terms))
+                for field, these_terms in terms.iteritems())
+
+
+def _matching_fields(parsed_query, terms):
+    """Evaluates a parsed query against an entity's terms.
+
+    Args:
+      parsed_query: The output of _parse_query_string.
+      terms: A dict of {field: set of terms}, from _entity_terms().
+
+    Returns:
+      The set of fields matched by the required parts of the query, or
+      None if the entity does not match.
+    """
+    matched_fields = set()
+    for logic, flavor, arg, field, end in parsed_query:
+        matched = set()
+        for fld, these_terms in terms.iteritems():
+            if field and fld != field:
+                continue
+            for term in these_terms:
+                if term == arg or (flavor == IS_PREFIX
+                                   and term.startswith(arg)):
+                    matched.add(fld)
+                    break
+        if logic == IS_REQUIRED:
+            if not matched:
+                return None
+            matched_fields.update(matched)
+        elif matched:
+            return None
+    return matched_fields
+
+
+def _is_refinement(old_query, new_query):
+    """Returns True if everything new_query matches, old_query matches.
+
+    That is the case when every part of old_query is implied by some
+    part of new_query: "metal*" is implied by "metall*" or by "metal",
+    and a forbidden part must appear unchanged.  Queries over ranges
+    are never treated as refinements.
+
+    Args:
+      old_query, new_query: Outputs of _parse_query_string.
+    """
+    for part in old_query + new_query:
+        if part[4] is not None:
+            return False
+    for old_part in old_query:
+        logic, flavor, arg, field, _ = old_part
+        if logic == IS_FORBIDDEN:
+            if old_part not in new_query:
+                return False
+            continue
+        for new_logic, new_flavor, new_arg, new_field, _ in new_query:
+            if new_logic != IS_REQUIRED:
+                continue
+            if field and new_field != field:
+                continue
+            if flavor == IS_TERM:
+                if new_flavor == IS_TERM and new_arg == arg:
+                    break
+            elif new_arg.startswith(arg):
+                break
+        else:
+            return False
+    return True
+
+
+def autocomplete_search(typed, entity_kind, max_num_results):
+    """Searches for entities of one kind as a user types.
+
+    What has been typed so far is treated as a prefix unless it ends
+    in whitespace, so "metalli" finds "Metallica".
+
+    Each keystroke usually extends the previous one, so we remember
+    the candidates found for what was typed along with their index
+    terms.  If an earlier search returned fewer than max_num_results
+    candidates, it found every match; the matches for a longer query
+    are then a subset of them, and are found by checking each
+    candidate's terms in memory instead of searching the index again.
+
+    Args:
+      typed: The unicode text the user has typed.
+      entity_kind: The kind of entity to search for.
+      max_num_results: The maximum number of entities to return.
+
+    Returns:
+      A list of entities of the given kind, in the same order as
+      simple_music_search() returns them.
+    """
+    query_str = typed
+    if not query_str[-1].isspace():
+        query_str = "%s*" % query_str
+    parsed = _parse_query_string(query_str)
+    namespace = search_cache.autocomplete_namespace(entity_kind,
+                                                    max_num_results)
+    if namespace is not None:
+        for i in xrange(len(typed), 0, -1):
+            cached = search_cache.lookup_candidates(namespace + (typed[:i],))
+            if cached is None:
+                continue
+            if i == len(typed):
+                candidates = cached["candidates"]
+            elif cached["complete"] and _is_refinement(cached["query"],
+                                                       parsed):
+                candidates = []
+                for key, terms in cached["candidates"]:
+                    fields = _matching_fields(parsed, terms)
+                    if fields and _is_wanted_match(key, fields):
+                        candidates.append((key, terms))
+                search_cache.store_candidates(
+                    namespace + (typed,),
+                    {"query": parsed, "candidates": candidates,
+                     "complete": True})
+            else:
+                break
+            # Entities are always loaded fresh, in case they have
+            # since been revoked.
+            keys = [key for key, _ in candidates]
+            return [ent for ent in AutoRetry(db).get(keys)
+                    if ent and not getattr(ent, "revoked", False)]
+
+    # Skip the search entirely if the index's prefix dictionary says
+    # that nothing can match.
+    if not may_have_matches(query_str, entity_kind):
+        return []
+    matches = simple_music_search(query_str, max_num_results=max_num_results,
+                                  entity_kind=entity_kind)
+    entities = (matches or {}).get(entity_kind, [])
+    if (namespace is not None and matches is not None
+        and not _is_truncated(parsed)):
+        # _entity_terms() reads the albums and artists that the
+        # entities refer to, so fetch them all at once.
+        prefetch_references(entities,
+                            ["album", "album_artist", "track_artist"])
+        prefetch_references([ent.album for ent in entities
+                             if ent.kind() == "Track"], ["album_artist"])
+        search_cache.store_candidates(
+            namespace + (typed,),
+            {"query": parsed,
+             "candidates": [(ent.key(), _entity_terms(ent))
+                            for ent in entities],
+             "complete": len(entities) < max_num_results})
+    return entities
@@ -0,0 +1,224 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""A cache of DJ database search results.
+
+Results are cached in two tiers: a small LRU cache in each instance's
+memory, backed by memcache.  Every cache key includes a version number
+that is stored in memcache.  Anything that might change a search
+result (an index update, a tag edit, revoking an item, a new review)
+calls invalidate(), which bumps the version.  Entries cached under an
+older version are never looked up again and simply age out.
+
+An invalidation takes effect everywhere at once, but other instances'
+index snapshots only catch up with the change on their next refresh.
+Results found in the meantime may be out of date, so until then they
+are cached under separate, short-lived keys.
+"""
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+
+from google.appengine.api import memcache
+
+from common.lru import LRUCache
+from djdb import search_index
+
+log = logging.getLogger(__name__)
+
+VERSION_KEY = "djdb.search_cache.version"
+
+# Present in memcache for a while after each invalidation.
+RECENTLY_INVALIDATED_KEY = "djdb.search_cache.recently_invalidated"
+
+# How long (in seconds) results are kept in memcache.
+MEMCACHE_TIMEOUT = 60 * 60
+
+# How long (in seconds) after an invalidation index snapshots may
+# still predate it, and so how long the results found then are kept.
+RECENT_INVALIDATION_SECONDS = search_index.REFRESH_INTERVAL
+
+# Ends the keys of results found soon after an invalidation.
+_RECENT_SUFFIX = ".recent"
+
+# How many results each instance keeps in memory.
+LOCAL_CAPACITY = 500
+
+_local = LRUCache(LOCAL_CAPACITY)
+
+# How many autocomplete candidate lists each instance keeps in memory.
+# See search.autocomplete_search().
+AUTOCOMPLETE_CAPACITY = 200
+
+_autocomplete = LRUCache(AUTOCOMPLETE_CAPACITY)
+
+# Counters for the memcache tier.  Like the local cache, these are
+# per-instance.
+_memcache_hits = 0
+_memcache_misses = 0
+
+
+def is_enabled():
+    """Returns True if search results should be cached."""
+    return getattr(settings, "DJDB_SEARCH_CACHE", False)
+
+
+def _current_state():
+    """Returns the cache version and whether it was bumped recently."""
+    values = memcache.get_multi([VERSION_KEY, RECENTLY_INVALIDATED_KEY])
+    version = values.get(VERSION_KEY)
+    if version is None:
+        # Start from the current time so that a version number is
+        # never reused after memcache loses the counter.
+        memcache.add(VERSION_KEY, int(time.time()))
+        version = memcache.get(VERSION_KEY)
+    return version, RECENTLY_INVALIDATED_KEY in values
+
+
+def current_version():
+    """Returns the current cache version number."""
+    return _current_state()[0]
+
+
+def invalidate():
+    """Makes every cached search result stale."""
+    if not is_enabled():
+        return
+    if memcache.incr(VERSION_KEY, initial_value=int(time.time())) is None:
+        log.warning("Unable to bump %s; search results may be stale",
+                    VERSION_KEY)
+    memcache.set(RECENTLY_INVALIDATED_KEY, True,
+                 time=RECENT_INVALIDATION_SECONDS)
+    _local.clear()
+    _autocomplete.clear()
+
+
+def make_key(parsed_query, **options):
+    """Builds a cache key for a search.
+
+    Args:
+      parsed_query: The output of search._parse_query_string.
+      options: Any other arguments that affect the search results.
+
+    Returns:
+      A string, or None if caching is disabled or the cache version is
+      unavailable.  Soon after an invalidation the key is a different,
+      short-lived one; see store().
+    """
+    if not is_enabled():
+        return None
+    version, recent = _current_state()
+    if version is None:
+        return None
+    parts = [repr(sorted(set(parsed_query)))]
+    parts.extend("%s=%r" % item for item in sorted(options.items()))
+    digest = hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+    key = "djdb.search_cache.%s.%s" % (version, digest)
+    if recent:
+        key += _RECENT_SUFFIX
+    return key
+
+
+def lookup(key):
+    """Returns a cached search result, or None."""
+    global _memcache_hits, _memcache_misses
+    if key is None:
+        return None
+    value = _local.get(key)
+    if value is not None:
+        return value
+    value = memcache.get(key)
+    if value is None:
+        _memcache_misses += 1
+        return None
+    _memcache_hits += 1
+    _local.set(key, value)
+    return value
+
+
+def store(key, value):
+    """Caches a search result in both tiers.
+
+    A result found soon after an invalidation is kept in memcache for
+    only RECENT_INVALIDATION_SECONDS.  After that make_key() returns
+    the usual key again, so neither tier will look it up any more.
+    """
+    if key is None:
+        return
+    timeout = MEMCACHE_TIMEOUT
+    if key.endswith(_RECENT_SUFFIX):
+        timeout = RECENT_INVALIDATION_SECONDS
+    _local.set(key, value)
+    memcache.set(key, value, time=timeout)
+
+
+def autocomplete_namespace(entity_kind, max_num_results):
+    """Builds the part of an autocomplete cache key shared by all prefixes.
+
+    The full key is this tuple with the text the user has typed
+    appended, so that a caller can look up every prefix of what was
+    typed while reading the cache version only once.
+
+    Args:
+      entity_kind: The kind of entity being completed.
+      max_num_results: The most candidates the search may return.
+
+    Returns:
+      A tuple, or None if caching is disabled or the cache version is
+      unavailable.
+    """
+    if not is_enabled():
+        return None
+    version, recent = _current_state()
+    if version is None:
+        return None
+    return (version, recent, entity_kind, max_num_results)
+
+
+def lookup_candidates(key):
+    """Returns cached autocomplete candidates, or None."""
+    if key is None:
+        return None
+    return _autocomplete.get(key)
+
+
+def store_candidates(key, value):
+    """Caches autocomplete candidates in this instance's memory.
+
+    Unlike search results these are not put in memcache: they only
+    help with the next few keystrokes, which are handled while they
+    are still in memory.
+    """
+    if key is None:
+        return
+    _autocomplete.set(key, value)
+
+
+def stats():
+    """Returns a dict of hit and miss counters for both tiers."""
+    return {
+        "version": memcache.get(VERSION_KEY),
+        "local": _local.stats(),
+        "autocomplete": _autocomplete.stats(),
+        "memcache": {
+            "hits": _memcache_hits,
+            "misses": _memcache_misses,
+        },
+    }
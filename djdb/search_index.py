@@ -0,0 +1,540 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""An in-memory, read-only snapshot of the DJ database search index.
+
+Running one SearchMatches query per search term is slow, so each
+instance can keep a copy of the whole index in memory.  The snapshot
+holds a sorted table of terms, and for each term a compact posting
+list of integer document ids per (entity kind, field).
+
+The snapshot is kept fresh by re-reading any SearchMatches objects
+whose timestamp is at or after the newest timestamp we have seen so
+far.  Deleted SearchMatches cannot be found that way, so while
+snapshots are enabled SearchMatches are emptied rather than deleted
+(see search.delete_matches), and compaction only deletes them once
+they are older than TOMBSTONE_SECONDS.  The whole snapshot is also
+rebuilt periodically.
+
+Building a snapshot reads the whole index, which is far too slow to
+do while a user waits.  Instances build theirs in the warmup request,
+and otherwise a little at a time; searches use the datastore until a
+snapshot is ready.
+
+Searches read a snapshot without taking any lock, while refreshes
+update it in place.  To keep that safe, writers hold the snapshot's
+write lock and never modify a term table or posting dict that readers
+can see; they build an updated copy and swap it in.
+"""
+
+import bisect
+import datetime
+import logging
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+from common.autoretry import AutoRetry
+from djdb import models
+from djdb import postings
+from djdb import prefix_dict
+
+log = logging.getLogger(__name__)
+
+# How often (in seconds) we look for new or modified SearchMatches.
+REFRESH_INTERVAL = 60
+
+# How old (in seconds) a snapshot may get before it is rebuilt from
+# scratch.  This is what eventually drops deleted SearchMatches.
+MAX_SNAPSHOT_AGE = 60 * 60
+
+# How long (in seconds) an emptied SearchMatches is kept before it is
+# deleted.  By then every instance has rebuilt its snapshot.
+TOMBSTONE_SECONDS = 2 * MAX_SNAPSHOT_AGE
+
+# How long (in seconds) a search may spend building a missing or
+# outdated snapshot before it goes ahead without one.
+BUILD_SLICE_SECONDS = 0.2
+
+# How long (in seconds) a warmup request may spend building.
+WARMUP_BUILD_SECONDS = 30
+
+# Number of SearchMatches to read per datastore RPC.
+_BATCH_SIZE = 500
+
+
+class IndexSnapshot(object):
+    """A read-only copy of all SearchMatches in the given generations."""
+
+    def __init__(self, *generations):
+        self.generations = generations
+        # Maps document ids to db.Key objects, and back.
+        self._doc_keys = []
+        self._doc_ids = {}
+        # Maps (term, kind, field) to a dict of
+        # {SearchMatches key: posting list}.
+        self._contributions = {}
+        # Maps the string form of a SearchMatches key to the
+        # (term, kind, field) it contributes to.
+        self._sm_triples = {}
+        # Maps terms to a dict of {(kind, field): merged posting list}.
+        # These dicts are replaced rather than modified.
+        self._postings = {}
+        # All terms, in sorted order.  This list is replaced rather
+        # than modified; terms added to or dropped from self._postings
+        # are collected and published all at once.
+        self._terms = []
+        self._added_terms = set()
+        self._dropped_terms = set()
+        # Held by anything that changes the snapshot.
+        self._write_lock = threading.Lock()
+        # A prefix_dict.PrefixDictionary over self._terms, built on
+        # demand.  It is thrown away when a term, or a (kind, field)
+        # under a term, comes or goes; changes in the length of a
+        # posting list alone leave it be.
+        self._prefix_dict = None
+        self._prefix_dict_outdated = False
+        # The newest SearchMatches.timestamp seen so far.
+        self.high_water_mark = None
+        # Where build_step() left off.
+        self._build_cursor = None
+        self._build_started = None
+        self._num_loaded = 0
+        self.built_at = None
+        self.refreshed_at = None
+        self.build_seconds = None
+
+    def _doc_id(self, key):
+        doc_id = self._doc_ids.get(key)
+        if doc_id is None:
+            doc_id = self._doc_ids[key] = len(self._doc_keys)
+            self._doc_keys.append(key)
+        return doc_id
+
+    def _merge(self, triple):
+        term, kind, field = triple
+        contrib = self._contributions.get(triple)
+        old = self._postings.get(term)
+        by_kind_field = dict(old or ())
+        if contrib:
+            by_kind_field[(kind, field)] = postings.union(contrib.values())
+        else:
+            self._contributions.pop(triple, None)
+            by_kind_field.pop((kind, field), None)
+        if len(by_kind_field) != len(old or ()):
+            self._prefix_dict_outdated = True
+        if by_kind_field:
+            if old is None:
+                if term in self._dropped_terms:
+                    self._dropped_terms.discard(term)
+                else:
+                    self._added_terms.add(term)
+            self._postings[term] = by_kind_field
+        elif old is not None:
+            del self._postings[term]
+            if term in self._added_terms:
+                self._added_terms.discard(term)
+            else:
+                self._dropped_terms.add(term)
+
+    def _publish_terms(self):
+        if self._prefix_dict_outdated:
+            self._prefix_dict = None
+            self._prefix_dict_outdated = False
+        if not (self._added_terms or self._dropped_terms):
+            return
+        dropped = self._dropped_terms
+        terms = [t for t in self._terms if t not in dropped]
+        terms.extend(sorted(self._added_terms))
+        # Both parts are already sorted, so this is just a merge.
+        terms.sort()
+        self._terms = terms
+        self._added_terms = set()
+        self._dropped_terms = set()
+
+    def _forget(self, sm_key):
+        sm_key = str(sm_key)
+        triple = self._sm_triples.pop(sm_key, None)
+        if triple is None:
+            return
+        contrib = self._contributions.get(triple)
+        if contrib is not None:
+            contrib.pop(sm_key, None)
+        self._merge(triple)
+
+    def _apply(self, sm):
+        sm_key = str(sm.key())
+        if sm.generation not in self.generations or not sm.matches:
+            # Emptied SearchMatches stand in for deleted ones.
+            self._forget(sm_key)
+        else:
+            triple = (sm.term, sm.entity_kind, sm.field)
+            old_triple = self._sm_triples.get(sm_key)
+            if old_triple is not None and old_triple != triple:
+                self._forget(sm_key)
+            plist = postings.from_ids(self._doc_id(k) for k in sm.matches)
+            self._contributions.setdefault(triple, {})[sm_key] = plist
+            self._sm_triples[sm_key] = triple
+            self._merge(triple)
+        if sm.timestamp and (self.high_water_mark is None
+                             or sm.timestamp > self.high_water_mark):
+            self.high_water_mark = sm.timestamp
+
+    def apply(self, search_matches):
+        """Adds or replaces the contributions of SearchMatches objects."""
+        with self._write_lock:
+            for sm in search_matches:
+                self._apply(sm)
+            self._publish_terms()
+
+    def forget(self, sm_keys):
+        """Drops everything contributed by some SearchMatches keys."""
+        with self._write_lock:
+            for sm_key in sm_keys:
+                self._forget(sm_key)
+            self._publish_terms()
+
+    def _load(self, query, cursor=None, deadline=None):
+        """Applies the SearchMatches returned by a query.
+
+        Args:
+          query: A SearchMatches query.
+          cursor: If given, the query cursor to start from.
+          deadline: If given, we stop after the first batch that ends
+            past this time.time() value.
+
+        Returns:
+          A (number of SearchMatches loaded, cursor) tuple.  The cursor
+          is None if we reached the end of the query.
+        """
+        num_loaded = 0
+        while True:
+            if cursor:
+                query.with_cursor(cursor)
+            batch = AutoRetry(query).fetch(_BATCH_SIZE)
+            for sm in batch:
+                self._apply(sm)
+            num_loaded += len(batch)
+            if len(batch) < _BATCH_SIZE:
+                return num_loaded, None
+            cursor = query.cursor()
+            if deadline is not None and time.time() >= deadline:
+                return num_loaded, cursor
+
+    def is_built(self):
+        """Returns True once every SearchMatches object has been loaded."""
+        return self.built_at is not None
+
+    def build_step(self, seconds=None):
+        """Loads the next part of the snapshot from the datastore.
+
+        Args:
+          seconds: Roughly how long to spend.  If None, we keep going
+            until the snapshot is built.
+
+        Returns:
+          True if the snapshot is now built.
+        """
+        if self.is_built():
+            return True
+        now = time.time()
+        deadline = None
+        if seconds is not None:
+            deadline = now + seconds
+        with self._write_lock:
+            if self._build_started is None:
+                self._build_started = now
+            num_loaded, self._build_cursor = self._load(
+                models.SearchMatches.all(), self._build_cursor, deadline)
+            self._num_loaded += num_loaded
+            if self._build_cursor is not None:
+                return False
+            self._publish_terms()
+            # A build may span many requests.  SearchMatches written
+            # since it started can be behind our cursor and yet older
+            # than the newest timestamp we saw, so the refresh below
+            # must start from the time the build began.
+            started = datetime.datetime.utcfromtimestamp(self._build_started)
+            if (self.high_water_mark is None
+                or self.high_water_mark > started):
+                self.high_water_mark = started
+        self.refresh()
+        self.built_at = time.time()
+        self.build_seconds = self.built_at - self._build_started
+        log.info("Built search index snapshot from %d SearchMatches "
+                 "in %.2fs: %r", self._num_loaded, self.build_seconds,
+                 self.stats())
+        return True
+
+    def build(self):
+        """Loads every SearchMatches object from the datastore."""
+        self.build_step()
+
+    def refresh(self):
+        """Picks up any SearchMatches written since the last refresh."""
+        query = models.SearchMatches.all()
+        if self.high_water_mark is not None:
+            # We use >= rather than > so that objects saved in the
+            # same instant as our newest one are not missed.  Applying
+            # the same object twice is harmless.
+            query.filter("timestamp >=", self.high_water_mark)
+        query.order("timestamp")
+        with self._write_lock:
+            self._load(query)
+            self._publish_terms()
+        self.refreshed_at = time.time()
+
+    def _components(self, term, entity_kind, field):
+        by_kind_field = self._postings.get(term)
+        if not by_kind_field:
+            return []
+        components = []
+        for (kind, fld), plist in by_kind_field.iteritems():
+            if entity_kind and kind != entity_kind:
+                continue
+            if field and fld != field:
+                continue
+            components.append((fld, plist))
+        return components
+
+    def _terms_in_range(self, low, high, max_terms=None):
+        terms = self._terms
+        start = bisect.bisect_left(terms, low)
+        end = bisect.bisect_left(terms, high)
+        if max_terms is not None:
+            end = min(end, start + max_terms)
+        return terms[start:end]
+
+    def _posting_counts(self, term):
+        return dict((kind_field, len(plist)) for kind_field, plist
+                    in self._postings.get(term, {}).iteritems())
+
+    def prefix_dictionary(self):
+        """Returns a PrefixDictionary over the snapshot's terms."""
+        pdict = self._prefix_dict
+        if pdict is None:
+            # Building under the write lock means that no refresh can
+            # change the terms half way through, or throw the
+            # dictionary away before we have stored it.
+            with self._write_lock:
+                pdict = self._prefix_dict
+                if pdict is None:
+                    pdict = self._prefix_dict = prefix_dict.PrefixDictionary(
+                        self._terms, self._posting_counts)
+        return pdict
+
+    def count_terms(self, term_prefix, max_terms=None):
+        """Returns how many terms start with a prefix, up to max_terms."""
+        return len(self._terms_in_range(term_prefix, term_prefix + u"\uffff",
+                                        max_terms))
+
+    def count_prefix(self, term_prefix, entity_kind=None, field=None):
+        """Returns roughly how many matches there are for a prefix.
+
+        This is zero if and only if nothing matches.  Otherwise it is
+        an estimate: see PrefixDictionary.count(), and note that the
+        counts are not updated every time a posting list grows or
+        shrinks.
+        """
+        return self.prefix_dictionary().count(term_prefix, entity_kind, field)
+
+    def term_components(self, term, entity_kind=None, field=None, end=None):
+        """Returns the (field, posting list) pairs matching a term.
+
+        The arguments have the same meaning as those of
+        search.fetch_keys_for_one_term.
+        """
+        if not end:
+            return self._components(term, entity_kind, field)
+        components = []
+        for t in self._terms_in_range(term, end + u"\uffff"):
+            components.extend(self._components(t, entity_kind, field))
+        return components
+
+    def prefix_components(self, term_prefix, entity_kind=None, field=None,
+                          max_terms=None):
+        """Returns the (field, posting list) pairs matching a term prefix.
+
+        If max_terms is given, the prefix is expanded to at most that
+        many terms, taken in sorted order.
+        """
+        components = []
+        for t in self._terms_in_range(term_prefix, term_prefix + u"\uffff",
+                                      max_terms):
+            components.extend(self._components(t, entity_kind, field))
+        return components
+
+    def doc_key(self, doc_id):
+        """Returns the db.Key for a document id."""
+        return self._doc_keys[doc_id]
+
+    def _to_keys(self, components):
+        matches = set()
+        for fld, plist in components:
+            matches.update((self._doc_keys[i], fld) for i in plist)
+        return matches
+
+    def keys_for_term(self, term, entity_kind=None, field=None, end=None):
+        """Like search.fetch_keys_for_one_term, but served from memory."""
+        return self._to_keys(
+            self.term_components(term, entity_kind, field, end))
+
+    def keys_for_prefix(self, term_prefix, entity_kind=None, field=None):
+        """Like search.fetch_keys_for_one_prefix, but served from memory."""
+        return self._to_keys(
+            self.prefix_components(term_prefix, entity_kind, field))
+
+    def memory_footprint(self):
+        """Returns a rough estimate of the snapshot's size in bytes."""
+        terms = self._terms
+        total = sys.getsizeof(terms) + sys.getsizeof(self._postings)
+        for term in terms:
+            total += sys.getsizeof(term)
+        # values() takes a copy, so a concurrent refresh cannot change
+        # the dict while we walk it.
+        for by_kind_field in self._postings.values():
+            total += sys.getsizeof(by_kind_field)
+            for plist in by_kind_field.itervalues():
+                total += sys.getsizeof(plist)
+        total += sys.getsizeof(self._doc_keys) + sys.getsizeof(self._doc_ids)
+        # db.Key objects are small wrappers; count their encoded size.
+        for key in list(self._doc_keys):
+            total += len(str(key))
+        return total
+
+    def stats(self):
+        """Returns a dict describing the size and age of the snapshot."""
+        num_postings = sum(len(plist)
+                           for by_kind_field in self._postings.values()
+                           for plist in by_kind_field.itervalues())
+        return {
+            "generations": list(self.generations),
+            "num_terms": len(self._terms),
+            "num_docs": len(self._doc_keys),
+            "num_postings": num_postings,
+            "memory_bytes": self.memory_footprint(),
+            "build_seconds": self.build_seconds,
+            "high_water_mark": self.high_water_mark,
+        }
+
+
+_snapshot = None
+# A snapshot being built to replace _snapshot.
+_pending = None
+_snapshot_lock = threading.Lock()
+
+
+def is_enabled():
+    """Returns True if searches should be served from a snapshot."""
+    return getattr(settings, "DJDB_SEARCH_SNAPSHOT", False)
+
+
+def _advance_build(generations, seconds):
+    # Must be called with _snapshot_lock held.
+    global _snapshot, _pending
+    pending = _pending
+    if pending is None or pending.generations != generations:
+        pending = _pending = IndexSnapshot(*generations)
+    if not pending.build_step(seconds):
+        return None
+    _snapshot = pending
+    _pending = None
+    return pending
+
+
+def get_snapshot(*generations):
+    """Returns this instance's index snapshot, or None.
+
+    None means that the search should use the datastore: snapshots are
+    disabled, or this instance has no snapshot of the given generations
+    yet.  A search that finds the snapshot missing or older than
+    MAX_SNAPSHOT_AGE spends up to BUILD_SLICE_SECONDS on building its
+    replacement, and keeps using the old one until that is ready.  If
+    another thread is already building or refreshing, we return the
+    current snapshot rather than waiting.
+    """
+    if not is_enabled():
+        return None
+    snap = _snapshot
+    if snap is not None and snap.generations != generations:
+        snap = None
+    now = time.time()
+    if (snap is not None and now - snap.refreshed_at < REFRESH_INTERVAL
+        and now - snap.built_at <= MAX_SNAPSHOT_AGE):
+        return snap
+    if not _snapshot_lock.acquire(False):
+        return snap
+    try:
+        if snap is None or now - snap.built_at > MAX_SNAPSHOT_AGE:
+            snap = _advance_build(generations, BUILD_SLICE_SECONDS) or snap
+        if snap is not None and now - snap.refreshed_at >= REFRESH_INTERVAL:
+            snap.refresh()
+    finally:
+        _snapshot_lock.release()
+    return snap
+
+
+def build_snapshot(*generations):
+    """Builds this instance's snapshot of the given generations.
+
+    This is meant for warmup requests, which no user is waiting on.
+    We give up after WARMUP_BUILD_SECONDS; searches then finish the
+    build bit by bit.
+
+    Returns:
+      The snapshot, or None if it is disabled or not built yet.
+    """
+    if not is_enabled():
+        return None
+    _snapshot_lock.acquire()
+    try:
+        snap = _snapshot
+        if snap is not None and snap.generations == generations:
+            return snap
+        return _advance_build(generations, WARMUP_BUILD_SECONDS)
+    finally:
+        _snapshot_lock.release()
+
+
+def _live_snapshots():
+    return [snap for snap in (_snapshot, _pending) if snap is not None]
+
+
+def note_saved(search_matches):
+    """Applies freshly-written SearchMatches to this instance's snapshot.
+
+    This lets an instance see its own index writes immediately, rather
+    than on the next refresh.
+    """
+    search_matches = list(search_matches)
+    for snap in _live_snapshots():
+        snap.apply(search_matches)
+
+
+def note_deleted(search_matches):
+    """Removes deleted SearchMatches from this instance's snapshot."""
+    keys = [sm.key() for sm in search_matches if sm.is_saved()]
+    for snap in _live_snapshots():
+        snap.forget(keys)
+
+
+def reset():
+    """Throws away this instance's snapshot."""
+    global _snapshot, _pending
+    _snapshot = _pending = None
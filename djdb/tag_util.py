@@ -19,6 +19,7 @@ from datetime import datetime, timedelta
 
 from google.appengine.ext import db
 
+from djdb import catalog
 from djdb import models
 from djdb import search
 from common.autoretry import AutoRetry
@@ -49,6 +50,8 @@ def modify_tags_and_save(user, obj, to_add, to_remove):
     # The two objects are in the same entity group, so saving them
     # is an all-or-nothing operation.
     AutoRetry(db).save([obj, tag_edit])
+    # Track tags are listed in the artist's catalog.
+    catalog.invalidate_for([obj])
     
     # Update search indexer.
     idx = search.Indexer(obj.parent_key())
@@ -0,0 +1,87 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+import datetime
+import unittest
+
+from google.appengine.api import memcache
+
+from djdb import catalog
+from djdb import models
+from djdb import search
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        idx = search.Indexer()
+        self.artist = models.Artist(name=u"Eno, Brian",
+                                    parent=idx.transaction,
+                                    key_name="catalog-art1")
+        idx.add_artist(self.artist)
+        self.tracks = []
+        for album_id, title, label in ((1, u"Another Green World", u"EG"),
+                                       (2, u"Before And After Science",
+                                        u"Polydor")):
+            album = models.Album(title=title,
+                                 album_id=album_id,
+                                 label=label,
+                                 import_timestamp=datetime.datetime.now(),
+                                 album_artist=self.artist,
+                                 num_tracks=1,
+                                 parent=idx.transaction)
+            idx.add_album(album)
+            track = models.Track(ufid="catalog-%d" % album_id,
+                                 album=album,
+                                 sampling_rate_hz=44110,
+                                 bit_rate_kbps=192,
+                                 channels="joint_stereo",
+                                 duration_ms=456,
+                                 title=title.split()[-1],
+                                 track_num=1,
+                                 parent=idx.transaction)
+            idx.add_track(track)
+            self.tracks.append(track)
+        idx.save()
+
+    def tearDown(self):
+        assert memcache.flush_all()
+        for kind in (models.SearchMatches, models.Track, models.Album,
+                     models.Artist):
+            for x in kind.all().fetch(1000):
+                x.delete()
+
+    def test_artist_tracks(self):
+        tracks = catalog.artist_tracks(self.artist.key())
+        self.assertEqual([u"Science", u"World"],
+                         [t['song'] for t in tracks])
+        self.assertEqual(u"Before And After Science", tracks[0]['album'])
+        self.assertEqual(u"Polydor", tracks[0]['label'])
+        self.assertEqual(str(self.tracks[1].key()), tracks[0]['song_key'])
+        self.assertEqual(str(self.tracks[1].album.key()),
+                         tracks[0]['album_key'])
+        self.assertEqual([], tracks[0]['song_tags'])
+        # The catalog is now cached, and looking it up by a string key
+        # finds the same entry.
+        self.assertEqual(1, memcache.get_stats()['items'])
+        self.assertEqual(tracks,
+                         catalog.artist_tracks(str(self.artist.key())))
+
+        # Editing a track throws the catalog away.
+        catalog.invalidate_for([self.tracks[0]])
+        self.assertEqual(0, memcache.get_stats()['items'])
@@ -0,0 +1,123 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+import unittest
+
+from django.test.client import Client
+import fudge
+from google.appengine.ext import db
+
+from djdb import compaction
+from djdb import models
+from djdb import search
+from djdb import search_index
+
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [db.Key.from_path("kind_dummy", "key%02d" % i)
+                     for i in range(12)]
+        # "foo" is spread over four objects, "bar" over one.
+        for i in range(4):
+            self.add_matches("foo", self.keys[i::4])
+        self.add_matches("bar", self.keys)
+
+    def tearDown(self):
+        for kind in (models.SearchMatches, models.IndexCompaction):
+            for x in kind.all().fetch(1000):
+                x.delete()
+
+    def add_matches(self, term, keys):
+        sm = models.SearchMatches(generation=search._GENERATION,
+                                  entity_kind="kind_dummy",
+                                  field="field",
+                                  term=term)
+        sm.matches.extend(keys)
+        sm.save()
+        return sm
+
+    def test_fragmentation(self):
+        query = models.SearchMatches.all()
+        self.assertEqual(
+            3, compaction.fragmentation(query.filter("term =", "foo")))
+        query = models.SearchMatches.all()
+        self.assertEqual(
+            0, compaction.fragmentation(query.filter("term =", "bar")))
+
+    @fudge.patch('djdb.compaction.taskqueue')
+    def test_sweep(self, taskqueue):
+        taskqueue.provides('add')
+        run = compaction.start()
+        self.assertEqual(None, compaction.start())
+
+        original_batch_size = compaction.SCAN_BATCH_SIZE
+        compaction.SCAN_BATCH_SIZE = 3
+        try:
+            for _ in xrange(10):
+                run = compaction.do_work(run.key().id())
+                if run.is_done:
+                    break
+        finally:
+            compaction.SCAN_BATCH_SIZE = original_batch_size
+        self.assertTrue(run.is_done)
+        # The second batch is all "foo", so the scan skips straight past
+        # the rest of its objects.
+        self.assertEqual(4, run.num_rows_scanned)
+        self.assertEqual(2, run.num_terms_scanned)
+        self.assertEqual(1, run.num_terms_compacted)
+        self.assertEqual(4, run.rows_before)
+        self.assertEqual(1, run.rows_after)
+        self.assertEqual(4.0, run.read_amplification_before)
+        self.assertEqual(1.0, run.read_amplification_after)
+
+        query = models.SearchMatches.all().filter("term =", "foo")
+        self.assertEqual(1, query.count())
+        self.assertEqual(set(self.keys), set(query.get().matches))
+        self.assertEqual(None, compaction.do_work(run.key().id()))
+        self.assertEqual("done", compaction.status()["phase"])
+
+    @fudge.patch('djdb.compaction.taskqueue')
+    def test_sweep_deletes_old_emptied_matches(self, taskqueue):
+        taskqueue.provides('add')
+        self.add_matches("baz", [])
+        run = compaction.start()
+        original_tombstone_seconds = search_index.TOMBSTONE_SECONDS
+        search_index.TOMBSTONE_SECONDS = -60
+        try:
+            while run is not None and not run.is_done:
+                run = compaction.do_work(run.key().id())
+        finally:
+            search_index.TOMBSTONE_SECONDS = original_tombstone_seconds
+        self.assertEqual(1, run.num_rows_reaped)
+        query = models.SearchMatches.all().filter("term =", "baz")
+        self.assertEqual(0, query.count())
+
+    @fudge.patch('djdb.compaction.taskqueue')
+    def test_cron_and_task_urls_need_no_login(self, taskqueue):
+        taskqueue.expects('add').with_args(url=compaction.TASK_URL,
+                                           name=fudge.any_value(),
+                                           params=fudge.any_value())
+        # Neither cron nor task queue requests carry a CHIRP login.
+        response = Client().get("/djdb/task/compact_index",
+                                HTTP_X_APPENGINE_CRON="true")
+        self.assertEqual(200, response.status_code)
+        run = models.IndexCompaction.get_latest()
+        response = Client().post(compaction.TASK_URL,
+                                 {"run": run.key().id()},
+                                 HTTP_X_APPENGINE_QUEUENAME="default")
+        self.assertEqual(200, response.status_code)
@@ -0,0 +1,130 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+import datetime
+import unittest
+
+from django.test.client import Client
+import fudge
+
+from djdb import models
+from djdb import reindex
+from djdb import search
+
+
+class ReindexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        idx = search.Indexer()
+        self.artist = models.Artist(name=u"Eno, Brian",
+                                    parent=idx.transaction,
+                                    key_name="reindex-art1")
+        self.album = models.Album(title=u"Another Green World",
+                                  album_id=67890,
+                                  label=u"Some Label",
+                                  import_timestamp=datetime.datetime.now(),
+                                  album_artist=self.artist,
+                                  num_tracks=1,
+                                  parent=idx.transaction)
+        self.track = models.Track(ufid="reindex-1",
+                                  album=self.album,
+                                  sampling_rate_hz=44110,
+                                  bit_rate_kbps=192,
+                                  channels="joint_stereo",
+                                  duration_ms=456,
+                                  title=u"Sky Saw",
+                                  track_num=1,
+                                  parent=idx.transaction)
+        idx.add_artist(self.artist)
+        idx.add_album(self.album)
+        idx.add_track(self.track)
+        idx.save()
+
+    def tearDown(self):
+        search.reset_generations()
+        for kind in (models.SearchMatches, models.ReindexState,
+                     models.Track, models.Album, models.Artist):
+            for x in kind.all().fetch(1000):
+                x.delete()
+
+    def run_to_completion(self):
+        for _ in xrange(20):
+            state = reindex.do_work()
+            if state.is_done:
+                return state
+        self.fail("Reindex did not finish")
+
+    @fudge.patch('djdb.reindex.taskqueue')
+    def test_reindex(self, taskqueue):
+        taskqueue.provides('add')
+        old_matches = search.fetch_keys_for_query_string(u"eno")
+        state = reindex.start()
+        self.assertEqual(search._GENERATION + 1, state.new_generation)
+        # While the rebuild runs we read from both generations and
+        # write to the new one.
+        self.assertEqual(((search._GENERATION, state.new_generation),
+                          state.new_generation),
+                         search.get_generations())
+        self.assertRaises(reindex.ReindexInProgress, reindex.start)
+
+        state = self.run_to_completion()
+        self.assertEqual(3, state.num_indexed)
+        self.assertTrue(state.num_deleted > 0)
+        self.assertEqual(((state.new_generation,), state.new_generation),
+                         search.get_generations())
+        self.assertEqual(
+            set([state.new_generation]),
+            set(sm.generation for sm in models.SearchMatches.all()))
+        self.assertEqual(old_matches,
+                         search.fetch_keys_for_query_string(u"eno"))
+        self.assertEqual(
+            {self.track.key(): set(["title"])},
+            search.fetch_keys_for_query_string(u"sky", entity_kind="Track"))
+
+        # A second rebuild starts from the generation the first built.
+        state = reindex.start()
+        self.assertEqual(search._GENERATION + 2, state.new_generation)
+
+    def test_task_url_needs_no_login(self):
+        # Task queue requests carry no CHIRP login.
+        response = Client().post(reindex.TASK_URL,
+                                 HTTP_X_APPENGINE_QUEUENAME="default")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("ok", response.content)
+
+    @fudge.patch('djdb.reindex.taskqueue')
+    def test_reindex_keeps_edited_fields(self, taskqueue):
+        taskqueue.provides('add')
+        various = models.Artist(name=u"Various Artists",
+                                key_name="reindex-art2")
+        various.put()
+        idx = search.Indexer(self.track.parent_key())
+        self.track.current_tags = [u"Ambient"]
+        idx.add_key(self.track.key(), "tag", u"Ambient")
+        idx.update_track(self.track, {"pronunciation": u"Skye Sah",
+                                      "track_artist": various})
+        idx.save()
+        query = u"ambient skye various"
+        self.assertEqual(
+            {self.track.key(): set(["tag", "pronunciation", "track_artist"])},
+            search.fetch_keys_for_query_string(query, entity_kind="Track"))
+
+        reindex.start()
+        self.run_to_completion()
+        self.assertEqual(
+            {self.track.key(): set(["tag", "pronunciation", "track_artist"])},
+            search.fetch_keys_for_query_string(query, entity_kind="Track"))
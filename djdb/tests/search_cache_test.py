@@ -0,0 +1,145 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+import datetime
+import unittest
+
+from django.conf import settings
+
+from google.appengine.api import memcache
+
+from common import prefetch
+from common.lru import LRUCache
+from djdb import models
+from djdb import search
+from djdb import search_cache
+
+
+class SearchCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        assert memcache.flush_all()
+        settings.DJDB_SEARCH_CACHE = True
+        search_cache._local = LRUCache(search_cache.LOCAL_CAPACITY)
+        search_cache._autocomplete = LRUCache(
+            search_cache.AUTOCOMPLETE_CAPACITY)
+        idx = search.Indexer()
+        self.artist = models.Artist(name=u"beatles", parent=idx.transaction,
+                                    key_name="sc-art1")
+        idx.add_artist(self.artist)
+        idx.save()
+
+    def tearDown(self):
+        settings.DJDB_SEARCH_CACHE = False
+        assert memcache.flush_all()
+        for x in models.SearchMatches.all().fetch(limit=1000):
+            x.delete()
+
+    def test_make_key(self):
+        parsed = search._parse_query_string(u"foo bar*")
+        key = search_cache.make_key(parsed, entity_kind="Artist")
+        # The order of the query parts does not matter.
+        self.assertEqual(
+            key,
+            search_cache.make_key(search._parse_query_string(u"bar* foo"),
+                                  entity_kind="Artist"))
+        self.assertNotEqual(
+            key, search_cache.make_key(parsed, entity_kind="Album"))
+        search_cache.invalidate()
+        self.assertNotEqual(
+            key, search_cache.make_key(parsed, entity_kind="Artist"))
+        settings.DJDB_SEARCH_CACHE = False
+        self.assertEqual(None, search_cache.make_key(parsed))
+
+    def test_results_are_cached_until_invalidated(self):
+        matches = search.simple_music_search(u"beat*")
+        self.assertEqual([self.artist.key()],
+                         [a.key() for a in matches["Artist"]])
+        self.assertEqual(1, search_cache.stats()["local"]["misses"])
+
+        # Entities are always loaded fresh, even on a cache hit.
+        self.artist.revoked = True
+        self.artist.save()
+        matches = search.simple_music_search(u"beat*")
+        self.assertEqual(1, search_cache.stats()["local"]["hits"])
+        self.assertTrue(matches["Artist"][0].revoked)
+
+        # Once the cache is invalidated the revoked artist disappears.
+        search_cache.invalidate()
+        self.assertEqual({}, search.simple_music_search(u"beat*"))
+
+    def test_results_found_soon_after_invalidation_are_kept_briefly(self):
+        parsed = search._parse_query_string(u"beat*")
+        key = search_cache.make_key(parsed)
+        search_cache.invalidate()
+        recent_key = search_cache.make_key(parsed)
+        self.assertNotEqual(key, recent_key)
+        search.simple_music_search(u"beat*")
+        search.simple_music_search(u"beat*")
+        self.assertEqual(1, search_cache.stats()["local"]["hits"])
+        # Once snapshots have caught up, the search is run again.
+        memcache.delete(search_cache.RECENTLY_INVALIDATED_KEY)
+        self.assertNotEqual(recent_key, search_cache.make_key(parsed))
+        search.simple_music_search(u"beat*")
+        self.assertEqual(2, search_cache.stats()["local"]["misses"])
+
+    def test_autocomplete_refines_earlier_results(self):
+        def complete(typed):
+            return [a.key() for a in search.autocomplete_search(
+                typed, "Artist", max_num_results=25)]
+
+        self.assertEqual([self.artist.key()], complete(u"bea"))
+        self.assertEqual(1, search_cache.stats()["local"]["misses"])
+        # Longer prefixes are answered from the candidates for "bea"
+        # without searching again.
+        self.assertEqual([self.artist.key()], complete(u"beat"))
+        self.assertEqual([self.artist.key()], complete(u"beatles "))
+        self.assertEqual([], complete(u"beaz"))
+        self.assertEqual(1, search_cache.stats()["local"]["misses"])
+        self.assertEqual(4, search_cache.stats()["autocomplete"]["size"])
+
+        # Forbidden terms are checked in memory too.
+        self.assertEqual([], complete(u"bea* -beatles"))
+        self.assertEqual(1, search_cache.stats()["local"]["misses"])
+
+        # Anything else runs a new search.
+        self.assertEqual([], complete(u"zzz"))
+        self.assertEqual(2, search_cache.stats()["local"]["misses"])
+
+    def test_autocomplete_reads_references_in_one_batch(self):
+        idx = search.Indexer()
+        album = models.Album(title=u"beat box", album_id=1234,
+                             import_timestamp=datetime.datetime.now(),
+                             album_artist=self.artist, num_tracks=2,
+                             parent=idx.transaction)
+        idx.add_album(album)
+        for i in range(2):
+            idx.add_track(models.Track(ufid="sc-trk%d" % i, album=album,
+                                       sampling_rate_hz=44110,
+                                       bit_rate_kbps=128, channels="mono",
+                                       duration_ms=123,
+                                       title=u"beat %d" % i,
+                                       track_num=i + 1,
+                                       parent=idx.transaction))
+        idx.save()
+        before = prefetch.rpcs_saved()
+        tracks = search.autocomplete_search(u"beat", "Track",
+                                            max_num_results=25)
+        self.assertEqual(2, len(tracks))
+        # The tracks' album, and then its artist, were each read once
+        # for both tracks.
+        self.assertEqual(before + 2, prefetch.rpcs_saved())
@@ -0,0 +1,338 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the 'License');
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an 'AS IS' BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+import unittest
+
+from django.conf import settings
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from common.lru import LRUCache
+from djdb import models
+from djdb import postings
+from djdb import prefix_dict
+from djdb import search
+from djdb import search_cache
+from djdb import search_index
+
+
+class PostingsTestCase(unittest.TestCase):
+
+    def test_from_ids(self):
+        self.assertEqual([1, 3, 7], list(postings.from_ids([7, 3, 1, 3])))
+        self.assertEqual([], list(postings.from_ids([])))
+
+    def test_union(self):
+        a = postings.from_ids([1, 5, 9])
+        b = postings.from_ids([2, 5, 10])
+        self.assertEqual([1, 2, 5, 9, 10], list(postings.union([a, b])))
+        # A single list is returned as-is.
+        self.assertTrue(postings.union([a]) is a)
+        self.assertEqual([], list(postings.union([])))
+
+    def test_intersect_and_difference(self):
+        a = postings.from_ids(range(0, 1000, 3))
+        b = postings.from_ids([0, 5, 6, 500, 501, 999, 2000])
+        self.assertEqual([0, 6, 501, 999], list(postings.intersect(a, b)))
+        self.assertEqual([0, 6, 501, 999], list(postings.intersect(b, a)))
+        self.assertEqual([5, 500, 2000], list(postings.difference(b, a)))
+        self.assertEqual([], list(postings.intersect(a, postings.EMPTY)))
+
+    def test_execute(self):
+        band = [("name", postings.from_ids(range(100))),
+                ("title", postings.from_ids(range(50, 150)))]
+        rare = [("title", postings.from_ids([7, 60, 500]))]
+        live = [("title", postings.from_ids([7]))]
+        self.assertEqual({7: set(["name", "title"]),
+                          60: set(["name", "title"])},
+                         postings.execute([band, rare], []))
+        self.assertEqual({60: set(["name", "title"])},
+                         postings.execute([rare, band], [live]))
+        self.assertEqual({}, postings.execute([band, []], []))
+        self.assertEqual({}, postings.execute([], [live]))
+
+
+class PrefixDictionaryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        counts = {
+            u"alaska": {("kind_Foo", "f1"): 1},
+            u"alpha": {("kind_Foo", "f1"): 2, ("kind_Bar", "f2"): 1},
+            u"beta": {("kind_Foo", "f1"): 1},
+            u"delta": {("kind_Bar", "f2"): 1},
+        }
+        self.pdict = prefix_dict.PrefixDictionary(sorted(counts),
+                                                  counts.get)
+
+    def test_expand(self):
+        self.assertEqual([u"alaska", u"alpha"], self.pdict.expand(u"al"))
+        self.assertEqual([u"alaska"], self.pdict.expand(u"al", max_terms=1))
+        self.assertEqual([], self.pdict.expand(u"z"))
+
+    def test_count(self):
+        self.assertEqual(4, self.pdict.count(u"al"))
+        self.assertEqual(1, self.pdict.count(u"al", entity_kind="kind_Bar"))
+        self.assertEqual(3, self.pdict.count(u"al", field="f1"))
+        self.assertEqual(6, self.pdict.count(u""))
+        self.assertEqual(0, self.pdict.count(u"z"))
+        self.assertEqual(0, self.pdict.count(u"b", entity_kind="kind_Bar"))
+
+
+class IndexSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.key1 = db.Key.from_path("kind_Foo", "key1")
+        self.key2 = db.Key.from_path("kind_Foo", "key2")
+        self.key3 = db.Key.from_path("kind_Bar", "key3")
+        idx = search.Indexer()
+        idx.add_key(self.key1, "f1", u"alpha beta")
+        idx.add_key(self.key2, "f2", u"alpha delta")
+        idx.add_key(self.key3, "f1", u"alaska gamma")
+        idx.save()
+
+    def tearDown(self):
+        search_index.reset()
+        for x in models.SearchMatches.all().fetch(limit=1000):
+            x.delete()
+
+    def test_snapshot_matches_datastore(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        for term in (u"alpha", u"beta", u"alaska", u"nosuchterm"):
+            self.assertEqual(search.fetch_keys_for_one_term(term),
+                             snap.keys_for_term(term))
+            self.assertEqual(
+                search.fetch_keys_for_one_term(term, entity_kind="kind_Foo"),
+                snap.keys_for_term(term, entity_kind="kind_Foo"))
+        for prefix in (u"al", u"alp", u"d", u"z"):
+            self.assertEqual(search.fetch_keys_for_one_prefix(prefix),
+                             snap.keys_for_prefix(prefix))
+            self.assertEqual(
+                search.fetch_keys_for_one_prefix(prefix, field="f2"),
+                snap.keys_for_prefix(prefix, field="f2"))
+
+    def test_query_string_matches_datastore(self):
+        queries = (u"alpha", u"al*", u"alpha -beta", u"al* -gamma",
+                   u"alpha beta", u"f2:alpha", u"nosuchterm alpha")
+        expected = [search.fetch_keys_for_query_string(q) for q in queries]
+        settings.DJDB_SEARCH_SNAPSHOT = True
+        try:
+            actual = [search.fetch_keys_for_query_string(q) for q in queries]
+        finally:
+            settings.DJDB_SEARCH_SNAPSHOT = False
+        self.assertEqual(expected, actual)
+
+    def test_count_prefix(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        self.assertEqual(3, snap.count_prefix(u"al"))
+        self.assertEqual(2, snap.count_prefix(u"al", entity_kind="kind_Foo"))
+        self.assertEqual(0, snap.count_prefix(u"zz"))
+        # The dictionary is rebuilt when terms come or go.
+        snap.forget(sm.key() for sm in
+                    models.SearchMatches.all().filter("term =", u"alaska"))
+        self.assertEqual(2, snap.count_prefix(u"al"))
+        self.assertEqual(0, snap.count_prefix(u"al", entity_kind="kind_Bar"))
+        # It is kept when a posting list merely grows...
+        pdict = snap.prefix_dictionary()
+        idx = search.Indexer()
+        idx.add_key(db.Key.from_path("kind_Foo", "key4"), "f1", u"alpha")
+        idx.save()
+        snap.refresh()
+        self.assertTrue(snap.prefix_dictionary() is pdict)
+        # ...but not when a term turns up in a new kind or field.
+        idx = search.Indexer()
+        idx.add_key(db.Key.from_path("kind_Bar", "key5"), "f1", u"alpha")
+        idx.save()
+        snap.refresh()
+        self.assertEqual(1, snap.count_prefix(u"al", entity_kind="kind_Bar"))
+
+    def test_refresh_picks_up_new_matches(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        self.assertEqual(set(), snap.keys_for_term(u"omega"))
+        key4 = db.Key.from_path("kind_Bar", "key4")
+        idx = search.Indexer()
+        idx.add_key(key4, "f1", u"omega alpha")
+        idx.save()
+        snap.refresh()
+        self.assertEqual(set([(key4, "f1")]), snap.keys_for_term(u"omega"))
+        self.assertEqual(4, len(snap.keys_for_term(u"alpha")))
+
+    def test_refresh_picks_up_removed_matches(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        settings.DJDB_SEARCH_SNAPSHOT = True
+        try:
+            idx = search.Indexer()
+            idx.remove_key(self.key3, "f1", u"alaska gamma")
+            idx.save()
+        finally:
+            settings.DJDB_SEARCH_SNAPSHOT = False
+        # The emptied SearchMatches are kept so that other instances'
+        # snapshots find out about them.
+        query = models.SearchMatches.all().filter("term =", u"alaska")
+        self.assertEqual([[]], [sm.matches for sm in query])
+        snap.refresh()
+        self.assertEqual(set(), snap.keys_for_term(u"alaska"))
+        self.assertEqual(set(), snap.keys_for_prefix(u"gam"))
+
+    def test_forget(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        snap.forget(sm.key() for sm in
+                    models.SearchMatches.all().filter("term =", u"beta"))
+        self.assertEqual(set(), snap.keys_for_term(u"beta"))
+        self.assertEqual(3, len(snap.keys_for_prefix(u"al")))
+        # Terms with nothing left in them are dropped.
+        self.assertEqual(4, snap.stats()["num_terms"])
+        self.assertEqual([], snap.prefix_components(u"be"))
+
+    def test_updates_do_not_change_what_readers_hold(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        components = snap.term_components(u"alpha")
+        terms = snap.prefix_dictionary().expand(u"")
+        key4 = db.Key.from_path("kind_Bar", "key4")
+        idx = search.Indexer()
+        idx.add_key(key4, "f3", u"alpha omega")
+        idx.save()
+        snap.refresh()
+        snap.forget(sm.key() for sm in
+                    models.SearchMatches.all().filter("term =", u"beta"))
+        # A search that is part way through still sees the snapshot
+        # as it was when it started.
+        self.assertEqual(2, len(components))
+        self.assertEqual([u"alaska", u"alpha", u"beta", u"delta", u"gamma"],
+                         terms)
+        self.assertEqual(3, len(snap.term_components(u"alpha")))
+        self.assertEqual([u"alaska", u"alpha", u"delta", u"gamma", u"omega"],
+                         snap.prefix_dictionary().expand(u""))
+
+    def test_other_generations_are_ignored(self):
+        sm = models.SearchMatches(generation=search._GENERATION + 1,
+                                  entity_kind="kind_Foo",
+                                  field="f1",
+                                  term=u"zeta")
+        sm.matches.append(self.key1)
+        sm.save()
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        self.assertEqual(set(), snap.keys_for_term(u"zeta"))
+
+    def test_get_snapshot_builds_a_slice_at_a_time(self):
+        generations = (search._GENERATION,)
+        old_batch_size = search_index._BATCH_SIZE
+        old_slice = search_index.BUILD_SLICE_SECONDS
+        settings.DJDB_SEARCH_SNAPSHOT = True
+        search_index._BATCH_SIZE = 1
+        search_index.BUILD_SLICE_SECONDS = 0
+        try:
+            # Each call loads one SearchMatches and then gives up,
+            # leaving the search to use the datastore.
+            for i in range(6):
+                self.assertEqual(None,
+                                 search_index.get_snapshot(*generations))
+            snap = search_index.get_snapshot(*generations)
+            self.assertEqual(3, len(snap.keys_for_prefix(u"al")))
+            # An outdated snapshot is used until its replacement is
+            # ready.
+            snap.built_at -= search_index.MAX_SNAPSHOT_AGE + 1
+            self.assertTrue(search_index.get_snapshot(*generations) is snap)
+        finally:
+            settings.DJDB_SEARCH_SNAPSHOT = False
+            search_index._BATCH_SIZE = old_batch_size
+            search_index.BUILD_SLICE_SECONDS = old_slice
+
+    def test_build_snapshot(self):
+        generations = (search._GENERATION,)
+        self.assertEqual(None, search_index.build_snapshot(*generations))
+        settings.DJDB_SEARCH_SNAPSHOT = True
+        try:
+            snap = search_index.build_snapshot(*generations)
+            self.assertTrue(snap.is_built())
+            self.assertTrue(search_index.get_snapshot(*generations) is snap)
+        finally:
+            settings.DJDB_SEARCH_SNAPSHOT = False
+
+    def test_stats(self):
+        snap = search_index.IndexSnapshot(search._GENERATION)
+        snap.build()
+        stats = snap.stats()
+        self.assertEqual(5, stats["num_terms"])
+        self.assertEqual(3, stats["num_docs"])
+        self.assertEqual(6, stats["num_postings"])
+        self.assertTrue(stats["memory_bytes"] > 0)
+        self.assertTrue(stats["build_seconds"] >= 0)
+        self.assertTrue(stats["high_water_mark"] is not None)
+
+
+class SnapshotSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        settings.DJDB_SEARCH_SNAPSHOT = True
+        idx = search.Indexer()
+        for key_name, name in (("sn-art1", u"beatles"),
+                               ("sn-art2", u"beatnuts")):
+            idx.add_artist(models.Artist(name=name, parent=idx.transaction,
+                                         key_name=key_name))
+        idx.save()
+        search.build_snapshot()
+
+    def tearDown(self):
+        settings.DJDB_SEARCH_SNAPSHOT = False
+        search_index.reset()
+        for x in models.SearchMatches.all().fetch(limit=1000):
+            x.delete()
+
+    def get_names(self, query_str):
+        matches = search.simple_music_search(query_str,
+                                             entity_kind="Artist")
+        return sorted(a.name for a in matches["Artist"])
+
+    def test_search(self):
+        self.assertNotEqual(None,
+                            search_index.get_snapshot(search._GENERATION))
+        self.assertEqual([u"beatles", u"beatnuts"], self.get_names(u"beat*"))
+        self.assertEqual([u"beatles"], self.get_names(u"beat* -beatnuts"))
+
+    def test_new_entities_are_found_right_away(self):
+        idx = search.Indexer()
+        idx.add_artist(models.Artist(name=u"beat happening",
+                                     parent=idx.transaction,
+                                     key_name="sn-art3"))
+        idx.save()
+        self.assertEqual([u"beat happening", u"beatles", u"beatnuts"],
+                         self.get_names(u"beat*"))
+
+    def test_truncated_prefix_results_are_not_cached(self):
+        assert memcache.flush_all()
+        search_cache._local = LRUCache(search_cache.LOCAL_CAPACITY)
+        search_cache._autocomplete = LRUCache(
+            search_cache.AUTOCOMPLETE_CAPACITY)
+        settings.DJDB_SEARCH_CACHE = True
+        original_max_prefix_expansion = search._MAX_PREFIX_EXPANSION
+        search._MAX_PREFIX_EXPANSION = 1
+        try:
+            self.assertEqual([u"beatles"], self.get_names(u"beat*"))
+            search.autocomplete_search(u"beat", "Artist", max_num_results=25)
+            self.assertEqual(0, search_cache.stats()["local"]["size"])
+            self.assertEqual(0, search_cache.stats()["autocomplete"]["size"])
+        finally:
+            search._MAX_PREFIX_EXPANSION = original_max_prefix_expansion
+            settings.DJDB_SEARCH_CACHE = False
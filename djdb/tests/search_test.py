@@ -27,47 +27,44 @@ from djdb import search
 
 class SearchHelpersTestCase(unittest.TestCase):
 
-    def test_discard_items(self):
-        items = range(10)
-        # Check the common case.
-        self.assertEqual(search._discard_items(items, 3), 3)
-        self.assertEqual(len(items), 7)
-        # Check discarding 0 items.
-        self.assertEqual(search._discard_items(items, 0), 0)
-        self.assertEqual(len(items), 7)
-        # Check discarding a negative number of items.
-        self.assertEqual(search._discard_items(items, -17), 0)
-        self.assertEqual(len(items), 7)
-        # Check discarding more items than actually exist.
-        self.assertEqual(search._discard_items(items, 100), 7)
-        self.assertEqual(len(items), 0)
-        # Check discarding from None.
-        self.assertEqual(search._discard_items(None, 17), 0)
-
-    def test_enforce_results_limit_on_matches(self):
-        matches = {"Artist": range(10), "Album": range(10), "Track": range(10)}
-        # If the max_num_results is larger than the total number of matches,
-        # do nothing.
-        search._enforce_results_limit_on_matches(matches, 100)
-        self.assertEqual(30, sum(len(x) for x in matches.values()))
-        # If the max_num_results is None, do nothing.
-        search._enforce_results_limit_on_matches(matches, None)
-        self.assertEqual(30, sum(len(x) for x in matches.values()))
-        # Track objects are the first to go.
-        search._enforce_results_limit_on_matches(matches, 25)
-        self.assertEqual(25, sum(len(x) for x in matches.values()))
-        self.assertEqual(5, len(matches["Track"]))
-        # Next we start dropping Album objects.
-        search._enforce_results_limit_on_matches(matches, 12)
-        self.assertEqual(12, sum(len(x) for x in matches.values()))
-        self.assertEqual(2, len(matches["Album"]))
-        # Empty lists are dropped entirely.
-        self.assertTrue("Track" not in matches)
-        # Artists are the last to go.
-        search._enforce_results_limit_on_matches(matches, 5)
-        self.assertEqual(5, sum(len(x) for x in matches.values()))
-        self.assertEqual(5, len(matches["Artist"]))
-        self.assertEqual(1, len(matches))
+    def test_is_stop_word_prefix(self):
+        for prefix in (u"", u"t", u"th", u"the", u"an", u"my"):
+            self.assertTrue(search._is_stop_word_prefix(prefix))
+        for prefix in (u"thee", u"x", u"ant"):
+            self.assertFalse(search._is_stop_word_prefix(prefix))
+
+    def test_is_refinement(self):
+        parse = search._parse_query_string
+        for old, new in ((u"meta*", u"metal*"),
+                         (u"meta*", u"metal"),
+                         (u"meta*", u"meta*"),
+                         (u"led zep*", u"led zeppelin"),
+                         (u"led", u"led zep*"),
+                         (u"label:dra*", u"label:drag*"),
+                         (u"foo* -bar", u"food* -bar")):
+            self.assertTrue(search._is_refinement(parse(old), parse(new)),
+                            (old, new))
+        for old, new in ((u"metal*", u"meta*"),
+                         (u"metal", u"metall*"),
+                         (u"label:dra*", u"drag*"),
+                         (u"foo* -bar", u"food*"),
+                         (u"year:1970-1979", u"year:1970-1979")):
+            self.assertFalse(search._is_refinement(parse(old), parse(new)),
+                             (old, new))
+
+    def test_rank_match(self):
+        artist = db.Key.from_path("Artist", "a")
+        album = db.Key.from_path("Album", "b")
+        track_by_title = db.Key.from_path("Track", "c")
+        track_by_artist = db.Key.from_path("Track", "d")
+        ranked = sorted(
+            [(track_by_artist, set(["artist"])),
+             (album, set(["label"])),
+             (track_by_title, set(["title"])),
+             (artist, set(["name"]))],
+            key=lambda (k, f): search._rank_match(k, f))
+        self.assertEqual([artist, album, track_by_title, track_by_artist],
+                         [k for k, _ in ranked])
 
 
 class SearchTestCase(unittest.TestCase):
@@ -223,6 +220,40 @@ class SearchTestCase(unittest.TestCase):
 
         self.assertEqual(0, len(search.fetch_keys_for_one_prefix("unknown")))
 
+        # Queries run concurrently come back in the order they were given.
+        self.assertEqual(
+            [set([(key1, "f1")]),
+             set([(key2, "f2"), (key4, "f2")]),
+             set()],
+            search._fetch_all_async([search._term_query("beta"),
+                                     search._prefix_query("al", field="f2"),
+                                     search._term_query("unknown")]))
+
+    def test_update_and_remove_key(self):
+        key1 = db.Key.from_path("kind_Foo", "key1")
+        key2 = db.Key.from_path("kind_Foo", "key2")
+        idx = search.Indexer()
+        idx.add_key(key1, "f1", u"alpha beta")
+        idx.add_key(key2, "f1", u"alpha")
+        idx.save()
+
+        idx = search.Indexer()
+        idx.update_key(key1, "f1", u"alpha beta", u"alpha gamma")
+        idx.remove_key(key2, "f1", u"alpha")
+        # Nothing changes until we save.
+        self.assertEqual(set([(key1, "f1")]),
+                         search.fetch_keys_for_one_term("beta"))
+        idx.save()
+
+        self.assertEqual(set([(key1, "f1")]),
+                         search.fetch_keys_for_one_term("alpha"))
+        self.assertEqual(set(), search.fetch_keys_for_one_term("beta"))
+        self.assertEqual(set([(key1, "f1")]),
+                         search.fetch_keys_for_one_term("gamma"))
+        # Emptied SearchMatches are deleted rather than saved.
+        for sm in models.SearchMatches.all():
+            self.assertTrue(sm.matches)
+
     def test_search_using_queries(self):
         key1 = db.Key.from_path("kind_Foo", "key1")
         key2 = db.Key.from_path("kind_Foo", "key2")
@@ -434,6 +465,86 @@ class SearchTestCase(unittest.TestCase):
             expected,
             search.fetch_keys_for_query_string(u"fire"))
 
+        # The compilation's tracks can be looked up by title and artist.
+        self.assertEqual(
+            [alb3.key()],
+            [alb.key() for alb in models.CompilationTrackLookup.find_albums(
+                u"love  hangover", u"DIANA ROSS")])
+        self.assertEqual(
+            None, models.CompilationTrackLookup.find_albums(u"Mansion",
+                                                            u"Fall, The"))
+
+        # Renaming a track moves it to a new lookup.
+        idx = search.Indexer(alb3.parent_key())
+        idx.update_track(trk3[1], {"title": u"Love Hangover (Remix)"})
+        idx.save()
+        self.assertEqual(
+            None, models.CompilationTrackLookup.find_albums(u"Love Hangover",
+                                                            u"Diana Ross"))
+        self.assertEqual(
+            [alb3.key()],
+            [alb.key() for alb in models.CompilationTrackLookup.find_albums(
+                u"Love Hangover (Remix)", u"Diana Ross")])
+
+        # Autocomplete checks refinements against the same terms.
+        self.assertEqual(frozenset([u"diana", u"ross"]),
+                         search._entity_terms(trk3[1])["track_artist"])
+
+    def test_substring_search(self):
+        self.assertEqual(u"st elmos fire",
+                         search.ngram_text(u"St. Elmo's  Fire!"))
+        idx = search.Indexer()
+        art = models.Artist(name=u"Eno, Brian", parent=idx.transaction,
+                            key_name="ngram-art1")
+        alb = models.Album(title=u"Another Green World",
+                           album_id=67891,
+                           import_timestamp=datetime.datetime.now(),
+                           album_artist=art,
+                           num_tracks=3,
+                           parent=idx.transaction)
+        trks = []
+        for i, track_title in enumerate(
+            (u"St. Elmo's Fire", u"Over Fire Island", u"Sky Saw")):
+            trks.append(models.Track(ufid="ngram-%d" % i,
+                                     album=alb,
+                                     sampling_rate_hz=44110,
+                                     bit_rate_kbps=192,
+                                     channels="joint_stereo",
+                                     duration_ms=123,
+                                     title=track_title,
+                                     track_num=i+1,
+                                     parent=idx.transaction))
+        idx.add_artist(art)
+        idx.add_album(alb)
+        for t in trks:
+            idx.add_track(t)
+        idx.save()
+
+        self.assertEqual(None, search.fetch_keys_for_substring(u"fi"))
+        self.assertEqual(set([trks[0].key(), trks[1].key()]),
+                         search.fetch_keys_for_substring(u"FIRE"))
+        # Substrings can span words.
+        self.assertEqual([trks[1].key()],
+                         [t.key() for t in
+                          search.substring_search(u"re isl", 10)])
+        self.assertEqual([trks[0].key()],
+                         [t.key() for t in
+                          search.substring_search(u"elmos", 10)])
+        self.assertEqual([], search.substring_search(u"fire sky", 10))
+        # N-grams never show up in ordinary searches.
+        self.assertEqual({}, search.fetch_keys_for_query_string(u"fir"))
+
+        # Renaming a track replaces its n-grams.
+        idx = search.Indexer(trks[2].parent_key())
+        idx.update_track(trks[2], {"title": u"Sombre Reptiles"})
+        idx.save()
+        self.assertEqual(set(), search.fetch_keys_for_substring(u"sky saw"))
+        self.assertEqual([trks[2].key()],
+                         [t.key() for t in
+                          search.substring_search(u"e rep", 10)])
+        for x in [art, alb] + trks:
+            x.delete()
+
     def test_index_optimization(self):
         # Create a bunch of test keys.
         test_keys = [db.Key.from_path("kind_dummy", "key%02d" % i)
@@ -479,6 +590,27 @@ class SearchTestCase(unittest.TestCase):
         query = models.SearchMatches.all().filter("term =", "the")
         self.assertEqual(0, query.count())
 
+    def test_index_optimization_splits_large_segments(self):
+        test_keys = [db.Key.from_path("kind_dummy", "key%04d" % i)
+                     for i in range(search.MAX_MATCHES_PER_SHARD + 10)]
+        sm = models.SearchMatches(generation=search._GENERATION,
+                                  entity_kind="kind_dummy",
+                                  field="field",
+                                  term="foo")
+        sm.matches.extend(test_keys)
+        sm.save()
+        # One oversized object is split into two shards.
+        self.assertEqual(-1, search.optimize_index("foo"))
+        query = models.SearchMatches.all().filter("term =", "foo")
+        shards = query.fetch(999)
+        self.assertEqual([search.MAX_MATCHES_PER_SHARD, 10],
+                         sorted((len(sm.matches) for sm in shards),
+                                reverse=True))
+        self.assertEqual(set(test_keys),
+                         set(k for sm in shards for k in sm.matches))
+        # Optimizing again leaves the shards alone.
+        self.assertEqual(0, search.optimize_index("foo"))
+
 
 class SearchTestCaseWithData(SearchTestCase):
     
@@ -533,3 +665,64 @@ class SearchTestCaseWithData(SearchTestCase):
 
         
         
+
+    def test_tied_results_are_chosen_by_name(self):
+        idx = search.Indexer()
+        idx.add_artist(models.Artist(name=u"beat happening",
+                                     parent=idx.transaction,
+                                     key_name="ss-art4"))
+        idx.save()
+        for max_num_results in (1, 2):
+            matches = search.simple_music_search(
+                u"beat*", max_num_results=max_num_results,
+                entity_kind="Artist")
+            self.assertEqual(
+                [u"beat happening", u"beatles"][:max_num_results],
+                [a.name for a in matches["Artist"]])
+
+    def test_reviewed_searches(self):
+        reviewer = models.User(email="ss-reviewer@test.com",
+                               first_name="Test", last_name="Reviewer")
+        reviewer.put()
+        other = models.User(email="ss-other@test.com",
+                            first_name="Other", last_name="Reviewer")
+        other.put()
+        idx = search.Indexer()
+        beatles = [a for a in models.Artist.all()
+                   if a.name == u"beatles"][0]
+        album = models.Album(title=u"beat city",
+                             album_id=4321,
+                             import_timestamp=datetime.datetime.now(),
+                             album_artist=beatles,
+                             num_tracks=0,
+                             is_reviewed=True,
+                             parent=idx.transaction)
+        idx.add_album(album)
+        idx.save()
+        beatles.is_reviewed = True
+        beatles.save()
+        doc = models.Document(parent=album, subject=album, author=reviewer,
+                              doctype=models.DOCTYPE_REVIEW)
+        doc.put()
+        try:
+            matches = search.simple_music_search(u"beat*", reviewed=True)
+            self.assertEqual([beatles.key()],
+                             [a.key() for a in matches["Artist"]])
+            self.assertEqual([album.key()],
+                             [a.key() for a in matches["Album"]])
+
+            for max_num_results in (None, 10):
+                matches = search.simple_music_search(
+                    u"beat*", max_num_results=max_num_results,
+                    user_key=str(reviewer.key()))
+                self.assertEqual([beatles.key()],
+                                 [a.key() for a in matches["Artist"]])
+                self.assertEqual([album.key()],
+                                 [a.key() for a in matches["Album"]])
+                matches = search.simple_music_search(
+                    u"beat*", max_num_results=max_num_results,
+                    user_key=str(other.key()))
+                self.assertFalse(any(matches.values()))
+        finally:
+            for x in (doc, album, reviewer, other):
+                x.delete()
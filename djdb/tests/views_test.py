@@ -617,6 +617,10 @@ class ReviewViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         doc = db.get(doc_key)
         self.assertEqual(doc, None)
+        # That was the only review, so the album is no longer reviewed.
+        album = db.get(album.key())
+        self.assertEqual(0, album.num_reviews)
+        self.assertFalse(album.is_reviewed)
 
     
 class CommentViewsTestCase(TestCase):
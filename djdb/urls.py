@@ -138,4 +138,15 @@ urlpatterns = patterns(
 
     # Web hook for index optimization
     (r'_hooks/optimize_index', 'djdb.hooks.optimize_index'),
+    (r'_hooks/index_snapshot_stats', 'djdb.hooks.index_snapshot_stats'),
+    (r'_hooks/search_cache_stats', 'djdb.hooks.search_cache_stats'),
+    (r'_hooks/reindex/start', 'djdb.hooks.start_reindex'),
+    (r'_hooks/reindex/status', 'djdb.hooks.reindex_status'),
+    (r'_hooks/compact_index/status', 'djdb.hooks.index_compaction_status'),
+
+    # Task queue and cron handlers, which the auth middleware lets
+    # through.
+    (r'^task/reindex$', 'djdb.hooks.reindex_work'),
+    (r'^task/compact_index/work$', 'djdb.hooks.index_compaction_work'),
+    (r'^task/compact_index$', 'djdb.hooks.start_index_compaction'),
 )
@@ -21,7 +21,7 @@ from functools import partial
 import logging
 import re
 
-from google.appengine.api import datastore_errors, memcache
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 from django import forms
 from django import http
@@ -31,15 +31,19 @@ from auth.decorators import require_role
 from auth import roles
 from common import dbconfig, sanitize_html, pager
 from common.autoretry import AutoRetry
+from common.prefetch import prefetch_references
 from common.time_util import chicago_now
 from common.utilities import as_json
+from djdb import catalog
 from djdb import models
 from djdb import search
+from djdb import search_cache
 from djdb import review
 from djdb import comment
 from djdb import forms
 from djdb.models import Album
-from playlists.models import chirp_playlist_key, PlaylistEvent, PlaylistTrack
+from playlists.models import (chirp_playlist_key, PlaylistEvent,
+                              recently_played)
 from playlists.views import PlaylistEventView
 from datetime import datetime, timedelta
 import djdb.pylast as pylast
@@ -313,6 +317,8 @@ def reviews_page(request, ctx_vars=None):
     return http.HttpResponse(template.render(ctx))
 
 def get_played_tracks(events):
+    events = list(events)
+    prefetch_references(events, ['selector', 'artist', 'track', 'album'])
     played_tracks = []
     prev_dt = None
     tracks = []
@@ -477,13 +483,10 @@ def artist_search_for_autocomplete(request):
                                             request.GET.get('q', ''),
                                             'Artist')        
     response = http.HttpResponse(mimetype="text/plain")
-    start_dt = datetime.now() - timedelta(seconds=LAST_PLAYED_SECONDS)
+    recent = recently_played(LAST_PLAYED_SECONDS)
     for ent in matching_entities:
         # Check if track played recently. 
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('artist =', ent.key())
-        if query.count() > 0:
+        if ent.key() in recent['artist']:
             error = "Track from artist already played within the last %d hours." % LAST_PLAYED_HOURS
         else:
             error = ''
@@ -496,13 +499,10 @@ def album_search_for_autocomplete(request):
                                             'Album')        
     response = http.HttpResponse(mimetype="text/plain")
     unique_entities = set()
-    start_dt = datetime.now() - timedelta(seconds=LAST_PLAYED_SECONDS)
+    recent = recently_played(LAST_PLAYED_SECONDS)
     for ent in matching_entities:
         # Check if track played recently. 
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('album =', ent.key())
-        if query.count() > 0:
+        if ent.key() in recent['album']:
             error = "Track from album already played within the last %d hours." % LAST_PLAYED_HOURS
         else:
             error = ''
@@ -523,46 +523,6 @@ def label_search_for_autocomplete(request):
     return response
 
 
-_unsearchable_chars = re.compile(r'[^a-zA-Z ]')
-
-def _searchable(s):
-    """A search-friendly version of s without punctuation, etc."""
-    return _unsearchable_chars.sub('', s).lower()
-
-
-def _search_artist_tracks(artist=None, artist_key=None):
-    assert artist or artist_key, 'Incorrect arguments'
-    tracks = []
-    ak = artist_key or artist.key()
-    key = '_search_artist_tracks.%s' % ak
-    try:
-        cached = memcache.get(key)
-    except:
-        cached = None
-        log.exception('getting from memcache')
-
-    if cached:
-        tracks = cached
-    else:
-        if not artist:
-            artist = models.Artist.get(artist_key)
-        albums = list(db.Query(models.Album, keys_only=True)
-                      .filter('album_artist =', artist))
-        q = models.Track.all().filter('album IN', albums).order('title')
-        for t in q:
-            tracks.append({'song': t.title,
-                           'song_key': str(t.key()),
-                           'song_tags': t.current_tags,
-                           'album': t.album.title,
-                           'album_key': str(t.album.key()),
-                           'label': t.album.label})
-        try:
-            memcache.set(key, tracks, time=60 * 4)
-        except:
-            log.exception('setting memcache')
-    return tracks
-
-
 @as_json
 def track_search(request):
     matches = []
@@ -577,14 +537,18 @@ def track_search(request):
                                                 'Artist')
             for artist in results:
                 artists.append({'artist': artist.pretty_name,
-                                'artist_key': str(artist.key()),
-                                'artist_object': artist})
+                                'artist_key': str(artist.key())})
+    song = request.GET.get('song')
     if len(artists):
         if len(artists) == 1:
             artist = artists[0]
-            kw = dict(artist=artist.get('artist_object'),
-                      artist_key=artist.get('artist_key'))
-            for data in _search_artist_tracks(**kw):
+            if song:
+                # Do a substring search within the artist's tracks,
+                # which the catalog already holds in memory.
+                needle = search.ngram_text(song)
+            for data in catalog.artist_tracks(artist['artist_key']):
+                if song and needle not in search.ngram_text(data['song']):
+                    continue
                 d = {'artist': artist['artist'],
                      'artist_key': artist['artist_key'],
                      'song': data['song'],
@@ -593,17 +557,26 @@ def track_search(request):
                      'album': data['album'],
                      'album_key': data['album_key'],
                      'label': data['label']}
-                if request.GET.get('song'):
-                    # Do a substring search within tracks:
-                    t = request.GET['song']
-                    if _searchable(t) in _searchable(data['song']):
-                        matches.append(d)
-                else:
-                    matches.append(d)
+                matches.append(d)
 
         for artist in artists:
             matches.append({'artist': artist['artist'],
                             'artist_key': artist['artist_key']})
+    elif song and not request.GET.get('artist'):
+        # No artist given, so search every track in the library.
+        for track in search.substring_search(song, max_num_results=25):
+            if track.track_artist:
+                artist = track.track_artist
+            else:
+                artist = track.album.album_artist
+            matches.append({'artist': track.artist_name,
+                            'artist_key': artist and str(artist.key()),
+                            'song': track.title,
+                            'song_key': str(track.key()),
+                            'song_tags': track.current_tags,
+                            'album': track.album.title,
+                            'album_key': str(track.album.key()),
+                            'label': track.album.label})
     return {'matches': matches}
 
 
@@ -686,6 +659,7 @@ def artist_revoke(request, artist_name):
         for track in album.track_set:
             track.revoked = True
             AutoRetry(track).save()
+    search_cache.invalidate()
 
     ctx_vars = {}    
     response_page = request.GET.get('response_page')
@@ -722,6 +696,7 @@ def artist_unrevoke(request, artist_name):
         for track in album.track_set:
             track.revoked = False
             AutoRetry(track).save()
+    search_cache.invalidate()
 
     ctx_vars = {}    
     response_page = request.GET.get('response_page')
@@ -880,6 +855,7 @@ def track_revoke(request, track_key):
     if track:
         track.revoked = True
         AutoRetry(track).save()
+        search_cache.invalidate()
     else:
         return http.HttpResponse(status=404)
     
@@ -910,6 +886,7 @@ def track_unrevoke(request, track_key):
     if track:
         track.revoked = False
         AutoRetry(track).save()
+        search_cache.invalidate()
     else:
         return http.HttpResponse(status=404)
     
@@ -1154,7 +1131,7 @@ def track_search_for_autocomplete(request):
     artist_key = request.GET.get('artist_key', None)
     
     response = http.HttpResponse(mimetype="text/plain")
-    start_dt = datetime.now() - timedelta(seconds=LAST_PLAYED_SECONDS)
+    recent = recently_played(LAST_PLAYED_SECONDS)
     for track in matching_entities:
         if artist_key:
             # skip this track if it doesn't match the 
@@ -1172,10 +1149,7 @@ def track_search_for_autocomplete(request):
                     continue
 
         # Check if track played recently. 
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('track =', track.key())
-        if query.count() > 0:
+        if track.key() in recent['track']:
             error = "Track already played within the last %d hours." % LAST_PLAYED_HOURS
         else:
             error = ''
@@ -1190,17 +1164,10 @@ def _get_matches_for_partial_entity_search(query, entity_kind):
         # conserve resources and refuse to perform a keyword 
         # search if query is less than 3 characters.
         return []
-    # If the query string doesn't end in whitespace,
-    # append star to match partial artist names.
+    # Partial names are matched as prefixes,
     #       e.g. ?q=metalli will become "metalli*" to match Metallica
-    if not query[-1].isspace():
-        query = "%s*" % query
-    matches = search.simple_music_search(query, max_num_results=25,
-                                         entity_kind=entity_kind)
-    if matches:
-        return matches.get(entity_kind, [])
-    else:
-        return []
+    # and each keystroke refines the results of the one before.
+    return search.autocomplete_search(query, entity_kind, max_num_results=25)
 
 def _get_album_or_404(album_id_str):
     if not album_id_str.isdigit():
@@ -1332,6 +1299,7 @@ def album_revoke(request, album_id_str):
     for track in album.track_set:
         track.revoked = True
         AutoRetry(track).save()
+    search_cache.invalidate()
 
     ctx_vars = {}    
     response_page = request.GET.get('response_page')
@@ -1366,6 +1334,7 @@ def album_unrevoke(request, album_id_str):
     for track in album.track_set:
         track.revoked = False
         AutoRetry(track).save()
+    search_cache.invalidate()
 
     ctx_vars = {}    
     response_page = request.GET.get('response_page')
@@ -1486,6 +1455,8 @@ def album_edit_review(request, album_id_str, review_key=None):
                     # They are both in the same entity group, so this write
                     # is atomic.
                     AutoRetry(db).put(items)
+                # Reviews affect "reviewed" searches.
+                search_cache.invalidate()
                 
                 # Update album info.
                 if request.user.is_music_director or request.user.is_reviewer:
@@ -1520,7 +1491,25 @@ def album_delete_review(request, album_id_str, review_key=None):
     if request.POST.get('confirm'):
         AutoRetry(doc).delete()
         album.num_reviews -= 1
-        AutoRetry(album).save()
+        items = [album]
+        if album.num_reviews <= 0:
+            # "Reviewed only" searches go by the is_reviewed flags, so
+            # clear them along with the album's last review.
+            album.is_reviewed = False
+            for track in album.track_set:
+                track.is_reviewed = False
+                items.append(track)
+            artist = album.album_artist
+            if not album.is_compilation and artist.is_reviewed:
+                query = db.Query(models.Album, keys_only=True)
+                query.filter("album_artist =", artist)
+                query.filter("is_reviewed =", True)
+                if not [key for key in AutoRetry(query).fetch(2)
+                        if key != album.key()]:
+                    artist.is_reviewed = False
+                    items.append(artist)
+        AutoRetry(db).save(items)
+        search_cache.invalidate()
     return album_info_page(request, album_id_str)
     
 def album_edit_comment(request, album_id_str, comment_key=None):
@@ -1926,24 +1915,15 @@ def send_to_playlist(request, key):
 
     # Check if item played recently.
     error = ''
-    start_dt = datetime.now() - timedelta(seconds=LAST_PLAYED_SECONDS)
+    recent = recently_played(LAST_PLAYED_SECONDS)
     if track_key != '':
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('track =', track_key)
-        if query.count() > 0:
+        if track_key in recent['track']:
             error = "Track already played within the last %d hours." % LAST_PLAYED_HOURS
     if error == '' and album_key != '':
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('album =', album_key)
-        if query.count() > 0:
+        if album_key in recent['album']:
             error = "Track from album already played within the last %d hours." % LAST_PLAYED_HOURS
     if error == '' and artist_key != '':
-        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key()) \
-                                   .filter('established >=', start_dt) \
-                                   .filter('artist =', artist_key)
-        if query.count() > 0:
+        if artist_key in recent['artist']:
             error = "Track from artist already played within the last %d hours." % LAST_PLAYED_HOURS
 
     response = '"%s / %s / %s / %s / %s / %s / %s / %s / %s / %s"' % (artist_name, artist_key, track_title, track_key, album_title, album_key, label, notes, categories, error)
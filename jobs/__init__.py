@@ -67,29 +67,18 @@ On the server, all you have to do is implement a worker method::
         if results is None:
             # build report headers:
             results = {
-                'file_lines': ["date, employee, hair_color"],
-                'last_offset': 0
+                'file_lines': ["date, employee, hair_color"]
             }
         
-        offset = results['last_offset']
-        last_offset = offset+10
-        results['last_offset'] = last_offset
+        for employees in iter_query_batches(Employee.all(), results):
+            for employee in employees:
+                results['file_lines'].append(",".join([
+                        str(datetime.datetime.now()),
+                        employee.name,
+                        employee.hair_color
+                    ]))
         
-        got_results = False
-        for employee in Employee.all()[ offset: last_offset ]:
-            got_results = True
-            results['file_lines'].append(",".join([
-                    str(datetime.datetime.now()),
-                    employee.name,
-                    employee.hair_color
-                ]))
-        
-        if not got_results:
-            finished = True
-        else:
-            finished = False
-        
-        return finished, results
+        return query_finished(results), results
     
     @job_product('build-playlist-report')
     def playlist_report_product(results):
@@ -97,9 +86,60 @@ On the server, all you have to do is implement a worker method::
         response = HttpResponse(content_type='text/csv; charset=utf-8')
         response.write(csv_file)
         return response
+
+Workers that walk a query should read it with iter_query_batches(), which
+picks up where the last request stopped by a datastore cursor rather than
+an offset.  Skipping over an offset costs as much as reading the rows, so
+paging through N rows with offsets costs O(N^2) reads.
+
+Workers whose product is a long file should pass it to write_output() a
+piece at a time rather than keeping it in their results.  Everything a
+worker keeps in its results is read and written again by every request,
+but each request's output is saved once, compressed, as a separate
+entity.  The product then reads it back with read_output().
+
+A job can also run on the task queue, without a browser driving it.
+Start it with the 'parallel' and 'params' fields::
+
+    $.ajax({
+        type: 'POST',
+        url: '/jobs/start',
+        data: {
+            'job_name': 'build-playlist-report',
+            'parallel': '1',
+            'params': JSON.stringify(params)
+        },
+        ...
+    });
+
+The job is split into shards by the worker's splitter (see job_worker),
+each shard runs as a chain of tasks, and once the last one finishes
+their results are merged.  Poll /jobs/progress/<job_key> until it says
+the job is finished, then fetch the product as usual.
         
 """
 
+from datetime import timedelta
+import time
+
+from common.autoretry import AutoRetry
+
+
+# How long each /jobs/work request may spend reading query batches.
+# This leaves plenty of the request deadline for the rest of the work
+# and for saving the job.
+WORK_SECONDS = 20
+
+MIN_BATCH_SIZE = 20
+MAX_BATCH_SIZE = 1000
+
+# The most shards split_date_range() will make.
+MAX_SHARDS = 10
+
+# The key in a job's results under which its new output is passed to
+# the framework, and its saved output to the product.
+OUTPUT = '_output'
+
 
 worker_registry = {}
 
@@ -140,7 +180,7 @@ def job_product(job_name, pre_request=None):
     return fn_decorator
 
 
-def job_worker(job_name, pre_request=None):
+def job_worker(job_name, pre_request=None, splitter=None, merger=None):
     """Decorator to register a function as a job worker.
     
     Example::
@@ -160,10 +200,26 @@ def job_worker(job_name, pre_request=None):
     returns an http response (any value but None), the response will be
     returned instead of the job work result.  This is useful for access
     restriction.
+
+    **splitter=None**
+    Optional callback that accepts the request params of a job run on
+    the task queue and returns a list of request params, one for each
+    shard to run in parallel.  For example, a report over a date range
+    can be split into shorter date ranges with split_date_range().
+    Without a splitter the job runs as a single shard.  The output of
+    the shards is joined in the order the splitter returned them.
+
+    **merger=None**
+    Optional callback that accepts the job's request params and a list
+    of the results of each shard, and returns the results to pass to
+    the job product.  Without a merger the product gets the results of
+    the first shard.
     """
     def fn_decorator(fn):
         worker_registry['workers'][job_name] = {'callback': fn,
-                                                'pre_request': pre_request}
+                                                'pre_request': pre_request,
+                                                'splitter': splitter,
+                                                'merger': merger}
         return fn
     return fn_decorator
 
@@ -180,3 +236,107 @@ def get_producer(job_name):
         raise LookupError(
             "No producer has been registered for job %r" % job_name)
     return worker_registry['producers'][job_name]
+
+
+def iter_query_batches(query, results, seconds=WORK_SECONDS):
+    """Yields the next batches of a query's entities for a job worker.
+
+    The position in the query is kept in results['query_state'], so each
+    call resumes where the last one stopped.  Batches are sized by how
+    quickly the worker got through the previous ones, so that the call
+    takes about the given number of seconds however much work each
+    entity is.  The time spent on a batch includes whatever the worker
+    does with it before asking for the next one.
+
+    Args:
+      query: A db.Query.  It must not use IN or != filters, which do not
+        support cursors.
+      results: The job's results dict; it must be saved with the job.
+      seconds: Roughly how long to keep yielding batches for.
+
+    Yields:
+      Lists of entities.  Use query_finished() afterwards to tell whether
+      the query has been read to the end.
+    """
+    state = results.setdefault('query_state', {})
+    if state.get('finished'):
+        return
+    started = time.time()
+    batch_size = state.get('batch_size', MIN_BATCH_SIZE)
+    while True:
+        if state.get('cursor'):
+            query.with_cursor(state['cursor'])
+        batch_started = time.time()
+        batch = AutoRetry(query).fetch(batch_size)
+        state['cursor'] = query.cursor()
+        if len(batch) < batch_size:
+            state['finished'] = True
+        if batch:
+            yield batch
+        if state.get('finished'):
+            return
+        now = time.time()
+        remaining = seconds - (now - started)
+        if remaining <= 0:
+            return
+        # Aim to finish the next batch in half of the time left, so a
+        # slow batch cannot overrun the request.
+        per_entity = max(now - batch_started, 0.001) / len(batch)
+        batch_size = int(remaining / 2 / per_entity)
+        batch_size = max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, batch_size))
+        state['batch_size'] = batch_size
+
+
+def query_finished(results):
+    """Returns True if iter_query_batches() has read its query to the end."""
+    return bool(results.get('query_state', {}).get('finished'))
+
+
+def write_output(results, data):
+    """Adds to a job's output.
+
+    The output is saved when the worker returns, and is not kept in its
+    results.
+
+    Args:
+      results: The results dict the worker will return.
+      data: A string.  Unicode strings are encoded as UTF-8.
+    """
+    results.setdefault(OUTPUT, []).append(data)
+
+
+def read_output(results):
+    """Returns an iterator over a finished job's output, for its product.
+
+    Args:
+      results: The results dict passed to the job product.
+
+    Returns:
+      An iterator of byte strings, in the order they were written.
+    """
+    return results.get(OUTPUT) or iter([])
+
+
+def split_date_range(from_date, to_date, max_shards=MAX_SHARDS):
+    """Splits a date range into shorter ones of about the same length.
+
+    Args:
+      from_date: The first day, a datetime.date.
+      to_date: The last day.
+      max_shards: The most ranges to return.
+
+    Returns:
+      A list of (from_date, to_date) tuples, earliest first, that
+      between them cover every day of the range once.
+    """
+    num_days = (to_date - from_date).days + 1
+    num_shards = max(1, min(max_shards, num_days))
+    ranges = []
+    start = from_date
+    for i in range(num_shards):
+        # Spread any leftover days over the first few ranges.
+        length = num_days // num_shards + (i < num_days % num_shards)
+        end = start + timedelta(days=length - 1)
+        ranges.append((start, end))
+        start = end + timedelta(days=1)
+    return ranges
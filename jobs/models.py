@@ -16,11 +16,128 @@
 ### limitations under the License.
 ###
 
+import itertools
+import zlib
 
 from google.appengine.ext import db
 
-class Job(db.Model):
+from common.autoretry import AutoRetry
+
+
+class _HasOutput(object):
+    """Output storage for Jobs and JobShards.
+
+    The entity must have a num_chunks property.
+    """
+
+    def put_with_output(self, output):
+        """Saves the entity, along with a new chunk of its output.
+
+        Both are written in one transaction, so the chunks always match
+        the worker state saved in the entity.
+
+        Args:
+          output: A byte string to add to the output.  If it is empty
+            only the entity is saved.
+        """
+        if not output:
+            AutoRetry(self).put()
+            return
+        index = self.num_chunks
+        chunk = JobResultChunk(parent=self,
+                               key_name=JobResultChunk.make_key_name(index),
+                               index=index,
+                               data=db.Blob(zlib.compress(output)))
+
+        def txn():
+            self.num_chunks = index + 1
+            db.put([self, chunk])
+        db.run_in_transaction(txn)
+
+    def iter_output(self):
+        """Yields the chunks of the output in order."""
+        query = JobResultChunk.all().ancestor(self).order('index')
+        for chunk in AutoRetry(query).run(batch_size=20):
+            yield zlib.decompress(chunk.data)
+
+    def _output_keys(self):
+        query = db.Query(JobResultChunk, keys_only=True).ancestor(self)
+        return list(AutoRetry(query).run())
+
+
+class Job(_HasOutput, db.Model):
     job_name = db.StringProperty(required=True)
     started = db.DateTimeProperty(auto_now_add=True)
     finished = db.DateTimeProperty()
-    result = db.TextProperty()
\ No newline at end of file
+    result = db.TextProperty()
+    # How many JobResultChunks of output the job has written.
+    num_chunks = db.IntegerProperty(default=0)
+    # The request parameters of a job run on the task queue.
+    params = db.TextProperty()
+    # How many JobShards a job run on the task queue was split into,
+    # and the indexes of the ones that have finished.
+    num_shards = db.IntegerProperty(default=0)
+    finished_shards = db.ListProperty(int)
+
+    def get_shards(self):
+        """Returns the job's JobShards in order."""
+        return AutoRetry(JobShard).get_by_key_name(
+            [JobShard.make_key_name(self.key(), i)
+             for i in range(self.num_shards)])
+
+    def iter_output(self):
+        """Yields the chunks of the job's output in order.
+
+        The output of a job run in shards is that of each shard in turn.
+        """
+        if not self.num_shards:
+            return _HasOutput.iter_output(self)
+        return itertools.chain.from_iterable(
+            shard.iter_output() for shard in self.get_shards() if shard)
+
+    def delete_with_output(self):
+        """Deletes the job, its shards and all of their output."""
+        keys = self._output_keys()
+        for shard in self.get_shards():
+            if shard is not None:
+                keys.extend(shard._output_keys())
+                keys.append(shard.key())
+        keys.append(self.key())
+        AutoRetry(db).delete(keys)
+
+
+class JobShard(_HasOutput, db.Model):
+    """A part of a job that runs on the task queue.
+
+    Shards are root entities rather than children of their Job so that
+    they can all be saved at once without contending for its entity
+    group.
+    """
+    job = db.ReferenceProperty(Job, required=True)
+    index = db.IntegerProperty(required=True)
+    # The request parameters to pass to the job's worker.
+    params = db.TextProperty()
+    result = db.TextProperty()
+    num_chunks = db.IntegerProperty(default=0)
+    # How many units of work the shard has done.
+    num_steps = db.IntegerProperty(default=0)
+    finished = db.DateTimeProperty()
+
+    @staticmethod
+    def make_key_name(job_key, index):
+        return '%s-%d' % (job_key, index)
+
+
+class JobResultChunk(db.Model):
+    """A compressed piece of a job's output.
+
+    Chunks are children of their Job or JobShard and are only ever
+    added, so each unit of work writes just its own output rather than
+    rewriting all of the output so far.
+    """
+    index = db.IntegerProperty(required=True)
+    data = db.BlobProperty(required=True)
+
+    @staticmethod
+    def make_key_name(index):
+        return '%08d' % index
@@ -18,18 +18,21 @@
 
 from unittest import TestCase
 import datetime
-from datetime import timedelta
+from datetime import date, timedelta
 
 from django.test import TestCase as DjangoTestCase
 from django.core.urlresolvers import reverse
 from django.utils import simplejson
 from django import http
+import fudge
 from nose.tools import eq_
 
 from auth import roles
 import jobs
-from jobs.models import Job
-from jobs import worker_registry, job_worker, job_product
+from jobs.models import Job, JobResultChunk, JobShard
+from jobs import (worker_registry, job_worker, job_product,
+                  iter_query_batches, query_finished, read_output,
+                  split_date_range, write_output)
 
 
 _worker_registry = {}
@@ -76,7 +79,7 @@ class JobTestCase(object):
 
 def teardown_data():
     for ob in Job.all():
-        ob.delete()
+        ob.delete_with_output()
     jobs._reset_registry()
 
 class TestJobModel(TestCase):
@@ -283,6 +286,185 @@ class TestJobsWithParams(JobSelfTestCase):
                          "Results from 2010-08-01 to 2010-08-31")
 
     
+class TestJobOutput(JobSelfTestCase):
+
+    def setUp(self):
+        assert self.client.login(email="test@test.com", roles=[roles.DJ])
+
+        @job_worker('writer')
+        def writer(data, request_params):
+            if data is None:
+                data = {'count': 0}
+            data['count'] += 1
+            write_output(data, u"line %d \u2713\n" % data['count'])
+            return data['count'] == 3, data
+
+        @job_product('writer')
+        def writer_product(data):
+            return http.HttpResponse(read_output(data))
+
+    def test_output_is_saved_in_chunks(self):
+        response = self.client.post(reverse('jobs.start'), {
+            'job_name': 'writer'
+        })
+        job_key = simplejson.loads(response.content)['job_key']
+        for i in range(3):
+            response = self.client.post(reverse('jobs.work'), {
+                'job_key': job_key
+            })
+            self.assert_json_success(simplejson.loads(response.content))
+
+        job = Job.get(job_key)
+        eq_(simplejson.loads(job.result), {'count': 3})
+        eq_(job.num_chunks, 3)
+        eq_(JobResultChunk.all().ancestor(job).count(), 3)
+
+        response = self.client.get(reverse('jobs.product', args=(job_key,)))
+        eq_(response.content.decode('utf8'),
+            u"line 1 \u2713\nline 2 \u2713\nline 3 \u2713\n")
+
+    def test_reaper_deletes_output(self):
+        job = Job(job_name='writer')
+        job.started = datetime.datetime.now() - timedelta(days=3)
+        job.put_with_output('old output')
+        eq_(JobResultChunk.all().count(), 1)
+
+        self.client.post(reverse('jobs.start'), {'job_name': 'writer'})
+        eq_(JobResultChunk.all().count(), 0)
+
+    
+class TestParallelJobs(JobSelfTestCase):
+
+    def setUp(self):
+        assert self.client.login(email="test@test.com", roles=[roles.DJ])
+
+        def splitter(params):
+            return [{'shard': i} for i in range(params['num_shards'])]
+
+        def merger(params, results):
+            return {'num_shards': params['num_shards'],
+                    'steps': [r['steps'] for r in results]}
+
+        @job_worker('sharded', splitter=splitter, merger=merger)
+        def sharded(data, request_params):
+            if data is None:
+                data = {'steps': 0}
+            data['steps'] += 1
+            write_output(data, "%d.%d\n" % (request_params['shard'],
+                                             data['steps']))
+            return data['steps'] == 2, data
+
+        @job_product('sharded')
+        def sharded_product(data):
+            return http.HttpResponse("".join(read_output(data)))
+
+    def start(self, num_shards):
+        response = self.client.post(reverse('jobs.start'), {
+            'job_name': 'sharded',
+            'parallel': '1',
+            'params': simplejson.dumps({'num_shards': num_shards})
+        })
+        json_response = simplejson.loads(response.content)
+        self.assert_json_success(json_response)
+        eq_(json_response['num_shards'], num_shards)
+        return json_response['job_key']
+
+    def run_shard(self, shard, step):
+        response = self.client.post(reverse('jobs.run_shard'), {
+            'shard_key': str(shard.key()),
+            'step': step
+        })
+        eq_(response.status_code, 200)
+
+    def progress(self, job_key):
+        response = self.client.get(reverse('jobs.progress', args=(job_key,)))
+        json_response = simplejson.loads(response.content)
+        self.assert_json_success(json_response)
+        return json_response
+
+    @fudge.patch('jobs.views.taskqueue')
+    def test_run_in_shards(self, fake_tq):
+        # One task to start each shard and one for its second step:
+        fake_tq.expects('add').times_called(6)
+        job_key = self.start(3)
+        shards = Job.get(job_key).get_shards()
+        eq_([shard.index for shard in shards], [0, 1, 2])
+
+        # Run the shards out of order.
+        for step in range(2):
+            for shard in reversed(shards):
+                self.run_shard(shard, step)
+            progress = self.progress(job_key)
+            eq_(progress['num_shards'], 3)
+            eq_(progress['num_shards_finished'], 3 * step)
+            eq_(progress['finished'], step == 1)
+
+        job = Job.get(job_key)
+        eq_(simplejson.loads(job.result), {'num_shards': 3,
+                                           'steps': [2, 2, 2]})
+        response = self.client.get(reverse('jobs.product', args=(job_key,)))
+        eq_(response.content, "0.1\n0.2\n1.1\n1.2\n2.1\n2.2\n")
+
+    @fudge.patch('jobs.views.taskqueue')
+    def test_repeated_tasks_are_ignored(self, fake_tq):
+        fake_tq.provides('add')
+        job_key = self.start(1)
+        shard = Job.get(job_key).get_shards()[0]
+        self.run_shard(shard, 0)
+        self.run_shard(shard, 0)
+        self.run_shard(shard, 1)
+        self.run_shard(shard, 1)
+        eq_(JobShard.get(shard.key()).num_steps, 2)
+        eq_(self.progress(job_key)['finished'], True)
+        response = self.client.get(reverse('jobs.product', args=(job_key,)))
+        eq_(response.content, "0.1\n0.2\n")
+
+    @fudge.patch('jobs.views.taskqueue')
+    def test_repeated_task_queues_the_next_step_again(self, fake_tq):
+        queued = []
+
+        def add(**kwargs):
+            queued.append((kwargs['name'], kwargs['params']['step']))
+
+        fake_tq.provides('add').calls(add)
+        job_key = self.start(1)
+        shard = Job.get(job_key).get_shards()[0]
+        self.run_shard(shard, 0)
+        # The first try may have saved step 0 and then failed to queue
+        # step 1.  The task name keeps step 1 from running twice.
+        self.run_shard(shard, 0)
+        eq_([step for name, step in queued], [0, 1, 1])
+        eq_(queued[1][0], queued[2][0])
+
+    @fudge.patch('jobs.views.taskqueue')
+    def test_reaper_deletes_shards(self, fake_tq):
+        fake_tq.provides('add')
+        job_key = self.start(2)
+        job = Job.get(job_key)
+        for shard in job.get_shards():
+            self.run_shard(shard, 0)
+        job.started = datetime.datetime.now() - timedelta(days=3)
+        job.put()
+        self.client.post(reverse('jobs.start'), {'job_name': 'sharded'})
+        eq_(JobShard.all().count(), 0)
+        eq_(JobResultChunk.all().count(), 0)
+
+
+class TestSplitDateRange(TestCase):
+
+    def test_split(self):
+        eq_(split_date_range(date(2011, 1, 1), date(2011, 1, 10),
+                             max_shards=3),
+            [(date(2011, 1, 1), date(2011, 1, 4)),
+             (date(2011, 1, 5), date(2011, 1, 7)),
+             (date(2011, 1, 8), date(2011, 1, 10))])
+
+    def test_short_range(self):
+        eq_(split_date_range(date(2011, 1, 1), date(2011, 1, 2)),
+            [(date(2011, 1, 1), date(2011, 1, 1)),
+             (date(2011, 1, 2), date(2011, 1, 2))])
+
+    
 class TestAccessRestriction(JobSelfTestCase):
     
     def setUp(self):
@@ -321,3 +503,41 @@ class TestAccessRestriction(JobSelfTestCase):
         response = self.client.get(reverse('jobs.product',
                                    args=[str(job.key())]))
         self.assertEqual(response.status_code, 403)
+
+
+class TestIterQueryBatches(TestCase):
+
+    def setUp(self):
+        for i in range(45):
+            Job(job_name='job-%02d' % i).put()
+
+    def tearDown(self):
+        teardown_data()
+
+    def read(self, results, seconds):
+        names = []
+        for batch in iter_query_batches(Job.all().order('job_name'),
+                                        results, seconds=seconds):
+            names.extend(job.job_name for job in batch)
+        # The results are stored as JSON between requests.
+        return names, simplejson.loads(simplejson.dumps(results))
+
+    def test_resumes_from_cursor(self):
+        results = {}
+        seen = []
+        calls = 0
+        while not query_finished(results):
+            calls += 1
+            assert calls < 10, "Query was never finished"
+            # With no time to spare, each call reads a single batch.
+            names, results = self.read(results, seconds=0)
+            seen.extend(names)
+        eq_(seen, ['job-%02d' % i for i in range(45)])
+        eq_(calls, 3)
+
+    def test_reads_more_batches_when_there_is_time(self):
+        names, results = self.read({}, seconds=60)
+        eq_(len(names), 45)
+        eq_(query_finished(results), True)
+        names, results = self.read(results, seconds=60)
+        eq_(names, [])
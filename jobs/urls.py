@@ -25,4 +25,6 @@ urlpatterns = patterns('jobs.views',
     url(r'^start$', 'start_job', name="jobs.start"),
     url(r'^work$', 'do_job_work', name="jobs.work"),
     url(r'^product/(.*)$', 'get_job_product', name="jobs.product"),
+    url(r'^progress/(.*)$', 'get_job_progress', name="jobs.progress"),
+    url(r'^task/run_shard$', 'run_job_shard', name="jobs.run_shard"),
 )
\ No newline at end of file
@@ -19,15 +19,23 @@
 import logging
 import datetime
 from datetime import timedelta
+import hashlib
 import traceback
 
 from django.conf import settings
+from django.core.urlresolvers import reverse
 from django.utils import simplejson
-from django.http import Http404
+from django.http import Http404, HttpResponse
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
 
-from common.utilities import as_json
-from jobs.models import Job
-from jobs import get_worker, get_producer
+from common.autoretry import AutoRetry
+from common.utilities import as_json, as_encoded_str
+from jobs.models import Job, JobShard
+from jobs import get_worker, get_producer, OUTPUT
+
+# The queue that runs the shards of jobs started with 'parallel'.
+SHARD_QUEUE = 'jobs'
 
 log = logging.getLogger()
 
@@ -44,7 +52,7 @@ def reap_dead_jobs():
     q = Job.all().filter("started <",
                          datetime.datetime.now() - timedelta(days=2))
     for job in q:
-        job.delete()
+        job.delete_with_output()
 
 
 def start_job(request):
@@ -59,15 +67,62 @@ def start_job(request):
         early_response = worker['pre_request'](request)
         if early_response is not None:
             return early_response
+    num_shards = 0
+    if request.POST.get('parallel'):
+        num_shards = _start_shards(job, worker,
+                                   request.POST.get('params', '{}'))
     @as_json
     def data(request):
         return {
             'job_key': str(job.key()),
+            'num_shards': num_shards,
             'success': True
         }
     return data(request)
 
 
+def _start_shards(job, worker, params):
+    job.params = params
+    params = simplejson.loads(params)
+    if worker['splitter']:
+        shard_params = worker['splitter'](params)
+    else:
+        shard_params = [params]
+    job.num_shards = len(shard_params)
+    shards = [JobShard(key_name=JobShard.make_key_name(job.key(), i),
+                       job=job,
+                       index=i,
+                       params=simplejson.dumps(p))
+              for i, p in enumerate(shard_params)]
+    AutoRetry(db).put(shards + [job])
+    for shard in shards:
+        _enqueue_shard(shard)
+    log.info('Started job %s in %d shards' % (job.job_name, len(shards)))
+    return len(shards)
+
+
+def _enqueue_shard(shard):
+    # Naming each task after the work done so far means that a retried
+    # task cannot fork the shard into two.
+    name = 'job-shard-%s-%d' % (hashlib.md5(str(shard.key())).hexdigest(),
+                                shard.num_steps)
+    try:
+        taskqueue.add(url=reverse('jobs.run_shard'), name=name,
+                      queue_name=SHARD_QUEUE,
+                      params={'shard_key': str(shard.key()),
+                              'step': shard.num_steps})
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        log.info('Job shard task %s already enqueued' % name)
+
+
+def _pop_output(result):
+    if not isinstance(result, dict):
+        return None
+    return ''.join(as_encoded_str(s, encoding='utf8')
+                   for s in result.pop(OUTPUT, []))
+
+
 def do_job_work(request):
     init_jobs()
     try:
@@ -84,8 +139,11 @@ def do_job_work(request):
             result_for_worker = None
         finished, result = worker['callback'](result_for_worker,
                                               simplejson.loads(params))
+        output = _pop_output(result)
         job.result = simplejson.dumps(result)
-        job.save()
+        if finished:
+            job.finished = datetime.datetime.now()
+        job.put_with_output(output)
     except:
         traceback.print_exc()
         raise
@@ -98,6 +156,103 @@ def do_job_work(request):
     return data(request)
 
 
+def run_job_shard(request):
+    """Task view to do one unit of work on a shard of a job.
+
+    Each unit queues up the next, until the worker says it is finished.
+    """
+    init_jobs()
+    shard = JobShard.get(request.POST['shard_key'])
+    if shard is None:
+        # The job has been reaped.
+        return HttpResponse('OK')
+    job_key = JobShard.job.get_value_for_datastore(shard)
+    if shard.finished:
+        # A retry of the shard's last unit of work.
+        _finish_shard(job_key, shard.index)
+        return HttpResponse('OK')
+    if shard.num_steps != int(request.POST['step']):
+        log.info('Job shard %s has already done step %s'
+                 % (shard.key().name(), request.POST['step']))
+        # We may have saved the step and then failed to queue the
+        # next one.  If the next one was queued, its name makes this
+        # a no-op.
+        _enqueue_shard(shard)
+        return HttpResponse('OK')
+    job = Job.get(job_key)
+    if job is None:
+        return HttpResponse('OK')
+    worker = get_worker(job.job_name)
+    if shard.result:
+        result_for_worker = simplejson.loads(shard.result)
+    else:
+        result_for_worker = None
+    finished, result = worker['callback'](result_for_worker,
+                                          simplejson.loads(shard.params))
+    output = _pop_output(result)
+    shard.result = simplejson.dumps(result)
+    shard.num_steps += 1
+    if finished:
+        shard.finished = datetime.datetime.now()
+    shard.put_with_output(output)
+    if finished:
+        _finish_shard(job_key, shard.index)
+    else:
+        _enqueue_shard(shard)
+    return HttpResponse('OK')
+
+
+def _finish_shard(job_key, index):
+    """Records that a shard has finished, merging the job if it was the
+    last one.
+    """
+    def txn():
+        job = Job.get(job_key)
+        if job is not None and index not in job.finished_shards:
+            job.finished_shards.append(index)
+            job.put()
+        return job
+    job = db.run_in_transaction(txn)
+    if job is None or len(job.finished_shards) < job.num_shards:
+        return
+    # Every shard has finished: fan in their results.
+    worker = get_worker(job.job_name)
+    results = [simplejson.loads(shard.result) for shard in job.get_shards()]
+    if worker['merger']:
+        result = worker['merger'](simplejson.loads(job.params), results)
+    else:
+        result = results[0]
+
+    def merge_txn():
+        job = Job.get(job_key)
+        job.result = simplejson.dumps(result)
+        job.finished = datetime.datetime.now()
+        job.put()
+    db.run_in_transaction(merge_txn)
+    log.info('Finished job %s in %d shards' % (job.job_name, job.num_shards))
+
+
+def get_job_progress(request, job_key):
+    init_jobs()
+    job = Job.get(job_key)
+    if job is None:
+        raise Http404("The requested job does not exist.")
+    worker = get_worker(job.job_name)
+    if worker['pre_request']:
+        early_response = worker['pre_request'](request)
+        if early_response is not None:
+            return early_response
+    @as_json
+    def data(request):
+        return {
+            'finished': job.finished is not None,
+            'num_shards': job.num_shards,
+            'num_shards_finished': len(job.finished_shards),
+            'success': True
+        }
+    return data(request)
+
+
 def get_job_product(request, job_key):
     init_jobs()
     job = Job.get(job_key)
@@ -112,4 +267,7 @@ def get_job_product(request, job_key):
         if early_response is not None:
             return early_response
     result = simplejson.loads(job.result)
+    if isinstance(result, dict):
+        # The output is read back as the product is sent.
+        result[OUTPUT] = job.iter_output()
     return producer['callback'](result)
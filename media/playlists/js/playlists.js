@@ -323,12 +323,14 @@ $(document).ready(function() {
             type: 'POST',
             url: '/jobs/start',
             data: {
-                'job_name': 'build-playlist-report'
+                'job_name': 'build-playlist-report',
+                'parallel': '1',
+                'params': JSON.stringify(values)
             },
             dataType: 'json',
             success: function(result, textStatus) {
                 job_key = result.job_key;
-                work(job_key, values);
+                wait_for(job_key);
             }
         });
     });
@@ -346,30 +348,33 @@ $(document).ready(function() {
             type: 'POST',
             url: '/jobs/start',
             data: {
-                'job_name': 'build-export-playlist-report'
+                'job_name': 'build-export-playlist-report',
+                'parallel': '1',
+                'params': JSON.stringify(values)
             },
             dataType: 'json',
             success: function(result, textStatus) {
                 job_key = result.job_key;
-                work(job_key, values);
+                wait_for(job_key);
             }
         });
     });
 
-    var work = function(job_key, form_values) {
+    // The job runs on the server; just check on it now and then.
+    var wait_for = function(job_key) {
         chirp.request({
-            type: 'POST',
-            url: '/jobs/work',
-            data: {
-                'job_key': job_key,
-                'params': JSON.stringify(form_values)
-            },
+            type: 'GET',
+            url: '/jobs/progress/' + job_key,
             dataType: 'json',
-            success: function(job_result, textStatus) {
-                if (job_result.finished) {
+            success: function(progress, textStatus) {
+                if (progress.finished) {
                     show_product(job_key);
                 } else {
-                    work(job_key, form_values);
+                    $("#ready-link").html(
+                        'Please wait while the report generates... (' +
+                        progress.num_shards_finished + ' of ' +
+                        progress.num_shards + ' parts done)');
+                    setTimeout(function() { wait_for(job_key); }, 2000);
                 }
             }
         });
@@ -23,7 +23,9 @@ from django.template import loader
 from django import forms
 from djdb.models import Artist, Album, Track
 from google.appengine.api import memcache
-from playlists.models import Playlist, PlaylistTrack, chirp_playlist_key
+from playlists import history
+from playlists.models import (Playlist, PlaylistTrack, HourlyQuota,
+                              chirp_playlist_key)
 from common.autoretry import AutoRetry
 
 class PlaylistTrackForm(forms.Form):
@@ -101,19 +103,11 @@ class PlaylistTrackForm(forms.Form):
         if self.cleaned_data['is_local_classic']:
             playlist_track.categories.append('local_classic')
         AutoRetry(playlist_track).save()
+        HourlyQuota.count_track(playlist_track, 1)
 
-        trk = playlist_track
-        memcache.set('playlist.last_track', {
-            'artist_name': trk.artist_name,
-            'track_title': trk.track_title,
-            'album_title_display': trk.album_title_display,
-            'label_display': trk.label_display,
-            'notes': trk.notes,
-            'key': str(trk.key()),
-            'categories': list(trk.categories),
-            'selector_key': str(trk.selector.key()),
-            'established_display': trk.established.timetuple()[0:7]
-        }, 30)
+        memcache.set('playlist.last_track',
+                     history.event_data(playlist_track), 30)
+        history.add(playlist_track)
 
         return playlist_track
 
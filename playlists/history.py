@@ -0,0 +1,167 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""The most recent events of each playlist, kept in memcache.
+
+The tracker page shows the last few hours of a playlist.  Rather than
+query for them on every page load, the newest HISTORY_SIZE events are
+kept in memcache, newest first, and updated as events are added and
+deleted.  Because the writers update the history directly, it is
+always in order and never misses an event the way an eventually
+consistent query can.
+
+If the history is lost, get() returns None and the caller queries the
+datastore and passes the result to fill().  Anything that writes
+PlaylistEvents without going through add() and remove() must call
+forget().
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+from django.conf import settings
+from google.appengine.api import memcache
+
+from playlists.models import PlaylistEvent, PlaylistBreak
+
+log = logging.getLogger()
+
+HISTORY_SIZE = 100
+
+# How many times to retry an update that raced with another one
+# before giving up and throwing the history away.
+MAX_UPDATE_ATTEMPTS = 5
+
+
+def is_enabled():
+    """Returns True if playlist histories should be kept in memcache."""
+    return getattr(settings, 'PLAYLISTS_HISTORY_CACHE', False)
+
+
+def _cache_key(playlist_key):
+    return 'playlist.history.%s' % playlist_key
+
+
+def _established(data):
+    return datetime(*data['established_display'][0:6])
+
+
+def event_data(event):
+    """Returns the compact form of a PlaylistTrack or PlaylistBreak.
+
+    This is the form the history stores events in; it is also cached as
+    'playlist.last_track'.
+    """
+    cached_data = getattr(event, 'cached_data', None)
+    if cached_data is not None:
+        return cached_data
+    data = {
+        'key': str(event.key()),
+        'established_display': event.established.timetuple()[0:7],
+    }
+    if isinstance(event, PlaylistBreak):
+        data['is_break'] = True
+        return data
+    data.update({
+        'is_break': False,
+        'artist_name': event.artist_name,
+        'track_title': event.track_title,
+        'album_title_display': event.album_title_display,
+        'label_display': event.label_display,
+        'notes': event.notes,
+        'categories': list(event.categories),
+        'selector_key': str(event.selector.key()),
+    })
+    return data
+
+
+def get(playlist_key, hours=3):
+    """Returns a playlist's recent events, newest first.
+
+    Args:
+      playlist_key: The key of the playlist.
+      hours: How far back to go.
+
+    Returns:
+      A list of dicts made by event_data(), or None if the history is
+      not in memcache.
+    """
+    if not is_enabled():
+        return None
+    events = memcache.get(_cache_key(playlist_key))
+    if events is None:
+        log.info('playlist history was not in memcache')
+        return None
+    start = datetime.now() - timedelta(hours=hours)
+    return [data for data in events if _established(data) >= start]
+
+
+def fill(playlist_key, events):
+    """Stores a playlist's history after it was lost.
+
+    Args:
+      playlist_key: The key of the playlist.
+      events: PlaylistTracks, PlaylistBreaks or cached events, newest
+        first.
+    """
+    if not is_enabled():
+        return
+    memcache.add(_cache_key(playlist_key),
+                 [event_data(ev) for ev in events[:HISTORY_SIZE]])
+
+
+def forget(playlist_key):
+    """Throws away a playlist's history."""
+    memcache.delete(_cache_key(playlist_key))
+
+
+def _update(playlist_key, change):
+    if not is_enabled():
+        return
+    key = _cache_key(playlist_key)
+    client = memcache.Client()
+    for attempt in xrange(MAX_UPDATE_ATTEMPTS):
+        events = client.gets(key)
+        if events is None:
+            # There is nothing to update; the next reader will query
+            # for the whole history.
+            return
+        if client.cas(key, change(events)[:HISTORY_SIZE]):
+            return
+    log.warning('Could not update the playlist history; dropping it')
+    memcache.delete(key)
+
+
+def add(event):
+    """Adds a newly saved PlaylistTrack or PlaylistBreak to the history."""
+    data = event_data(event)
+
+    def change(events):
+        events = [d for d in events if d['key'] != data['key']]
+        events.append(data)
+        # New events almost always go first, but keep the history in
+        # order even if one was saved with an earlier time.
+        events.sort(key=_established, reverse=True)
+        return events
+    _update(PlaylistEvent.playlist.get_value_for_datastore(event), change)
+
+
+def remove(event):
+    """Removes a deleted PlaylistTrack or PlaylistBreak from the history."""
+    key = str(event.key())
+    _update(PlaylistEvent.playlist.get_value_for_datastore(event),
+            lambda events: [d for d in events if d['key'] != key])
@@ -16,8 +16,10 @@
 ###
 
 """Datastore model for DJ Playlists."""
+from datetime import datetime, timedelta
 import hashlib
 import logging
+import random
 
 from google.appengine.ext.db import polymodel
 from google.appengine.api import memcache
@@ -248,16 +250,276 @@ class PlaylistTrack(PlaylistEvent):
         super(PlaylistTrack, self).put(*args, **kwargs)
         try:
             memcache.delete('api.current_track')
+            memcache.delete(RECENT_PLAYS_KEY)
         except:
             log.exception('IGNORED while saving playlist:')
+        PlayRollupDay.note_changed(self.established)
 
     def save(self, *args, **kwargs):
         return self.put(*args, **kwargs)
 
+    def delete(self, *args, **kwargs):
+        super(PlaylistTrack, self).delete(*args, **kwargs)
+        PlayRollupDay.note_changed(self.established)
+
+
+# Memcache key for the tracks played in the last little while.  This
+# is deleted whenever a track is added to or removed from a playlist.
+RECENT_PLAYS_KEY = 'playlist.recent_plays'
+RECENT_PLAYS_TIMEOUT = 15 * 60
+
+
+def recently_played(seconds):
+    """Returns what the CHIRP broadcast has played recently.
+
+    All of the plays in the window are read with a single query and
+    cached, so callers can check many artists, albums or tracks
+    against them without going back to the datastore.
+
+    Args:
+      seconds: How far back to look.
+
+    Returns:
+      A dict mapping 'artist', 'album' and 'track' to sets of the keys
+      of the artists, albums and tracks played in the last seconds.
+    """
+    now = datetime.now()
+    cached = memcache.get(RECENT_PLAYS_KEY)
+    if cached is None or cached['seconds'] < seconds:
+        query = PlaylistTrack.all().filter('playlist =', chirp_playlist_key())
+        query.filter('established >=', now - timedelta(seconds=seconds))
+        plays = []
+        for trk in AutoRetry(query).fetch(1000):
+            plays.append((trk.established,
+                          PlaylistTrack.artist.get_value_for_datastore(trk),
+                          PlaylistTrack.album.get_value_for_datastore(trk),
+                          PlaylistTrack.track.get_value_for_datastore(trk)))
+        # The plays stay valid for a while: the window only moves
+        # forward, and anything that falls out of it is dropped below.
+        cached = {'seconds': seconds, 'plays': plays}
+        memcache.set(RECENT_PLAYS_KEY, cached, RECENT_PLAYS_TIMEOUT)
+    start_dt = now - timedelta(seconds=seconds)
+    recent = {'artist': set(), 'album': set(), 'track': set()}
+    for established, artist, album, track in cached['plays']:
+        if established < start_dt:
+            continue
+        for name, key in (('artist', artist), ('album', album),
+                          ('track', track)):
+            if key is not None:
+                recent[name].add(key)
+    return recent
+
+
+class HourlyQuota(db.Model):
+    """How many tracks in each rotation category a playlist had in an hour.
+
+    The key name is made by make_key_name().  The counters are kept up
+    to date as tracks are added and deleted, and rebuilt from the
+    playlist if they go missing.  The keys of the counted tracks are
+    kept too, so that a track is never counted twice, whether it is
+    counted again or was already found by a rebuild.
+    """
+    CATEGORIES = ('heavy_rotation', 'light_rotation', 'local_current',
+                  'local_classic')
+
+    hour = db.DateTimeProperty(required=True)
+    heavy_rotation = db.IntegerProperty(default=0)
+    light_rotation = db.IntegerProperty(default=0)
+    local_current = db.IntegerProperty(default=0)
+    local_classic = db.IntegerProperty(default=0)
+    track_keys = db.ListProperty(db.Key)
+
+    @staticmethod
+    def start_of_hour(dt):
+        return dt.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def make_key_name(cls, playlist_key, hour):
+        return '%s:%s' % (playlist_key, hour.strftime('%Y%m%d%H'))
+
+    def _count(self, track_key, categories, delta):
+        """Adds a track to, or removes it from, the counters.
+
+        Returns:
+          False if the track was already counted (or, when removing,
+          was not counted), so nothing changed.
+        """
+        if delta > 0:
+            if track_key in self.track_keys:
+                return False
+            self.track_keys.append(track_key)
+        else:
+            if track_key not in self.track_keys:
+                return False
+            self.track_keys.remove(track_key)
+        for category in self.CATEGORIES:
+            if category in categories:
+                setattr(self, category,
+                        max(0, getattr(self, category) + delta))
+        return True
+
+    @classmethod
+    def _rebuild(cls, playlist_key, hour):
+        """Counts an hour's tracks from the playlist.
+
+        Args:
+          playlist_key: The key of the playlist.
+          hour: The start of the hour, in UTC.
+        """
+        quota = cls(key_name=cls.make_key_name(playlist_key, hour),
+                    hour=hour)
+        query = PlaylistTrack.all().filter('playlist =', playlist_key)
+        query.filter('established >=', hour)
+        query.filter('established <', hour + timedelta(hours=1))
+        for trk in AutoRetry(query).run():
+            if any(c in trk.categories for c in cls.CATEGORIES):
+                quota._count(trk.key(), trk.categories, 1)
+
+        def txn():
+            existing = cls.get_by_key_name(quota.key().name())
+            if existing is not None:
+                return existing
+            quota.put()
+            return quota
+        return db.run_in_transaction(txn)
+
+    @classmethod
+    def get_for(cls, playlist_key, when=None):
+        """Returns the counters for the hour containing a time.
+
+        Args:
+          playlist_key: The key of the playlist.
+          when: A UTC datetime; the default is now.
+        """
+        hour = cls.start_of_hour(when or datetime.now())
+        quota = AutoRetry(cls).get_by_key_name(
+            cls.make_key_name(playlist_key, hour))
+        if quota is None:
+            quota = cls._rebuild(playlist_key, hour)
+        return quota
+
+    @classmethod
+    def count_track(cls, track, delta):
+        """Adds a track to, or removes it from, its hour's counters.
+
+        A track that is already counted is not counted again, and one
+        that is not counted is not removed, so this is safe to repeat.
+
+        Args:
+          track: A PlaylistTrack that was just saved or deleted.
+          delta: 1 if it was saved, or -1 if it was deleted.
+        """
+        if not any(c in track.categories for c in cls.CATEGORIES):
+            return
+        playlist_key = PlaylistTrack.playlist.get_value_for_datastore(track)
+        hour = cls.start_of_hour(track.established)
+        key_name = cls.make_key_name(playlist_key, hour)
+        if AutoRetry(cls).get_by_key_name(key_name) is None:
+            # The query may or may not find a track that was only just
+            # saved or deleted; _count() sorts that out below.
+            cls._rebuild(playlist_key, hour)
+
+        def txn():
+            quota = cls.get_by_key_name(key_name)
+            if quota._count(track.key(), track.categories, delta):
+                quota.put()
+        db.run_in_transaction(txn)
+
+
+class PlayRollupDay(db.Model):
+    """Records when one day's plays were rolled up into PlayRollups.
+
+    The key name is the day in ISO format, and the day's PlayRollups
+    are its children.  Days are in UTC, like the playlist reports.
+    """
+    day = db.DateProperty(required=True)
+    num_plays = db.IntegerProperty(default=0)
+    # When the rollup was started and when the day's plays last
+    # changed; the rollup is only usable if it is newer.
+    computed = db.DateTimeProperty()
+    invalidated = db.DateTimeProperty()
+
+    @property
+    def is_fresh(self):
+        return (self.computed is not None and
+                (self.invalidated is None or
+                 self.computed > self.invalidated))
+
+    @classmethod
+    def note_changed(cls, established):
+        """Marks a day's rollup as out of date after a late change.
+
+        Changes to today's plays are ignored, since today is not
+        rolled up until it is over.
+
+        Args:
+          established: The time of the play that was added, changed or
+            deleted.
+        """
+        now = datetime.now()
+        day = established.date()
+        if day >= now.date():
+            return
+
+        def txn():
+            marker = cls.get_by_key_name(day.isoformat())
+            if marker is None:
+                marker = cls(key_name=day.isoformat(), day=day)
+            marker.invalidated = now
+            marker.put()
+        db.run_in_transaction(txn)
+
+
+class PlayRollup(db.Model):
+    """How many times a release was played on one day.
+
+    A child of the day's PlayRollupDay.  The fields match the items
+    made by playlists.views.query_group_by_track_key().
+    """
+    day = db.DateProperty(required=True)
+    group_by_key = db.TextProperty()
+    album_title = db.StringProperty()
+    artist_name = db.StringProperty()
+    label = db.StringProperty()
+    play_count = db.IntegerProperty(default=0)
+    heavy_rotation = db.BooleanProperty(default=False)
+    light_rotation = db.BooleanProperty(default=False)
+    # The time of the day's last play of the release; the rotation
+    # flags and names are taken from it.
+    last_played = db.DateTimeProperty()
+
+    def as_item(self):
+        return {'group_by_key': self.group_by_key,
+                'album_title': self.album_title,
+                'artist_name': self.artist_name,
+                'label': self.label,
+                'play_count': self.play_count,
+                'heavy_rotation': int(self.heavy_rotation),
+                'light_rotation': int(self.light_rotation),
+                'last_played': self.last_played}
+
+
+# Memcache key for the running total of a PlayCount's shards.
+PLAY_COUNT_TOTAL_KEY = 'playlist.play_count.%s'
+
 
 class PlayCount(db.Model):
-    """A log of how many times each artist/track was played."""
+    """A log of how many times each artist/track was played.
+
+    Plays are not counted on this entity but on one of NUM_SHARDS
+    PlayCountShard entities chosen at random, each in its own entity
+    group, so concurrent plays of the same album do not contend for a
+    single entity.  play_count holds the total as of the last merge().
+
+    Counts written before plays were sharded have sharded=False, and
+    their play_count is the only record of the plays so far.  The
+    first merge() moves it into an extra shard, LEGACY_SHARD.
+    """
+    NUM_SHARDS = 20
+    LEGACY_SHARD = NUM_SHARDS
+
     play_count = db.IntegerProperty(default=0)
+    sharded = db.BooleanProperty(default=False)
     artist_name = db.StringProperty()
     album_title = db.StringProperty()
     label = db.StringProperty()
@@ -276,6 +538,7 @@ class PlayCount(db.Model):
         count.artist_name = artist_name
         count.album_title = album_title
         count.label = label
+        count.sharded = True
         count.put()
         return count
 
@@ -286,6 +549,155 @@ class PlayCount(db.Model):
         id.update(album_title.lower().encode('utf8', 'replace'))
         return id.hexdigest()
 
+    @property
+    def track_id(self):
+        return self.key().name()
+
+    def shard_keys(self):
+        """Returns the keys of all shards, LEGACY_SHARD last."""
+        return [db.Key.from_path('PlayCountShard',
+                                 PlayCountShard.make_key_name(self.track_id,
+                                                              n))
+                for n in xrange(self.NUM_SHARDS + 1)]
+
+    def increment(self, amount=1):
+        """Counts some plays.
+
+        If the randomly chosen shard is busy, another one is tried
+        rather than retrying the same one.
+
+        Args:
+          amount: The number of plays to count.
+        """
+        shards = range(self.NUM_SHARDS)
+        random.shuffle(shards)
+        for n in shards[:-1]:
+            try:
+                db.run_in_transaction_options(
+                    db.create_transaction_options(retries=0),
+                    PlayCountShard.increment, self.track_id, n, amount)
+                break
+            except db.TransactionFailedError:
+                log.info('Play count shard %s is busy'
+                         % PlayCountShard.make_key_name(self.track_id, n))
+        else:
+            db.run_in_transaction(PlayCountShard.increment, self.track_id,
+                                  shards[-1], amount)
+        # Keep a running total only if someone has already read one;
+        # otherwise the next read sums the shards.
+        memcache.incr(PLAY_COUNT_TOTAL_KEY % self.track_id, delta=amount)
+
+    def sum_shards(self):
+        """Returns the number of plays, read from the shards in one batch."""
+        shards = AutoRetry(db).get(self.shard_keys())
+        total = sum(shard.count for shard in shards if shard)
+        if not self.sharded and shards[-1] is None:
+            # The plays counted before sharding are not in a shard yet.
+            total += self.play_count
+        return total
+
+    def total(self):
+        """Returns the current number of plays.
+
+        The total is kept in memcache and incremented along with the
+        shards; the shards are only read when it is missing.
+        """
+        key = PLAY_COUNT_TOTAL_KEY % self.track_id
+        total = memcache.get(key)
+        if total is None:
+            total = self.sum_shards()
+            memcache.add(key, total)
+        return total
+
+    def merge(self):
+        """Copies the total of this count's shards to play_count.
+
+        This count is only written if the total has changed, so
+        modified records when the album was last played.
+
+        Returns:
+          True if the total changed.
+        """
+        seeded = False
+        if not self.sharded:
+            # get_or_insert() leaves an existing shard alone, so the
+            # old total is moved over once even if we fail before the
+            # put() below.
+            AutoRetry(PlayCountShard).get_or_insert(
+                PlayCountShard.make_key_name(self.track_id,
+                                             self.LEGACY_SHARD),
+                track_id=self.track_id, count=self.play_count)
+            self.sharded = seeded = True
+        total = self.sum_shards()
+        if total == self.play_count:
+            if seeded:
+                AutoRetry(self).put()
+            return False
+        self.play_count = total
+        AutoRetry(self).put()
+        return True
+
+    @classmethod
+    def merge_all(cls):
+        """Merges the shards of every count whose total has changed.
+
+        The shards are read with a single query, and only the counts
+        that changed are written back.
+
+        Returns:
+          The number of counts that changed.
+        """
+        totals = {}
+        for shard in AutoRetry(PlayCountShard.all()).run(batch_size=1000):
+            totals[shard.track_id] = (totals.get(shard.track_id, 0)
+                                      + shard.count)
+        track_ids = totals.keys()
+        changed = []
+        num_merged = 0
+        for count in AutoRetry(cls).get_by_key_name(track_ids):
+            if count is None:
+                continue
+            if not count.sharded:
+                # The shard query cannot tell us whether the old total
+                # has been moved to a shard yet; merge() can.
+                if count.merge():
+                    num_merged += 1
+                continue
+            if count.play_count != totals[count.track_id]:
+                count.play_count = totals[count.track_id]
+                changed.append(count)
+        AutoRetry(db).put(changed)
+        return len(changed) + num_merged
+
+    def delete_with_shards(self):
+        AutoRetry(db).delete(self.shard_keys() + [self.key()])
+        memcache.delete(PLAY_COUNT_TOTAL_KEY % self.track_id)
+
+
+class PlayCountShard(db.Model):
+    """Part of the number of times an artist/album was played.
+
+    The key name is the PlayCount's track ID followed by the shard
+    number.
+    """
+    track_id = db.StringProperty(required=True)
+    count = db.IntegerProperty(default=0)
+    modified = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def make_key_name(cls, track_id, n):
+        return '%s-%d' % (track_id, n)
+
+    @classmethod
+    def increment(cls, track_id, n, amount=1):
+        """Adds to a shard.  Must be called in a transaction."""
+        key_name = cls.make_key_name(track_id, n)
+        shard = cls.get_by_key_name(key_name)
+        if shard is None:
+            shard = cls(key_name=key_name, track_id=track_id)
+        shard.count += amount
+        shard.put()
+
 
 class PlayCountSnapshot(db.Model):
     """Snapshot of top 40 play count."""
@@ -300,7 +712,8 @@ class PlayCountSnapshot(db.Model):
     @classmethod
     def create_from_count(cls, count):
         snap = cls()
-        snap.play_count = count.play_count
+        # Plays may have been counted since the count was last merged.
+        snap.play_count = count.total()
         snap.artist_name = count.artist_name
         snap.album_title = count.album_title
         snap.label = count.label
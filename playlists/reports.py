@@ -15,11 +15,10 @@
 ### limitations under the License.
 ###
 
-import csv
 from datetime import datetime, timedelta
+import itertools
 import logging
 
-from django.http import HttpResponse
 from django.template import loader, RequestContext
 from django.shortcuts import render_to_response, get_object_or_404
 
@@ -28,13 +27,20 @@ from google.appengine.api import datastore_errors
 from auth.decorators import require_role
 import auth
 from auth import roles
+from common.autoretry import AutoRetry
+from common.prefetch import prefetch_references
 from common.utilities import (as_encoded_str, http_send_csv_file, 
+                              http_stream_csv_file, iter_csv,
                               restricted_job_worker, restricted_job_product)
-from djdb.models import HEAVY_ROTATION_TAG, LIGHT_ROTATION_TAG
+from jobs import (iter_query_batches, query_finished, read_output,
+                  split_date_range, write_output)
 from playlists.forms import PlaylistTrackForm, PlaylistReportForm
-from playlists.views import (query_group_by_track_key, filter_tracks_by_date_range,
-                             filter_playlist_events_by_date_range)
-from playlists.models import PlaylistTrack, PlaylistEvent, PlaylistBreak
+from playlists.views import (filter_playlist_events_by_date_range,
+                             filter_tracks_by_date_range, group_by_track_key)
+from playlists.models import (PlaylistTrack, PlaylistEvent, PlaylistBreak,
+                              chirp_playlist_key)
+from playlists.rollups import (iter_plays_by_release, plays_by_release,
+                               rolled_up_plays_by_release)
 
 
 log = logging.getLogger()
@@ -46,6 +52,9 @@ REPORT_FIELDS = ['from_date', 'to_date', 'album_title', 'artist_name',
 EXPORT_REPORT_FIELDS = ['channel', 'date', 'start_time', 'end_time', 'artist_name',
                         'track_title', 'album_title', 'label']
 
+# How many days of plays playlist_report_worker counts per step.
+REPORT_DAYS_PER_STEP = 31
+
 @require_role(roles.MUSIC_DIRECTOR)
 def report_playlist(request, template='playlists/reports.html'):
     vars = {}
@@ -58,7 +67,7 @@ def report_playlist(request, template='playlists/reports.html'):
     if request.method == 'GET':
         to_date = datetime.now().date()
         from_date = to_date - timedelta(days=1)
-        items = query_group_by_track_key(from_date, to_date)
+        items = plays_by_release(from_date, to_date)
 
         # default form
         form = PlaylistReportForm({'from_date':from_date, 'to_date':to_date})
@@ -76,11 +85,12 @@ def report_playlist(request, template='playlists/reports.html'):
             # special case to download report
             if request.POST.get('download') == 'Download':
                 fname = "chirp-play-count_%s_%s" % (from_date, to_date)
-                return http_send_csv_file(fname, fields, query_group_by_track_key(from_date, to_date))
+                return http_send_csv_file(
+                    fname, fields, iter_plays_by_release(from_date, to_date))
 
             # generate report from date range
             if request.POST.get('search') == 'Search':
-                items = query_group_by_track_key(from_date, to_date)
+                items = plays_by_release(from_date, to_date)
 
     # template vars
     vars['form'] = form
@@ -104,119 +114,234 @@ def report_export_playlist(request, template='playlists/export_reports.html'):
             context_instance=RequestContext(request))
 
 
-@restricted_job_worker('build-playlist-report', roles.MUSIC_DIRECTOR)
-def playlist_report_worker(results, request_params):
+def _report_dates(request_params):
     form = PlaylistReportForm(data=request_params)
     if not form.is_valid():
         # TODO(Kumar) make this visible to the user
         raise ValueError('Invalid PlaylistReportForm')
-    from_date = form.cleaned_data['from_date']
-    to_date = form.cleaned_data['to_date']
+    return form.cleaned_data['from_date'], form.cleaned_data['to_date']
+
+
+def split_report(request_params):
+    """Splits the params of a playlist report by date, to run in parallel."""
+    shards = []
+    for from_date, to_date in split_date_range(*_report_dates(request_params)):
+        params = dict(request_params)
+        params['from_date'] = str(from_date)
+        params['to_date'] = str(to_date)
+        shards.append(params)
+    return shards
+
+
+def split_export_report(request_params):
+    """Splits the params of an export report by date, latest dates first.
+
+    Events are written out newest first, and the shards' output is
+    joined in the order they are returned here.
+    """
+    shards = split_report(request_params)
+    report_to_date = str(_report_dates(request_params)[1])
+    for params in shards:
+        params['report_to_date'] = report_to_date
+    shards.reverse()
+    return shards
+
+
+def _first_event_after(to_date, request_params):
+    """Returns the time of the report's first event after to_date, or None.
+
+    A shard of an export report needs this to find the end time of its
+    own last track, which can be on the same local day as the first
+    event of the next shard: shards split the dates in UTC, while
+    established_display is in Chicago time.
+    """
+    if not request_params.get('report_to_date'):
+        return None
+    report_to_date = datetime.strptime(request_params['report_to_date'],
+                                       '%Y-%m-%d').date()
+    if to_date >= report_to_date:
+        return None
+    # Like filter_playlist_events_by_date_range(), but oldest first.
+    start = to_date + timedelta(days=1)
+    query = PlaylistEvent.all().filter('playlist =', chirp_playlist_key())
+    query.filter('established >=',
+                 datetime(start.year, start.month, start.day, 0, 0, 0))
+    query.filter('established <=',
+                 datetime(report_to_date.year, report_to_date.month,
+                          report_to_date.day, 23, 59, 59))
+    query.order('established')
+    event = AutoRetry(query).get()
+    if event is None:
+        return None
+    return _get_entity_attr(event, 'established_display')
+
+
+def _count_plays(results, play_key, play_count, last_played, item):
+    if play_key in results['play_counts']:
+        results['play_counts'][play_key] += play_count
+        if last_played <= results['last_played'][play_key]:
+            return
+    else:
+        results['play_counts'][play_key] = play_count
+    results['last_played'][play_key] = last_played
+    results['items'][play_key] = item
+
+
+def merge_report(request_params, shard_results):
+    """Adds up the play counts of a playlist report run in parallel."""
+    from_date, to_date = _report_dates(request_params)
+    merged = {
+        'items': {},
+        'play_counts': {},
+        'last_played': {},
+        'from_date': str(from_date),
+        'to_date': str(to_date),
+    }
+    for results in shard_results:
+        for play_key, play_count in results['play_counts'].iteritems():
+            _count_plays(merged, play_key, play_count,
+                         results['last_played'][play_key],
+                         results['items'][play_key])
+    return merged
+
+
+@restricted_job_worker('build-playlist-report', roles.MUSIC_DIRECTOR,
+                       splitter=split_report, merger=merge_report)
+def playlist_report_worker(results, request_params):
+    from_date, to_date = _report_dates(request_params)
 
     if results is None:
         # when starting the job, init file lines with the header row...
         results = {
             'items': {},  # items keyed by play key
-            'last_offset': 0,
+            'next_day': str(from_date),
+            # Days of the current step that have not been rolled up,
+            # as [from_date, to_date] pairs.
+            'unrolled_ranges': [],
             'play_counts': {},  # play keys to number of plays
+            'last_played': {},  # play keys to the time of the last play
             'from_date': str(from_date),
             'to_date': str(to_date),
         }
 
-    offset = results['last_offset']
-    last_offset = offset+50
-    results['last_offset'] = last_offset
+    if results['unrolled_ranges']:
+        # Page through the plays of days that have not been rolled up,
+        # such as today.
+        start, end = [datetime.strptime(d, '%Y-%m-%d').date()
+                      for d in results['unrolled_ranges'][0]]
+        query = filter_tracks_by_date_range(start, end)
+        for plays in iter_query_batches(query, results):
+            prefetch_references(plays, ['album', 'artist', 'track'])
+            for item in group_by_track_key(plays, start, end):
+                _count_release_plays(results, item)
+        if query_finished(results):
+            results['unrolled_ranges'].pop(0)
+            del results['query_state']
+    else:
+        # Most days have been rolled up, so a step can cover many of
+        # them.
+        start = datetime.strptime(results['next_day'], '%Y-%m-%d').date()
+        end = min(start + timedelta(days=REPORT_DAYS_PER_STEP - 1), to_date)
+        results['next_day'] = str(end + timedelta(days=1))
+        items, unrolled_ranges = rolled_up_plays_by_release(start, end)
+        for item in items:
+            _count_release_plays(results, item)
+        results['unrolled_ranges'] = [[str(s), str(e)]
+                                      for s, e in unrolled_ranges]
+
+    next_day = datetime.strptime(results['next_day'], '%Y-%m-%d').date()
+    finished = next_day > to_date and not results['unrolled_ranges']
+    return finished, results
 
-    query = filter_tracks_by_date_range(from_date, to_date)
-    all_entries = query[ offset: last_offset ]
 
-    if len(all_entries) == 0:
-        finished = True
-    else:
-        finished = False
+def _count_release_plays(results, item):
+    _count_plays(results, item['group_by_key'], item['play_count'],
+                 item['last_played'].isoformat(), {
+        'album_title': as_encoded_str(item['album_title']),
+        'artist_name': as_encoded_str(item['artist_name']),
+        'label': as_encoded_str(item['label']),
+        'heavy_rotation': str(item['heavy_rotation']),
+        'light_rotation': str(item['light_rotation'])
+    })
 
-    for entry in all_entries:
-        play_key = play_count_key(entry)
-        if play_key in results['play_counts']:
-            results['play_counts'][play_key] += 1
-            continue
-        else:
-            results['play_counts'][play_key] = 1
-        results['items'][play_key] = {
-            'album_title': as_encoded_str(_get_entity_attr(entry,
-                                                           'album_title')),
-            'artist_name': as_encoded_str(_get_entity_attr(entry,
-                                                           'artist_name')),
-            'label': as_encoded_str(_get_entity_attr(entry, 'label')),
-            'heavy_rotation': str(int(bool(HEAVY_ROTATION_TAG in
-                                           entry.categories))),
-            'light_rotation': str(int(bool(LIGHT_ROTATION_TAG in
-                                           entry.categories)))
-        }
 
-    return finished, results
+def merge_export_report(request_params, shard_results):
+    from_date, to_date = _report_dates(request_params)
+    return {'from_date': str(from_date), 'to_date': str(to_date)}
 
 
-@restricted_job_worker('build-export-playlist-report', roles.MUSIC_DIRECTOR)
+@restricted_job_worker('build-export-playlist-report', roles.MUSIC_DIRECTOR,
+                       splitter=split_export_report,
+                       merger=merge_export_report)
 def playlist_export_report_worker(results, request_params):
-    form = PlaylistReportForm(data=request_params)
-    if not form.is_valid():
-        # TODO(Kumar) make this visible to the user
-        raise ValueError('Invalid PlaylistReportForm')
-    from_date = form.cleaned_data['from_date']
-    to_date = form.cleaned_data['to_date']
+    from_date, to_date = _report_dates(request_params)
 
     if results is None:
-        # when starting the job, init file lines with the header row...
         results = {
-            'items': {},  # items keyed by datetime established
-            'last_offset': 0,
             'from_date': str(from_date),
             'to_date': str(to_date),
+            # The last event read, which ends the track before it.
+            # A shard starts from the first event of the next shard.
+            'prev_established': None,
         }
-
-    offset = results['last_offset']
-    last_offset = offset+50
-    results['last_offset'] = last_offset
-
-    query = filter_playlist_events_by_date_range(from_date, to_date)
-    all_entries = query[ offset: last_offset ]
-
-    if len(all_entries) == 0:
-        finished = True
+        next_established = _first_event_after(to_date, request_params)
+        if next_established:
+            results['prev_established'] = next_established.strftime(
+                                                    '%Y-%m-%d %H:%M:%S.%f')
+
+    if results['prev_established']:
+        prev_established = datetime.strptime(results['prev_established'],
+                                             '%Y-%m-%d %H:%M:%S.%f')
     else:
-        finished = False
-
-    for entry in all_entries:
-        established = _get_entity_attr(entry, 'established_display')
-        report_key = as_encoded_str(str(established))
-      
-        if type(entry) == PlaylistBreak:
-            results['items'][report_key] = {
-                'established': as_encoded_str(established.strftime('%Y-%m-%d %H:%M:%S')),
-                'is_break': True
+        prev_established = None
+    # The events come newest first, so each track ends when the event
+    # after it (the one before it here) starts.
+    rows = []
+    query = filter_playlist_events_by_date_range(from_date, to_date)
+    for entries in iter_query_batches(query, results):
+        prefetch_references(entries, ['playlist', 'artist', 'track', 'album'])
+        for entry in entries:
+            established = _get_entity_attr(entry, 'established_display')
+            if established == prev_established:
+                # Only the first of two events at the same time is reported.
+                continue
+
+            if type(entry) == PlaylistBreak:
+                prev_established = established
+                continue
+
+            playlist = _get_entity_attr(entry, 'playlist')
+            track = _get_entity_attr(entry, 'track')
+            if (prev_established and
+                prev_established.date() == established.date()):
+                end_time = prev_established - timedelta(seconds=1)
+            else:
+                # track is last played for the day
+                duration_ms = _get_entity_attr(track, 'duration_ms', 0)
+                if duration_ms:
+                    end_time = established + timedelta(milliseconds=duration_ms)
+                else:
+                    # no track duration, default to 4 minutes
+                    end_time = established + timedelta(minutes=4)
+            prev_established = established
+            item = {
+                'channel': _get_entity_attr(playlist, 'channel'),
+                'date': established.strftime("%m/%d/%y"),
+                'start_time': established.strftime('%H:%M:%S'),
+                'end_time': end_time.strftime('%H:%M:%S'),
+                'artist_name': _get_entity_attr(entry, 'artist_name'),
+                'track_title': _get_entity_attr(entry, 'track_title'),
+                'album_title': _get_entity_attr(entry, 'album_title_display'),
+                'label': _get_entity_attr(entry, 'label_display'),
             }
-            continue
-       
-        playlist = _get_entity_attr(entry, 'playlist') 
-        track = _get_entity_attr(entry, 'track')
-        results['items'][report_key] = {
-            'channel': as_encoded_str(_get_entity_attr(playlist, 'channel')),
-            'date': as_encoded_str(established.strftime("%m/%d/%y")),
-            'duration_ms': as_encoded_str(_get_entity_attr(track, 
-                                                           'duration_ms', 0)),
-            'established': as_encoded_str(established.strftime('%Y-%m-%d %H:%M:%S')),
-            'artist_name': as_encoded_str(_get_entity_attr(entry,
-                                                           'artist_name')),
-            'track_title': as_encoded_str(_get_entity_attr(entry,
-                                                            'track_title')),
-            'album_title': as_encoded_str(_get_entity_attr(entry, 
-                                                           'album_title_display')),
-            'label': as_encoded_str(_get_entity_attr(entry, 'label_display')),
-            'is_break': False
-        }
+            rows.append([as_encoded_str(item[k], errors='replace')
+                         for k in EXPORT_REPORT_FIELDS])
 
-    return finished, results
+    if prev_established:
+        results['prev_established'] = prev_established.strftime(
+                                                    '%Y-%m-%d %H:%M:%S.%f')
+    write_output(results, ''.join(iter_csv(rows, delimiter='\t')))
+    return query_finished(results), results
 
 
 def _get_entity_attr(entity, attr, *getattr_args):
@@ -240,68 +365,27 @@ def _get_entity_attr(entity, attr, *getattr_args):
             raise
 
 
-# group by key/fields
-def play_count_key(item):
-    """given a playlist record, generate a key to tally play counts with.
-
-    For example: Talking Book,Stevie Wonder,Motown
-    """
-    key_parts = []
-    for key in ['album_title', 'artist_name', 'label']:
-        stub = as_encoded_str(_get_entity_attr(item, key, ''))
-        stub = stub.lower()
-        key_parts.append(stub)
-    return ','.join(key_parts)
-
-
 @restricted_job_product('build-playlist-report', roles.MUSIC_DIRECTOR)
 def playlist_report_product(results):
     fname = "chirp-play-count_%s_%s" % (results['from_date'],
                                         results['to_date'])
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = "attachment; filename=%s.csv" % (fname)
-    writer = csv.writer(response, REPORT_FIELDS)
-    writer.writerow(REPORT_FIELDS)
-    for play_key, item in results['items'].iteritems():
-        item['from_date'] = results['from_date']
-        item['to_date'] = results['to_date']
-        item['play_count'] = results['play_counts'][play_key]
-        writer.writerow([as_encoded_str(item[k], errors='replace')
-                         for k in REPORT_FIELDS])
-    return response
+
+    def rows():
+        yield REPORT_FIELDS
+        for play_key, item in results['items'].iteritems():
+            item['from_date'] = results['from_date']
+            item['to_date'] = results['to_date']
+            item['play_count'] = results['play_counts'][play_key]
+            yield [as_encoded_str(item[k], errors='replace')
+                   for k in REPORT_FIELDS]
+    return http_stream_csv_file(fname, iter_csv(rows()))
 
 
 @restricted_job_product('build-export-playlist-report', roles.MUSIC_DIRECTOR)
 def playlist_report_export_product(results):
     fname = "chirp-export-report_%s_%s" % (results['from_date'],
                                            results['to_date'])
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = "attachment; filename=%s.txt" % (fname)
-    writer = csv.writer(response, EXPORT_REPORT_FIELDS, delimiter='\t')
-    writer.writerow(EXPORT_REPORT_FIELDS)
-    # sort on date and time
-    sorted_keys = sorted(results['items'], reverse=True)
-    # construct start and end times
-    prev_established = None
-    for key in sorted_keys:
-        item = results['items'][key]
-        established = datetime.strptime(item['established'], '%Y-%m-%d %H:%M:%S')
-        if item['is_break']: 
-            prev_established = established
-            continue
-        item['start_time'] = established.strftime('%H:%M:%S')
-        # calculate end times
-        if prev_established and prev_established.date() == established.date():
-            item['end_time'] = (prev_established - timedelta(seconds=1)).strftime('%H:%M:%S')
-        else:
-            # track is last played for the day
-            if item['duration_ms']:
-                delta = timedelta(milliseconds=item['duration_ms'])
-                item['end_time'] = (established + delta).strftime('%H:%M:%S')
-            else:
-                # no track duration, default to 4 minutes
-                item['end_time'] = (established + timedelta(minutes=4)).strftime('%H:%M:%S')
-        prev_established = established
-        writer.writerow([as_encoded_str(item[k], errors='replace')
-                         for k in EXPORT_REPORT_FIELDS])
-    return response
+    header = iter_csv([EXPORT_REPORT_FIELDS], delimiter='\t')
+    return http_stream_csv_file(fname,
+                                itertools.chain(header, read_output(results)),
+                                extension='txt')
@@ -0,0 +1,226 @@
+###
+### Copyright 2026 The Chicago Independent Radio Project
+### All Rights Reserved.
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###     http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+###
+
+"""Daily play counts per release for the playlist reports.
+
+Grouping a date range's plays by release means reading every play in
+the range.  Instead, a nightly cron job rolls each finished day up into
+one PlayRollup per release played that day, under a PlayRollupDay.  A
+report then reads the rollups for the days that have them and only
+groups the plays of the days that do not, such as today.
+
+Adding, changing or deleting a play on an earlier day marks that day's
+rollup out of date (see PlayRollupDay.note_changed), so reports stop
+using it and the next cron run redoes just that day.
+"""
+
+from datetime import date, datetime, timedelta
+import hashlib
+import logging
+
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from common.autoretry import AutoRetry
+from common.utilities import cronjob
+from playlists.models import PlayRollup, PlayRollupDay
+from playlists.views import query_group_by_track_key
+
+log = logging.getLogger()
+
+# How many days back the cron job looks for days to roll up.
+ROLLUP_DAYS = 120
+
+_MAX_PUT_SIZE = 500
+
+
+def _days(from_date, to_date):
+    day = from_date
+    while day <= to_date:
+        yield day
+        day += timedelta(days=1)
+
+
+def rollup_day(day):
+    """Rolls up one day's plays, replacing any earlier rollup.
+
+    Args:
+      day: A datetime.date.
+
+    Returns:
+      The PlayRollupDay.
+    """
+    started = datetime.now()
+    parent = db.Key.from_path('PlayRollupDay', day.isoformat())
+    rows = []
+    for item in query_group_by_track_key(day, day):
+        key = item['group_by_key']
+        rows.append(PlayRollup(
+            parent=parent,
+            key_name=hashlib.md5(key).hexdigest(),
+            day=day,
+            group_by_key=key.decode('utf8'),
+            album_title=item['album_title'],
+            artist_name=item['artist_name'],
+            label=item['label'],
+            play_count=item['play_count'],
+            heavy_rotation=bool(item['heavy_rotation']),
+            light_rotation=bool(item['light_rotation']),
+            last_played=item['last_played']))
+    old_keys = set(AutoRetry(db.Query(PlayRollup, keys_only=True)
+                             .ancestor(parent)).run())
+    for i in xrange(0, len(rows), _MAX_PUT_SIZE):
+        AutoRetry(db).put(rows[i:i + _MAX_PUT_SIZE])
+    AutoRetry(db).delete(list(old_keys.difference(r.key() for r in rows)))
+
+    def txn():
+        marker = PlayRollupDay.get_by_key_name(day.isoformat())
+        if marker is None:
+            marker = PlayRollupDay(key_name=day.isoformat(), day=day)
+        # A play changed while we were working leaves the rollup
+        # out of date.
+        marker.computed = started
+        marker.num_plays = sum(r.play_count for r in rows)
+        marker.put()
+        return marker
+    marker = db.run_in_transaction(txn)
+    log.info('Rolled up %d plays of %d releases on %s'
+             % (marker.num_plays, len(rows), day))
+    return marker
+
+
+def _fresh_days(days):
+    markers = AutoRetry(PlayRollupDay).get_by_key_name(
+        [day.isoformat() for day in days])
+    return set(day for day, marker in zip(days, markers)
+               if marker is not None and marker.is_fresh)
+
+
+def _add_item(combined, item):
+    key = item['group_by_key']
+    seen = combined.get(key)
+    if seen is None:
+        combined[key] = dict(item)
+        return
+    play_count = seen['play_count'] + item['play_count']
+    if item['last_played'] > seen['last_played']:
+        seen.update(item)
+    seen['play_count'] = play_count
+
+
+def rolled_up_plays_by_release(from_date, to_date):
+    """Counts the plays of each release on the rolled up days of a range.
+
+    Args:
+      from_date: The first day, a datetime.date.
+      to_date: The last day.
+
+    Returns:
+      A (items, unrolled_ranges) tuple.  items is a list of dicts like
+      those made by query_group_by_track_key(), in no particular order.
+      unrolled_ranges is a list of (from_date, to_date) tuples, the
+      runs of days whose plays have to be grouped directly.
+    """
+    days = list(_days(date(from_date.year, from_date.month, from_date.day),
+                      date(to_date.year, to_date.month, to_date.day)))
+    fresh = _fresh_days(days)
+    combined = {}
+    if fresh:
+        query = PlayRollup.all().filter('day >=', min(fresh))
+        query.filter('day <=', max(fresh))
+        for row in AutoRetry(query).run(batch_size=1000):
+            if row.day in fresh:
+                item = row.as_item()
+                item['group_by_key'] = item['group_by_key'].encode('utf8')
+                _add_item(combined, item)
+    unrolled_ranges = []
+    start = None
+    for day in days + [None]:
+        if day is not None and day not in fresh:
+            if start is None:
+                start = day
+            continue
+        if start is not None:
+            end = (day or days[-1] + timedelta(days=1)) - timedelta(days=1)
+            unrolled_ranges.append((start, end))
+            start = None
+    return combined.values(), unrolled_ranges
+
+
+def plays_by_release(from_date, to_date):
+    """Counts the plays of each release in a date range.
+
+    Args:
+      from_date: The first day, a datetime.date.
+      to_date: The last day.
+
+    Returns:
+      A list of dicts like those made by query_group_by_track_key(),
+      most recently played first.
+    """
+    return list(iter_plays_by_release(from_date, to_date))
+
+
+def iter_plays_by_release(from_date, to_date):
+    """Like plays_by_release(), but yields the dicts one at a time.
+
+    Nothing is read until the first dict is asked for.  The plays of
+    every release still have to be counted before the first one can be
+    yielded, but no list of the results is built.
+    """
+    combined = {}
+    items, unrolled_ranges = rolled_up_plays_by_release(from_date, to_date)
+    for item in items:
+        _add_item(combined, item)
+    # Group the plays of the other days directly, a run of days at a
+    # time.
+    for start, end in unrolled_ranges:
+        for item in query_group_by_track_key(start, end):
+            _add_item(combined, item)
+    play_keys = sorted(combined,
+                       key=lambda key: combined[key]['last_played'],
+                       reverse=True)
+    for key in play_keys:
+        item = combined.pop(key)
+        item['from_date'] = from_date
+        item['to_date'] = to_date
+        yield item
+
+
+@cronjob
+def rollup_plays(request):
+    """Cron view to queue up the days that need rolling up."""
+    today = datetime.now().date()
+    days = list(_days(today - timedelta(days=ROLLUP_DAYS),
+                      today - timedelta(days=1)))
+    fresh = _fresh_days(days)
+    num = 0
+    for day in days:
+        if day not in fresh:
+            taskqueue.add(url=reverse('playlists.rollup_day'),
+                          params={'day': day.isoformat()})
+            num += 1
+    log.info('Queued %d days to roll up' % num)
+
+
+def rollup_day_task(request):
+    """Task view to roll up one day's plays."""
+    day = datetime.strptime(request.POST['day'], '%Y-%m-%d').date()
+    rollup_day(day)
+    return HttpResponse('OK')
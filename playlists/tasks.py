@@ -21,6 +21,7 @@ import urllib, urllib2
 import wsgiref.handlers
 
 from django import http
+from django.conf import settings
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 
@@ -31,11 +32,25 @@ from google.appengine.api import taskqueue, urlfetch
 from common import dbconfig, in_dev
 from common.utilities import as_encoded_str, cronjob
 from common.autoretry import AutoRetry
-from djdb.models import Track
-from playlists.models import PlaylistEvent, PlayCount, PlayCountSnapshot
+from common.prefetch import prefetch_references
+from djdb.models import CompilationTrackLookup, Track
+from playlists.models import (PlaylistEvent, PlaylistTrack, PlayCount,
+                              PlayCountSnapshot)
 
 log = logging.getLogger()
 
+# Pull queue that plays wait in until aggregate_play_counts counts them.
+PLAY_COUNT_QUEUE = 'play-counts'
+
+# How long aggregate_play_counts may hold a batch of plays before they
+# can be leased again.
+PLAY_COUNT_LEASE_SECONDS = 5 * 60
+
+# How many plays to count per batch, and the most batches to count
+# each time aggregate_play_counts runs.
+PLAY_COUNT_BATCH_SIZE = 200
+MAX_PLAY_COUNT_BATCHES = 10
+
 
 class PlaylistEventListener(object):
     """Listens to creations or deletions of playlist entries."""
@@ -67,8 +82,12 @@ class PlayCountListener(PlaylistEventListener):
 
     def create(self, track):
         """This instance of PlaylistEvent was created."""
-        taskqueue.add(url=reverse('playlists.play_count'),
-                      params={'id': str(track.key())})
+        if settings.PLAYLISTS_AGGREGATE_PLAY_COUNTS:
+            taskqueue.Queue(PLAY_COUNT_QUEUE).add(
+                taskqueue.Task(payload=str(track.key()), method='PULL'))
+        else:
+            taskqueue.add(url=reverse('playlists.play_count'),
+                          params={'id': str(track.key())})
 
     def delete(self, track_key):
         """The key of this PlaylistEvent was deleted."""
@@ -128,56 +147,143 @@ def _push_notify(url_key):
     return resp.status_code == 200
 
 
-def play_count(request):
-    """View for keeping track of play counts"""
-    track_key = request.POST['id']
-    track = PlaylistEvent.get(track_key)
-    artist_name = track.artist_name
+def _find_album(track):
+    """Returns the album a play was from, or None."""
     album = track.album
     if not album:
         # Try to find a compilation album based on track name.
-        qs = Track.all().filter('title =', track.track_title)
-        for candidate in qs.run():
-            if (candidate.track_artist and
-                candidate.album.title == track.album_title and
-                candidate.track_artist.name == track.artist_name):
-                album = candidate.album
+        candidates = CompilationTrackLookup.find_albums(track.track_title,
+                                                        track.artist_name)
+        if candidates is None and not CompilationTrackLookup.is_complete():
+            # Tracks indexed before the lookup existed are only listed
+            # once the index is rebuilt, so until then fall back to a
+            # scan.
+            candidates = [
+                t.album for t in
+                Track.all().filter('title =', track.track_title).run()
+                if (t.track_artist and
+                    t.track_artist.name == track.artist_name)]
+        for candidate in candidates or ():
+            if candidate.title == track.album_title:
+                album = candidate
                 break
         if not album:
             log.info('No album for %s / %s / %s'
                      % (track.artist_name, track.track_title,
                         track.album_title))
+    return album
+
+
+def _release_artist_name(track, album):
     if album and album.is_compilation:
-        artist_name = 'Various'
+        return 'Various'
+    return track.artist_name
+
 
+def play_count(request):
+    """View for keeping track of play counts"""
+    track_key = request.POST['id']
+    track = PlaylistEvent.get(track_key)
+    artist_name = _release_artist_name(track, _find_album(track))
     count = PlayCount.query(artist_name, track.album_title)
     if not count:
         count = PlayCount.create_first(artist_name,
                                        track.album_title,
                                        track.label)
+    count.increment()
+    return HttpResponse("OK")
 
-    @db.transactional
-    def increment(key):
-        ob = db.get(key)
-        ob.play_count += 1
-        ob.put()
 
-    increment(count.key())
+def count_plays(event_keys, counted=None):
+    """Counts a batch of plays.
+
+    The plays, and the albums, artists and tracks they refer to, are
+    each read with one batch get.  Plays of the same release are added
+    up first, so each release is written to only once.
+
+    Args:
+      event_keys: The keys of PlaylistTracks.  A key may appear more
+        than once, to count more than one play.
+      counted: If given, called with a list of indexes into event_keys
+        as soon as those plays are counted (or found to be deleted),
+        so that the caller can make sure they are not counted again.
+
+    Returns:
+      The number of plays counted.
+    """
+    events = AutoRetry(db).get(event_keys)
+    missing = [i for i, ev in enumerate(events)
+               if not isinstance(ev, PlaylistTrack)]
+    if missing and counted:
+        counted(missing)
+    found = [ev for ev in events if isinstance(ev, PlaylistTrack)]
+    prefetch_references(found, ['album', 'artist', 'track'])
+
+    releases = {}
+    for i, ev in enumerate(events):
+        if not isinstance(ev, PlaylistTrack):
+            continue
+        artist_name = _release_artist_name(ev, _find_album(ev))
+        track_id = PlayCount.make_track_id(artist_name, ev.album_title)
+        if track_id not in releases:
+            releases[track_id] = [artist_name, ev.album_title, ev.label, []]
+        releases[track_id][3].append(i)
+
+    track_ids = releases.keys()
+    counts = AutoRetry(PlayCount).get_by_key_name(track_ids)
+    new_counts = []
+    for i, track_id in enumerate(track_ids):
+        if counts[i] is None:
+            artist_name, album_title, label, _ = releases[track_id]
+            counts[i] = PlayCount(key_name=track_id,
+                                  artist_name=artist_name,
+                                  album_title=album_title,
+                                  label=label,
+                                  sharded=True)
+            new_counts.append(counts[i])
+    AutoRetry(db).put(new_counts)
+    for track_id, count in zip(track_ids, counts):
+        count.increment(len(releases[track_id][3]))
+        if counted:
+            counted(releases[track_id][3])
+    return len(found)
 
-    # See also:
-    # https://developers.google.com/appengine/articles/sharding_counters
-    return HttpResponse("OK")
+
+@cronjob
+def aggregate_play_counts(request):
+    """Cron view to count the plays waiting in the pull queue.
+
+    Each release's plays are deleted from the queue as soon as they
+    are counted.  If counting fails part way through a batch, only
+    the plays that were not counted yet are leased again.
+    """
+    queue = taskqueue.Queue(PLAY_COUNT_QUEUE)
+    num = 0
+    for i in xrange(MAX_PLAY_COUNT_BATCHES):
+        tasks = queue.lease_tasks(PLAY_COUNT_LEASE_SECONDS,
+                                  PLAY_COUNT_BATCH_SIZE)
+        if not tasks:
+            break
+
+        def counted(indexes):
+            queue.delete_tasks([tasks[n] for n in indexes])
+        num += count_plays([task.payload for task in tasks], counted)
+    log.info('Counted %s plays' % num)
 
 
 @cronjob
 def expunge_play_count(request):
     """Cron view to expire old play counts."""
     # Delete tracks that have not been incremented in the last week.
-    qs = PlayCount.all().filter('modified <',
-                                datetime.now() - timedelta(days=7))
+    # Plays are counted on shards, so a count's modified time is only
+    # brought up to date when its shards are merged.
+    cutoff = datetime.now() - timedelta(days=7)
+    qs = PlayCount.all().filter('modified <', cutoff)
     num = 0
     for ob in qs.fetch(1000):
-        ob.delete()
+        if ob.merge():
+            continue
+        ob.delete_with_shards()
         num += 1
     log.info('Deleted %s old play count entries' % num)
 
@@ -185,6 +291,8 @@ def expunge_play_count(request):
 @cronjob
 def play_count_snapshot(request):
     """Cron view to create a play count snapshot (top 40)."""
+    num = PlayCount.merge_all()
+    log.info('Merged play count shards for %s entries' % num)
     qs = PlayCount.all().order('-play_count')
     results = []
     for count in qs.fetch(40):
@@ -27,9 +27,11 @@ from auth.models import User
 from djdb.models import Artist, Album, Track
 from playlists.models import (
         Playlist, DJPlaylist, BroadcastPlaylist, PlaylistTrack, 
-        PlaylistBreak, ChirpBroadcast, chirp_playlist_key)
+        PlaylistBreak, ChirpBroadcast, chirp_playlist_key, recently_played,
+        RECENT_PLAYS_KEY, HourlyQuota)
 
-__all__ = ['TestPlaylist', 'TestPlaylistTrack', 'TestPlaylistBreak']
+__all__ = ['TestPlaylist', 'TestPlaylistTrack', 'TestPlaylistBreak',
+           'TestHourlyQuota']
 
 def create_dj():    
     dj = User(email="test")
@@ -272,6 +274,30 @@ class TestPlaylistTrack(PlaylistEventTest):
         self.assertEqual(recent_tracks[1].track_title,
             "Ember")
 
+    def test_recently_played(self):
+        playlist = ChirpBroadcast()
+        selector = create_dj()
+        sunshine = self.tracks['You Are The Sunshine Of My Life']
+        try:
+            self.assertEqual(set(), recently_played(3600)['track'])
+            track = PlaylistTrack(
+                selector=selector,
+                playlist=playlist,
+                artist=self.stevie,
+                album=self.talking_book,
+                track=sunshine
+            )
+            track.put()
+            # Saving the track invalidated the cached plays.
+            recent = recently_played(3600)
+            self.assertEqual(set([self.stevie.key()]), recent['artist'])
+            self.assertEqual(set([self.talking_book.key()]), recent['album'])
+            self.assertEqual(set([sunshine.key()]), recent['track'])
+            # Plays older than the window are left out.
+            self.assertEqual(set(), recently_played(0)['track'])
+        finally:
+            memcache.delete(RECENT_PLAYS_KEY)
+
 class TestPlaylistBreak(PlaylistEventTest):
     
     def test_break(self):
@@ -298,3 +324,60 @@ class TestPlaylistBreak(PlaylistEventTest):
         self.assertEqual(
             [type(e) for e in playlist.recent_events],
             [PlaylistBreak, PlaylistTrack])
+
+class TestHourlyQuota(PlaylistEventTest):
+
+    def tearDown(self):
+        for obj in HourlyQuota.all():
+            obj.delete()
+
+    def add_track(self, categories):
+        track = PlaylistTrack(
+            selector=self.selector,
+            playlist=self.playlist,
+            freeform_artist_name="The Meters",
+            freeform_album_title="Chicken Strut",
+            freeform_track_title="Hand Clapping Song",
+            categories=categories)
+        track.put()
+        return track
+
+    def get_counts(self):
+        quota = HourlyQuota.get_for(self.playlist.key())
+        return [getattr(quota, c) for c in HourlyQuota.CATEGORIES]
+
+    def test_counts(self):
+        self.playlist = ChirpBroadcast()
+        self.selector = create_dj()
+        self.add_track(['heavy_rotation', 'local_current'])
+        self.add_track([])
+        # The first read counts the hour's tracks.
+        self.assertEqual([1, 0, 1, 0], self.get_counts())
+        self.assertEqual(1, HourlyQuota.all().count())
+
+        track = self.add_track(['heavy_rotation'])
+        HourlyQuota.count_track(track, 1)
+        self.assertEqual([2, 0, 1, 0], self.get_counts())
+        track.delete()
+        HourlyQuota.count_track(track, -1)
+        self.assertEqual([1, 0, 1, 0], self.get_counts())
+
+        # Missing counters are rebuilt before a new track is counted.
+        HourlyQuota.all()[0].delete()
+        track = self.add_track(['light_rotation'])
+        HourlyQuota.count_track(track, 1)
+        self.assertEqual([1, 1, 1, 0], self.get_counts())
+
+    def test_counts_each_track_once(self):
+        self.playlist = ChirpBroadcast()
+        self.selector = create_dj()
+        track = self.add_track(['heavy_rotation'])
+        # The rebuild finds the track, so counting it adds nothing.
+        HourlyQuota.count_track(track, 1)
+        self.assertEqual([1, 0, 0, 0], self.get_counts())
+        HourlyQuota.count_track(track, 1)
+        self.assertEqual([1, 0, 0, 0], self.get_counts())
+        track.delete()
+        HourlyQuota.count_track(track, -1)
+        HourlyQuota.count_track(track, -1)
+        self.assertEqual([0, 0, 0, 0], self.get_counts())
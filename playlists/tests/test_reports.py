@@ -26,8 +26,14 @@ from django.core.urlresolvers import reverse
 
 from auth import roles
 from djdb.models import HEAVY_ROTATION_TAG, LIGHT_ROTATION_TAG
+from google.appengine.ext import db
+
+from jobs import OUTPUT
+from playlists import reports
+from playlists import rollups
 from playlists import views as playlists_views
-from playlists.models import Playlist, PlaylistTrack, PlaylistBreak, ChirpBroadcast
+from playlists.models import (Playlist, PlaylistTrack, PlaylistBreak,
+                              ChirpBroadcast, PlayRollup, PlayRollupDay)
 from playlists.tests.test_views import PlaylistViewsTest
 from playlists.tests.test_views import create_stevie_wonder_album_data
 
@@ -99,6 +105,99 @@ class TestPlaylistReport(PlaylistViewsTest):
         self.assertEquals(len(tracks), pl.count())
 
 
+    def test_rollups(self):
+        selector = self.get_selector()
+        playlist = ChirpBroadcast()
+        day = datetime.date(2010, 1, 10)
+
+        def create_track(album, established, categories=()):
+            track = PlaylistTrack(
+                        playlist=playlist,
+                        selector=selector,
+                        categories=list(categories),
+                        freeform_artist_name="artist",
+                        freeform_album_title=album,
+                        freeform_track_title="track",
+                        freeform_label="label",
+                        established=established)
+            track.put()
+            return track
+
+        create_track("a", datetime.datetime(2010, 1, 9, 23, 0))
+        create_track("a", datetime.datetime(2010, 1, 10, 1, 0))
+        create_track("a", datetime.datetime(2010, 1, 10, 2, 0),
+                     [HEAVY_ROTATION_TAG])
+        late = create_track("b", datetime.datetime(2010, 1, 10, 3, 0))
+
+        def counts():
+            items = rollups.plays_by_release(day - timedelta(days=1), day)
+            return [(i['album_title'], i['play_count'],
+                     i['heavy_rotation']) for i in items]
+        expected = [("b", 1, 0), ("a", 3, 1)]
+        self.assertEquals(expected, counts())
+
+        marker = rollups.rollup_day(day)
+        self.assertEquals(3, marker.num_plays)
+        self.assertEquals(2, PlayRollup.all().count())
+        self.assertEquals(expected, counts())
+        # The rollup is used in place of the day's plays.
+        db.put(PlaylistTrack(playlist=playlist, selector=selector,
+                             freeform_artist_name="artist",
+                             freeform_album_title="c",
+                             freeform_track_title="track",
+                             established=datetime.datetime(2010, 1, 10, 4)))
+        self.assertEquals(expected, counts())
+
+        # Deleting a play makes the reports ignore the day's rollup
+        # until it is redone.
+        late.delete()
+        self.assertFalse(PlayRollupDay.get_by_key_name('2010-01-10').is_fresh)
+        expected = [("c", 1, 0), ("a", 3, 1)]
+        self.assertEquals(expected, counts())
+        rollups.rollup_day(day)
+        self.assertEquals(expected, counts())
+        self.assertEquals(2, PlayRollup.all().count())
+        for ob in PlayRollup.all():
+            ob.delete()
+        for ob in PlayRollupDay.all():
+            ob.delete()
+
+    def test_report_worker(self):
+        selector = self.get_selector()
+        playlist = ChirpBroadcast()
+        for album, established in (
+                ("a", datetime.datetime(2010, 1, 8, 1, 0)),
+                ("a", datetime.datetime(2010, 1, 9, 1, 0)),
+                ("b", datetime.datetime(2010, 1, 9, 2, 0)),
+                ("a", datetime.datetime(2010, 1, 10, 1, 0))):
+            PlaylistTrack(playlist=playlist,
+                          selector=selector,
+                          freeform_artist_name="artist",
+                          freeform_album_title=album,
+                          freeform_track_title="track",
+                          freeform_label="label",
+                          established=established).put()
+        # Only the day in the middle has been rolled up.
+        rollups.rollup_day(datetime.date(2010, 1, 9))
+
+        params = {'from_date': '2010-01-08', 'to_date': '2010-01-10'}
+        results = None
+        finished = False
+        num_steps = 0
+        while not finished:
+            finished, results = reports.playlist_report_worker(results,
+                                                               params)
+            num_steps += 1
+        # One step for the rollups and one for each of the other days.
+        self.assertEquals(3, num_steps)
+        self.assertEquals(
+            {"a,artist,label": 3, "b,artist,label": 1},
+            results['play_counts'])
+        for ob in PlayRollup.all():
+            ob.delete()
+        for ob in PlayRollupDay.all():
+            ob.delete()
+
     def test_report_csv(self):
         selector = self.get_selector()
         playlist = ChirpBroadcast()
@@ -176,6 +275,45 @@ class TestPlaylistReport(PlaylistViewsTest):
             report.next())
     
     
+    def test_export_report_in_shards(self):
+        selector = self.get_selector()
+        playlist = ChirpBroadcast()
+        # Three plays either side of midnight UTC, which is the same
+        # day in Chicago.
+        for i, established in enumerate([
+                datetime.datetime(2011, 3, 1, 23, 40),
+                datetime.datetime(2011, 3, 1, 23, 50),
+                datetime.datetime(2011, 3, 2, 0, 10)]):
+            track = PlaylistTrack(
+                        playlist=playlist,
+                        selector=selector,
+                        freeform_artist_name="Artist %d" % i,
+                        freeform_album_title="Album %d" % i,
+                        freeform_track_title="Track %d" % i,
+                        freeform_label="Label")
+            track.put()
+            track.established = established
+            track.put()
+
+        def export(params):
+            results = None
+            finished = False
+            output = []
+            while not finished:
+                finished, results = reports.playlist_export_report_worker(
+                    results, params)
+                output.extend(results.pop(OUTPUT, []))
+            return ''.join(output)
+
+        params = {'from_date': '2011-03-01', 'to_date': '2011-03-02'}
+        unsharded = export(params)
+        self.assertEquals(3, len(unsharded.splitlines()))
+        shards = reports.split_export_report(params)
+        self.assertEquals(
+            [('2011-03-02', '2011-03-02'), ('2011-03-01', '2011-03-01')],
+            [(p['from_date'], p['to_date']) for p in shards])
+        self.assertEquals(unsharded, ''.join(export(p) for p in shards))
+
     def test_report_ignores_reference_errors(self):
         selector = self.get_selector()
         playlist = ChirpBroadcast()
@@ -27,6 +27,7 @@ import unittest
 # future: urlparse
 
 from django.test import TestCase, Client
+from django.conf import settings
 from django.core.urlresolvers import reverse
 import fudge
 from fudge.inspector import arg
@@ -41,8 +42,10 @@ from auth.models import User
 import playlists.tasks
 from playlists import views as playlists_views
 from playlists.models import (Playlist, PlaylistTrack, PlaylistBreak,
-                              ChirpBroadcast, PlayCount, PlayCountSnapshot)
-from djdb.models import Artist, Album, Track
+                              ChirpBroadcast, PlayCount, PlayCountShard,
+                              PlayCountSnapshot)
+from djdb.models import (Artist, Album, CompilationTrackLookup,
+                         ReindexState, Track)
 
 import time
 
@@ -64,6 +67,9 @@ def clear_data():
         pl.delete()
     for ob in PlayCount.all():
         ob.delete()
+    for ob in PlayCountShard.all():
+        ob.delete()
+    memcache.flush_all()
 
 def create_stevie_wonder_album_data():
     stevie = Artist.create(name="Stevie Wonder")
@@ -99,6 +105,10 @@ def create_stevie_wonder_album_data():
                     track_num=idx+1)
         tracks[title] = track
         track.put()
+    # The tracks were not saved through the indexer, which would
+    # otherwise have done this.
+    CompilationTrackLookup.add_tracks(
+        [(title, stevie.name, talking_book.key()) for title in tracks])
 
     return stevie, talking_book, tracks
 
@@ -514,6 +524,95 @@ class TestDeleteTrackFromPlaylist(PlaylistViewsTest):
         resp = self.client.get(reverse('playlists_landing_page'))
         assert '[delete]' not in resp.content
 
+class TestPlaylistHistory(PlaylistViewsTest):
+
+    def setUp(self):
+        super(TestPlaylistHistory, self).setUp()
+        settings.PLAYLISTS_HISTORY_CACHE = True
+        self.playlist = ChirpBroadcast()
+
+    def tearDown(self):
+        settings.PLAYLISTS_HISTORY_CACHE = False
+        super(TestPlaylistHistory, self).tearDown()
+
+    def get_events(self):
+        resp = self.client.get(reverse('playlists_landing_page'))
+        return [t for t in resp.context[0]['playlist_events']]
+
+    @fudge.patch('playlists.tasks.taskqueue')
+    def test_history(self, fake_tq):
+        fake_tq.provides('add')
+        track = PlaylistTrack(
+                    playlist=self.playlist,
+                    selector=self.get_selector(),
+                    freeform_artist_name="Steely Dan",
+                    freeform_album_title="Aja",
+                    freeform_track_title="Peg")
+        track.put()
+        # The first page load queries for the history.
+        eq_([e.artist_name for e in self.get_events()], ["Steely Dan"])
+
+        resp = self.client.post(reverse('playlists_add_event'), {
+            'submit': "Add Break",
+        })
+        resp = self.client.post(reverse('playlists_add_event'), {
+            'artist': "Squarepusher",
+            'song': "Port Rhombus",
+            'album': "Port Rhombus EP",
+            'label': "Warp Records",
+        })
+        self.assertRedirects(resp, reverse('playlists_landing_page'))
+        # Tracks saved behind the history's back do not show up.
+        PlaylistTrack(playlist=self.playlist,
+                      selector=self.get_selector(),
+                      freeform_artist_name="Peaches",
+                      freeform_track_title="Rock Show").put()
+        events = self.get_events()
+        eq_([e.is_break for e in events], [False, True, False])
+        eq_(events[0].artist_name, "Squarepusher")
+        eq_(events[0].is_new, True)
+        eq_(events[2].is_new, False)
+
+        self.client.get(reverse('playlists_delete_event',
+                                args=[events[0].key()]))
+        eq_([e.is_break for e in self.get_events()], [True, False])
+
+
+class TestAggregatedPlayCounts(PlaylistViewsTest):
+
+    def setUp(self):
+        super(TestAggregatedPlayCounts, self).setUp()
+        settings.PLAYLISTS_AGGREGATE_PLAY_COUNTS = True
+
+    def tearDown(self):
+        settings.PLAYLISTS_AGGREGATE_PLAY_COUNTS = False
+        super(TestAggregatedPlayCounts, self).tearDown()
+
+    @fudge.patch('playlists.tasks.taskqueue')
+    def test_add_track_queues_a_pull_task(self, fake_tq):
+        task = fudge.Fake('Task')
+        (fake_tq.expects('add')
+                .with_args(
+                    url=reverse('playlists.send_track_to_live_site'),
+                    params={'id': arg.any_value()},
+                    queue_name='live-site-playlists'))
+        (fake_tq.expects('Task')
+                .with_args(payload=arg.any_value(), method='PULL')
+                .returns(task))
+        (fake_tq.expects('Queue').with_args('play-counts')
+                .returns_fake()
+                .expects('add').with_args(task))
+
+        resp = self.client.post(reverse('playlists_add_event'), {
+            'artist': "Squarepusher",
+            'song': "Port Rhombus",
+            'album': "Port Rhombus EP",
+            'label': "Warp Records",
+        })
+        self.assertNoFormErrors(resp)
+        self.assertRedirects(resp, reverse('playlists_landing_page'))
+
+
 class TaskTest(object):
 
     def get_selector(self):
@@ -608,7 +707,7 @@ class TestPlayCountTask(TaskTest, TestCase):
         eq_(count.artist_name, self.track.freeform_artist_name)
         eq_(count.album_title, self.track.freeform_album_title)
         eq_(count.label, self.track.label)
-        eq_(count.play_count, 2)
+        eq_(count.sum_shards(), 2)
 
     def test_different_tracks(self):
         self.count()
@@ -640,7 +739,104 @@ class TestPlayCountTask(TaskTest, TestCase):
         eq_(count.artist_name, self.track.freeform_artist_name)
         eq_(count.album_title, self.track.freeform_album_title)
         eq_(count.label, self.track.label)
-        eq_(count.play_count, 2)
+        eq_(count.sum_shards(), 2)
+
+    def test_count_is_sharded(self):
+        for i in range(3):
+            self.count()
+        count = PlayCount.all()[0]
+        shards = PlayCountShard.all().fetch(100)
+        assert len(shards) >= 1
+        for shard in shards:
+            eq_(shard.track_id, count.track_id)
+            assert shard.key().name().startswith(count.track_id + '-')
+        eq_(sum(s.count for s in shards), 3)
+        # The count itself is only brought up to date by a merge.
+        eq_(count.play_count, 0)
+        eq_(count.sum_shards(), 3)
+        self.count()
+        eq_(PlayCount.all()[0].sum_shards(), 4)
+        # The running total in memcache keeps up with the shards once
+        # it has been read.
+        eq_(count.total(), 4)
+        self.count()
+        eq_(count.total(), 5)
+        eq_(PlayCount.merge_all(), 1)
+        eq_(PlayCount.all()[0].play_count, 5)
+        eq_(PlayCount.merge_all(), 0)
+
+    def test_count_plays(self):
+        new_trk = PlaylistTrack(
+            playlist=self.track.playlist,
+            selector=self.track.selector,
+            freeform_artist_name='Prince',
+            freeform_album_title='Purple Rain',
+            freeform_track_title='When Doves Cry')
+        new_trk.put()
+        gone_trk = PlaylistTrack(
+            playlist=self.track.playlist,
+            selector=self.track.selector,
+            freeform_artist_name='Prince',
+            freeform_album_title='Sign o the Times',
+            freeform_track_title='Starfish and Coffee')
+        gone_trk.put()
+        gone_trk.delete()
+        counted = []
+        num = playlists.tasks.count_plays(
+            [str(self.track.key()), str(self.track.key()), str(new_trk.key()),
+             str(gone_trk.key())],
+            counted.append)
+        eq_(num, 3)
+        # Deleted plays are reported first, then each release's plays
+        # once they have been counted.
+        eq_(counted[0], [3])
+        eq_(sorted(counted[1:]), [[0, 1], [2]])
+        totals = dict((c.album_title, c.sum_shards()) for c in PlayCount.all())
+        eq_(totals, {self.track.freeform_album_title: 2, 'Purple Rain': 1})
+        # Each release was written to once.
+        eq_(PlayCountShard.all().count(), 2)
+        res = self.snapshot()
+        eq_(res.status_code, 200)
+        snap = PlayCountSnapshot.all().order('-play_count')[0]
+        eq_(snap.play_count, 2)
+        eq_(snap.label, self.track.label)
+
+    def test_count_from_before_sharding(self):
+        track_id = PlayCount.make_track_id(self.track.artist_name,
+                                           self.track.album_title)
+        PlayCount(key_name=track_id,
+                  artist_name=self.track.artist_name,
+                  album_title=self.track.album_title,
+                  label=self.track.label,
+                  play_count=5).put()
+        self.count()
+        count = PlayCount.all()[0]
+        eq_(count.sharded, False)
+        eq_(count.sum_shards(), 6)
+        eq_(PlayCount.merge_all(), 1)
+        count = PlayCount.all()[0]
+        eq_(count.sharded, True)
+        eq_(count.play_count, 6)
+        eq_(count.sum_shards(), 6)
+        # The old total is moved to a shard only once.
+        eq_(PlayCount.merge_all(), 0)
+        eq_(count.merge(), False)
+        self.count()
+        eq_(PlayCount.merge_all(), 1)
+        eq_(PlayCount.all()[0].play_count, 7)
+
+    @fudge.patch('playlists.tasks.taskqueue')
+    def test_aggregate_play_counts(self, fake_tq):
+        task = fudge.Fake('Task').has_attr(payload=str(self.track.key()))
+        (fake_tq.provides('Queue').with_args('play-counts')
+                .returns_fake()
+                .expects('lease_tasks').returns([task, task])
+                .next_call().returns([])
+                .expects('delete_tasks').with_args([task, task]))
+        res = self.client.post(reverse('playlists.aggregate_play_counts'),
+                               HTTP_X_APPENGINE_CRON='true')
+        eq_(res.status_code, 200)
+        eq_(PlayCount.all()[0].sum_shards(), 2)
 
     def test_expunge(self):
         from nose.exc import SkipTest
@@ -754,6 +950,58 @@ class TestPlayCountTask(TaskTest, TestCase):
         eq_(snap.album_title, 'Talking Book')
 
 
+    def test_freeform_compilation_without_lookup(self):
+        stevie, talking_book, tracks = create_stevie_wonder_album_data()
+        talking_book.is_compilation = True
+        talking_book.put()
+        # Tracks indexed before CompilationTrackLookup existed are
+        # still found.
+        for lookup in CompilationTrackLookup.all():
+            lookup.delete()
+        new_trk = PlaylistTrack(
+            playlist=self.track.playlist,
+            selector=self.track.selector,
+            freeform_album_title='Talking Book',
+            freeform_artist_name='Stevie Wonder',
+            freeform_track_title='Superstition',
+            freeform_label='...')
+        new_trk.put()
+        self.count(track_key=new_trk.key())
+        res = self.snapshot()
+        eq_(res.status_code, 200)
+        snap = PlayCountSnapshot.all()[0]
+        eq_(snap.artist_name, 'Various')
+        eq_(snap.album_title, 'Talking Book')
+
+    def test_freeform_track_not_on_a_compilation(self):
+        stevie, talking_book, tracks = create_stevie_wonder_album_data()
+        talking_book.is_compilation = True
+        talking_book.put()
+        for lookup in CompilationTrackLookup.all():
+            lookup.delete()
+        # Once a rebuild has listed every compilation track, a track
+        # missing from the lookup is not looked for any further.
+        state = ReindexState(key_name=ReindexState.KEY_NAME,
+                             old_generation=1, new_generation=2,
+                             phase='done', lists_compilation_tracks=True)
+        state.put()
+        try:
+            new_trk = PlaylistTrack(
+                playlist=self.track.playlist,
+                selector=self.track.selector,
+                freeform_album_title='Talking Book',
+                freeform_artist_name='Stevie Wonder',
+                freeform_track_title='Superstition',
+                freeform_label='...')
+            new_trk.put()
+            self.count(track_key=new_trk.key())
+        finally:
+            state.delete()
+        res = self.snapshot()
+        eq_(res.status_code, 200)
+        snap = PlayCountSnapshot.all()[0]
+        eq_(snap.artist_name, 'Stevie Wonder')
+
 class IsFromStudioTests(TestCase):
     """Test the FromStudioMiddleware playlists middleware."""
 
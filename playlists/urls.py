@@ -37,8 +37,17 @@ urlpatterns += patterns('playlists.tasks',
         name='playlists.send_track_to_live_site'),
     url(r'^task/play_count$', 'play_count',
         name='playlists.play_count'),
+    url(r'^task/aggregate_play_counts$', 'aggregate_play_counts',
+        name='playlists.aggregate_play_counts'),
     url(r'^task/expunge_play_count$', 'expunge_play_count',
         name='playlists.expunge_play_count'),
     url(r'^task/play_count_snapshot$', 'play_count_snapshot',
         name='playlists.play_count_snapshot'),
 )
+
+urlpatterns += patterns('playlists.rollups',
+    url(r'^task/rollup_plays$', 'rollup_plays',
+        name='playlists.rollup_plays'),
+    url(r'^task/rollup_day$', 'rollup_day_task',
+        name='playlists.rollup_day'),
+)
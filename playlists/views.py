@@ -32,12 +32,15 @@ from auth.decorators import require_role
 import auth
 from auth import roles
 from djdb.models import Album, HEAVY_ROTATION_TAG, LIGHT_ROTATION_TAG
+from playlists import history
 from playlists.forms import PlaylistTrackForm
 from playlists.models import (PlaylistTrack, PlaylistEvent, PlaylistBreak,
-                              chirp_playlist_key, ChirpBroadcast)
+                              HourlyQuota, chirp_playlist_key, ChirpBroadcast,
+                              RECENT_PLAYS_KEY)
 from playlists.tasks import playlist_event_listeners
 from common.utilities import as_encoded_str, http_send_csv_file
 from common.autoretry import AutoRetry
+from common.prefetch import prefetch_references
 from common import time_util
 from common.time_util import chicago_now
 from djdb.models import Track
@@ -73,7 +76,8 @@ class PlaylistEventView(object):
 
     def __init__(self, playlist_event):
         self.playlist_event = playlist_event
-        self.is_break = type(self.playlist_event) is PlaylistBreak
+        self.is_break = type(self.playlist_event) in (PlaylistBreak,
+                                                      CachedPlaylistBreak)
         self.is_new = False
 
     def __getattr__(self, key):
@@ -92,6 +96,7 @@ class CachedSelector(object):
 class CachedPlaylistEvent(object):
 
     def __init__(self, data):
+        self.cached_data = data
         self._key = data['key']
         self.artist_name = data['artist_name']
         self.track_title = data['track_title']
@@ -108,14 +113,36 @@ class CachedPlaylistEvent(object):
         return Key(encoded=self._key)
 
 
+class CachedPlaylistBreak(object):
+
+    def __init__(self, data):
+        self.cached_data = data
+        self._key = data['key']
+        d = datetime(*data['established_display'])
+        d = time_util.convert_utc_to_chicago(d)
+        self.established_display = d
+
+    def key(self):
+        return Key(encoded=self._key)
+
+
+def cached_playlist_event(data):
+    """Makes a cached event out of data from playlists.history."""
+    if data.get('is_break'):
+        return CachedPlaylistBreak(data)
+    return CachedPlaylistEvent(data)
+
+
 def iter_playlist_events_for_view(query):
     """Iterate a query of playlist event objects.
 
     returns a generator to produce PlaylistEventView() objects
     which contain some extra attributes for the view.
     """
-    first_break = False
-    events = list(query)
+    return _iter_views(_with_last_track(list(query)))
+
+
+def _with_last_track(events):
     last_track = memcache.get('playlist.last_track')
 
     if last_track:
@@ -131,7 +158,11 @@ def iter_playlist_events_for_view(query):
             events.insert(0, CachedPlaylistEvent(last_track))
     else:
         log.info('playlist.last_track was not in memcache')
+    return events
+
 
+def _iter_views(events):
+    first_break = False
     for playlist_event in events:
         pl_view = PlaylistEventView(playlist_event)
         if pl_view.is_break:
@@ -157,37 +188,29 @@ def get_vars(request):
     return vars
 
 def get_quotas(playlist):
-    quotas = {'heavy_rotation_played': 0,
-              'heavy_rotation_target': TRACKS_HEAVY_ROTATION_TARGET,
-              'light_rotation_played': 0,
-              'light_rotation_target': TRACKS_LIGHT_ROTATION_TARGET,
-              'local_current_played': 0,
-              'local_current_target': TRACKS_LOCAL_CURRENT_TARGET,
-              'local_classic_played': 0,
-              'local_classic_target': TRACKS_LOCAL_CLASSIC_TARGET}
-    pl = PlaylistEvent.all().filter('playlist =', playlist)
-    now = chicago_now()
-    now.replace(second=0, microsecond=0)
-    pl.filter('established >=', now - timedelta(seconds=60 * now.minute))
-    pl.filter('established <', now + timedelta(seconds=60 * (60 - now.minute)))
-    for event in iter_playlist_events_for_view(pl):
-        if not event.is_break:
-            if 'heavy_rotation' in event.categories:
-                quotas['heavy_rotation_played'] += 1
-            if 'light_rotation' in event.categories:
-                quotas['light_rotation_played'] += 1
-            if 'local_current' in event.categories:
-                quotas['local_current_played'] += 1
-            if 'local_classic' in event.categories:
-                quotas['local_classic_played'] += 1
-
-    return quotas
+    quota = HourlyQuota.get_for(playlist)
+    return {'heavy_rotation_played': quota.heavy_rotation,
+            'heavy_rotation_target': TRACKS_HEAVY_ROTATION_TARGET,
+            'light_rotation_played': quota.light_rotation,
+            'light_rotation_target': TRACKS_LIGHT_ROTATION_TARGET,
+            'local_current_played': quota.local_current,
+            'local_current_target': TRACKS_LOCAL_CURRENT_TARGET,
+            'local_classic_played': quota.local_classic,
+            'local_classic_target': TRACKS_LOCAL_CLASSIC_TARGET}
 
 def get_playlist_history(playlist):
+    recent = history.get(playlist, hours=3)
+    if recent is not None:
+        return list(_iter_views([cached_playlist_event(data)
+                                 for data in recent]))
     pl = PlaylistEvent.all().filter('playlist =', playlist)
     pl = pl.filter('established >=', datetime.now() - timedelta(hours=3))
     pl = pl.order('-established')
-    return list(iter_playlist_events_for_view(pl))
+    events = list(pl)
+    prefetch_references(events, ['selector', 'artist', 'track', 'album'])
+    events = _with_last_track(events)
+    history.fill(playlist, events)
+    return list(_iter_views(events))
 
 @require_role(roles.DJ)
 def landing_page(request, vars=None):
@@ -215,6 +238,7 @@ def create_event(request):
         if request.POST.get('submit') == 'Add Break':
             b = PlaylistBreak(playlist=vars['playlist'])
             b.put()
+            history.add(b)
             vars['add_break'] = True
             # errors should not display on add break, reset internal hash
             vars['form']._errors = {}
@@ -238,9 +262,13 @@ def delete_event(request, event_key):
     else:
         if e and e.selector.key() == auth.get_current_user(request).key():
             e.delete()
+            if isinstance(e, PlaylistTrack):
+                HourlyQuota.count_track(e, -1)
+            history.remove(e)
             # This avoids seeing dupes after deleting the last
             # submitted track.
             memcache.delete('playlist.last_track')
+            memcache.delete(RECENT_PLAYS_KEY)
             playlist_event_listeners.delete(event_key)
 
     return HttpResponseRedirect(reverse('playlists_landing_page'))
@@ -294,6 +322,12 @@ def query_group_by_track_key(from_date, to_date):
     '''
 
     query = filter_tracks_by_date_range(from_date, to_date)
+    return group_by_track_key(AutoRetry(query), from_date, to_date)
+
+
+def group_by_track_key(plays, from_date, to_date):
+    '''groups some plays, newest first, like query_group_by_track_key()
+    '''
     fields = ['album_title', 'artist_name', 'label']
 
     #
@@ -314,13 +348,15 @@ def query_group_by_track_key(from_date, to_date):
         return ','.join(key_parts)
 
     # dict version of db rec
-    def item2hash(item):
+    def item2hash(item, key):
         d = {}
-        for key in fields:
-            d[key] = _get_entity_attr(item, key, None)
+        for field in fields:
+            d[field] = _get_entity_attr(item, field, None)
 
         # init additional props
+        d[key_item] = key
         d[key_counter] = 0
+        d['last_played'] = item.established
         d['from_date'] = from_date
         d['to_date'] = to_date
         d['heavy_rotation'] = int(bool(HEAVY_ROTATION_TAG in item.categories))
@@ -334,11 +370,11 @@ def query_group_by_track_key(from_date, to_date):
     # hash of seen keys
     seen = {}
 
-    for item in AutoRetry(query):
+    for item in plays:
         key = item_key(item)
 
         if not seen.has_key(key):
-            x = item2hash(item)
+            x = item2hash(item, key)
             seen[key] = x
             items.append(x)
 
@@ -367,12 +403,14 @@ def bootstrap(request):
                        album=track.album,
                        track=track)
         pl_track.put()
+        HourlyQuota.count_track(pl_track, 1)
         if minutes > 0 and minutes % 25 == 0:
             pl_break = PlaylistBreak(
                            playlist=playlist,
                            established = datetime.now() - timedelta(minutes=minutes - 1))
             pl_break.put()
         minutes += 5
+    history.forget(playlist.key())
 
     return HttpResponseRedirect("/playlists/")
 
@@ -74,6 +74,8 @@ MEDIA_URL = '/media/'
 # this is necessary so they are executed by Admin user
 # (internal Task Queue user)
 PUBLIC_TOP_LEVEL_URLS = ['/playlists/task',
+                         '/jobs/task',
+                         '/djdb/task',
                          '/auth/task',
                          '/auth/cron',
                          '/_ah/warmup',
@@ -136,6 +138,26 @@ if RUNNING_TESTS:
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
+# The following features are off unless turned on here.  Each has
+# test classes that turn it on for their tests.
+
+# Serve DJ database searches from an in-memory snapshot of the search
+# index (see djdb/search_index.py).  Each instance holds the whole index
+# in memory, twice while the snapshot is being rebuilt.
+DJDB_SEARCH_SNAPSHOT = False
+
+# Cache DJ database search results (see djdb/search_cache.py).
+DJDB_SEARCH_CACHE = False
+
+# Queue plays in a pull queue and count them in batches from cron (see
+# aggregate_play_counts in playlists/tasks.py) rather than with one task
+# per play.
+PLAYLISTS_AGGREGATE_PLAY_COUNTS = False
+
+# Keep each playlist's recent events in memcache for the tracker page
+# (see playlists/history.py).
+PLAYLISTS_HISTORY_CACHE = False
+
 NOSE_ARGS = ['--logging-clear-handlers', '--with-nicedots']
 
 NOSE_PLUGINS = [
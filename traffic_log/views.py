@@ -21,8 +21,7 @@ import datetime
 import calendar
 import logging
 from collections import defaultdict
-from StringIO import StringIO
-import csv
+import itertools
 
 from google.appengine.ext import db
 
@@ -36,6 +35,7 @@ from django.utils import simplejson
 import django.forms
 
 from common.utilities import (as_json, http_send_csv_file, as_encoded_str,
+                              http_stream_csv_file, iter_csv,
                               restricted_job_worker, restricted_job_product)
 from common import time_util
 from common.autoretry import AutoRetry
@@ -43,6 +43,8 @@ import auth
 from auth.models import User
 from auth.roles  import DJ, TRAFFIC_LOG_ADMIN
 from auth.decorators import require_role
+from jobs import (iter_query_batches, query_finished, read_output,
+                  split_date_range, write_output)
 from traffic_log import models, forms, constants
 
 log = logging.getLogger()
@@ -468,76 +470,87 @@ def traffic_log(request, date):
         context_instance=RequestContext(request))
 
 
-@restricted_job_worker('build-trafficlog-report', TRAFFIC_LOG_ADMIN)
+REPORT_FIELDS = ['readtime', 'dow', 'slot_time', 'underwriter',
+                 'title', 'type', 'excerpt']
+
+
+def mkdt(dt_string):
+    parts = [int(p) for p in dt_string.split("-")]
+    return datetime.datetime(*parts)
+
+
+def split_report(request_params):
+    """Splits the params of a traffic log report by date, to run in
+    parallel.
+    """
+    shards = []
+    for start_date, end_date in split_date_range(
+                                    mkdt(request_params['start_date']).date(),
+                                    mkdt(request_params['end_date']).date()):
+        params = dict(request_params)
+        params['start_date'] = str(start_date)
+        params['end_date'] = str(end_date)
+        shards.append(params)
+    return shards
+
+
+@restricted_job_worker('build-trafficlog-report', TRAFFIC_LOG_ADMIN,
+                       splitter=split_report)
 def trafficlog_report_worker(results, request_params):
-    fields = ['readtime', 'dow', 'slot_time', 'underwriter',
-              'title', 'type', 'excerpt']
+    fields = REPORT_FIELDS
     if results is None:
-        # when starting the job, init file lines with the header row...
-        results = {
-            "file_lines": [ 
-                ",".join(fields) + "\n" 
-            ],
-            'last_offset': 0
-        }
+        results = {}
     
-    offset = results['last_offset']
-    last_offset = offset+50
-    results['last_offset'] = last_offset
-    
-    def mkdt(dt_string):
-        parts = [int(p) for p in dt_string.split("-")]
-        return datetime.datetime(*parts)
-        
     query = (models.TrafficLogEntry.all()
                 .filter('log_date >=', mkdt(request_params['start_date']))
                 .filter('log_date <',
                         mkdt(request_params['end_date']) +
                         datetime.timedelta(days=1))
     )
+    spot_keys = None
     if request_params['type']:
         index = constants.SPOT_TYPE_CHOICES.index(request_params['type'])
         if index > 0:
             # -1 = not found, 0 = ALL
-            spots = models.Spot.all().filter(
+            # Queries with an IN filter cannot be resumed from a cursor,
+            # so the entries are filtered by spot type as they are read.
+            spots = db.Query(models.Spot, keys_only=True).filter(
                         'type =', constants.SPOT_TYPE_CHOICES[index])
-            query = query.filter('spot IN', list(spots))
+            spot_keys = set(AutoRetry(spots).run())
     # TODO(Kumar) figure out why this doesn't work!
     # if request_params['underwriter']:
     #     copies = models.SpotCopy.all().filter('underwriter =',
     #                                           request_params['underwriter'])
     #     query = query.filter('spot_copy IN', list(copies))
                         
-    all_entries = query[ offset: last_offset ]
-    if len(all_entries) == 0:
-        finished = True
-    else:
-        finished = False
-    
-    for entry in all_entries:
-        # TODO(Kumar) - see above
-        if request_params['underwriter']:
-            if entry.spot_copy.underwriter != request_params['underwriter']:
-                continue
-        buf = StringIO()
-        writer = csv.DictWriter(buf, fields)
-        row = report_entry_to_csv_dict(entry)
-        for k, v in row.items():
-            row[k] = as_encoded_str(v, encoding='utf8')
-        writer.writerow(row)
-        results['file_lines'].append(buf.getvalue())
+    def rows(entries):
+        for entry in entries:
+            if spot_keys is not None:
+                spot_key = models.TrafficLogEntry.spot.get_value_for_datastore(
+                                                                        entry)
+                if spot_key not in spot_keys:
+                    continue
+            # TODO(Kumar) - see above
+            if request_params['underwriter']:
+                if entry.spot_copy.underwriter != request_params['underwriter']:
+                    continue
+            row = report_entry_to_csv_dict(entry)
+            # Like csv.DictWriter, leave out fields the entry lacks.
+            yield [as_encoded_str(row.get(k, ''), encoding='utf8')
+                   for k in fields]
+
+    for entries in iter_query_batches(query, results):
+        write_output(results, ''.join(iter_csv(rows(entries))))
     
-    return finished, results
+    return query_finished(results), results
 
 
 @restricted_job_product('build-trafficlog-report', TRAFFIC_LOG_ADMIN)
 def playlist_report_product(results):
     fname = "chirp-traffic_log"
-    response = HttpResponse(content_type='text/csv; charset=utf-8')
-    response['Content-Disposition'] = "attachment; filename=%s.csv" % (fname)
-    for line in results['file_lines']:
-        response.write(line)
-    return response
+    return http_stream_csv_file(fname,
+                                itertools.chain(iter_csv([REPORT_FIELDS]),
+                                                read_output(results)))
 
 
 @require_role(TRAFFIC_LOG_ADMIN)